@@ -0,0 +1 @@
+"""Shared data loading and metric computations for the dashboard apps."""
@@ -0,0 +1,128 @@
+"""Cohort retention: users grouped by the day or week of their first session.
+
+Each user's first event time and session come from ``first_seen``, as arrays
+indexed by user code, so every event finds its user's cohort and its offset
+from the first day with a lookup instead of a self-join. An event counts as
+a return when it is in another session than the user's first one, and as a
+purchase when it is an order (in any session, so day 0 includes purchases of
+the first session).
+
+For both granularities the distinct ``(user, period)`` and ``(user, session,
+period)`` cells of returning and purchasing events are found with one
+``np.unique`` each, then counted per ``(cohort, period)``. Periods are
+relative to each user's first day (week N is days 7N to 7N + 6), weekly
+cohorts start on Mondays. The resulting cube is small, and changing the
+granularity, the scope or the metric only re-slices it:
+
+- user scope: share of the cohort's users that returned / purchased in the
+  period
+- session scope: returning / purchasing sessions per 100 users of the cohort
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from analytics.encoding import value_mask
+from analytics.first_session import first_seen
+
+
+GRANULARITIES = {'Daily': 1, 'Weekly': 7}
+PERIOD_NAMES = {'Daily': 'Day', 'Weekly': 'Week'}
+RATES = {'returned': 'Return', 'purchased': 'Purchase'}
+
+COUNT_COLUMNS = ['users_returned', 'users_purchased', 'sessions_returned', 'sessions_purchased']
+
+DAY_NS = 86400 * 10**9
+
+CohortCube = namedtuple('CohortCube', ['sizes', 'counts', 'last_day'])
+
+
+def _cohort_start(days, step):
+    """First day of the cohort of each day, weeks starting on Monday (day 4 is one)."""
+    return days if step == 1 else days - (days + 3) % 7
+
+
+def _as_dates(days):
+    return np.asarray(days, dtype=np.int64).astype('datetime64[D]').astype('datetime64[ns]')
+
+
+def build_cohort_cube(df):
+    """Cohort sizes and per ``(granularity, cohort, period)`` counts of the events."""
+    user_codes, _, session_codes, first_ts, first_session = first_seen(df)
+    n_sessions = int(session_codes.max()) + 1 if len(session_codes) else 1
+    days = df['event_date'].to_numpy().view('int64') // DAY_NS
+    first_day = first_ts // DAY_NS
+    offset = days - first_day[user_codes]
+
+    returned = session_codes != first_session[user_codes]
+    purchased = value_mask(df['event_type'], 'order')
+    pairs = user_codes.astype(np.int64) * n_sessions + session_codes
+
+    sizes, counts = {}, {}
+    for granularity, step in GRANULARITIES.items():
+        cohort = _cohort_start(first_day, step)
+        period = offset // step
+        n_periods = int(period.max()) + 1 if len(period) else 1
+
+        columns = {}
+        for column, keys, per_user, mask in (
+                ('users_returned', user_codes, 1, returned),
+                ('users_purchased', user_codes, 1, purchased),
+                ('sessions_returned', pairs, n_sessions, returned),
+                ('sessions_purchased', pairs, n_sessions, purchased)):
+            cells = np.unique(keys[mask] * n_periods + period[mask])
+            users = cells // n_periods // per_user
+            columns[column] = (pd.Series(cells, dtype='int64')
+                               .groupby([_as_dates(cohort[users]), cells % n_periods])
+                               .size())
+
+        table = pd.DataFrame(columns, columns=COUNT_COLUMNS).fillna(0).astype('int64')
+        table.index.names = ['cohort', 'period']
+        counts[granularity] = table
+        sizes[granularity] = (pd.Series(_as_dates(cohort)).value_counts().sort_index()
+                              .rename_axis('cohort').rename('users'))
+
+    return CohortCube(
+        sizes=pd.concat(sizes, names=['granularity']),
+        counts=pd.concat(counts, names=['granularity']),
+        last_day=int(days.max()) if len(days) else None)
+
+
+def merge_cohort_cubes(cubes):
+    """Add up cohort cubes of user-disjoint parts of the events."""
+    last_days = [cube.last_day for cube in cubes if cube.last_day is not None]
+    return CohortCube(
+        sizes=pd.concat([cube.sizes for cube in cubes]).groupby(level=[0, 1]).sum(),
+        counts=pd.concat([cube.counts for cube in cubes]).groupby(level=[0, 1, 2]).sum(),
+        last_day=max(last_days) if last_days else None)
+
+
+def retention_matrix(cube, scope, granularity='Daily', metric='returned', periods=None):
+    """Cohorts x periods table of rates, with the cohort size in the first column.
+
+    Rates are in percent of the cohort's users (see the module docstring for
+    the session scope). Periods that start after the last day of the data are
+    NaN.
+    """
+    step = GRANULARITIES[granularity]
+    sizes = cube.sizes[cube.sizes.index.get_level_values('granularity') == granularity]
+    sizes = sizes.droplevel('granularity')
+    counts = cube.counts[cube.counts.index.get_level_values('granularity') == granularity]
+    counts = counts.droplevel('granularity')[f'{scope}s_{metric}']
+
+    cohort_days = sizes.index.to_numpy().astype('datetime64[D]').view('int64')
+    n_periods = (cube.last_day - cohort_days.min()) // step + 1 if len(sizes) else 0
+    if periods is not None:
+        n_periods = min(n_periods, periods)
+
+    table = (counts.unstack('period', fill_value=0)
+             .reindex(index=sizes.index, columns=range(n_periods), fill_value=0))
+    rates = (table.div(sizes, axis=0) * 100).round(2)
+    started = cohort_days[:, None] + np.arange(n_periods)[None, :] * step <= cube.last_day
+    rates = rates.where(started)
+
+    rates.columns = [f'{PERIOD_NAMES[granularity]} {period}' for period in rates.columns]
+    rates.insert(0, 'users', sizes.to_numpy())
+    rates.index = pd.Index(sizes.index.date, name='cohort')
+    return rates
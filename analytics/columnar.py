@@ -0,0 +1,152 @@
+"""Memory-mapped columnar copy of the encoded event frame.
+
+Every Streamlit server process used to parse the CSV into its own frame, so
+replicas on one host each held a full copy. The encoded frame (see
+``analytics.encoding``) is instead written once per dataset version to
+``<dataset dir>/.cache/columns-<version>/`` as one ``.npy`` file per array:
+
+- ``event_date.npy``: the timestamps, datetime64[ns]
+- ``<column>.codes.npy`` and ``<column>.categories.arrow`` for the
+  categorical columns, the categories as an Arrow string array
+- ``product.indices.npy`` and ``product.values.npy``: positions and values of
+  the non-zero products
+- ``columns.json``: format version, row count, column order and the size as
+  parsed, written last so a directory without it is incomplete
+
+``open_columns`` maps the arrays read-only and wraps them in a DataFrame
+without copying the codes or the categories: those stay Arrow strings backed
+by the mapped file (pandas' ``string[pyarrow]``). Processes that map the
+same files share those pages through the OS page cache. Two things are built
+per process, as pandas' public API has no way around them: the check that
+the session and user categories are unique (an object array and hash table
+over the ids), and the sparse ``product`` column, rebuilt from the mapped
+positions and values. Opening costs a small fraction of parsing the CSV.
+A newer version replaces the directory; processes still mapping the old
+files keep reading them until they reload.
+
+``python -m analytics.columnar [data.csv]`` converts a dataset ahead of time,
+otherwise the first process that parses the CSV writes the store.
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from analytics.encoding import CATEGORICAL_COLUMNS
+
+
+MANIFEST = 'columns.json'
+
+# bumped when the file layout changes, stores of another format are rewritten
+FORMAT_VERSION = 2
+
+
+def columns_dir(filepath, version):
+    """``.cache/columns-<version>`` next to the dataset."""
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)), '.cache')
+    return os.path.join(cache_dir, f'columns-{version}')
+
+
+def write_columns(df, path, parsed_mb=None):
+    """Write the encoded frame ``df`` under ``path``, replacing older versions."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    def save(name, array):
+        np.save(os.path.join(tmp_path, f'{name}.npy'), array)
+
+    def save_strings(name, values):
+        array = pa.array(np.asarray(values, dtype=object), type=pa.large_string())
+        with pa.OSFile(os.path.join(tmp_path, f'{name}.arrow'), 'wb') as f:
+            with pa.ipc.new_file(f, pa.schema([('value', array.type)])) as writer:
+                writer.write(pa.record_batch([array], names=['value']))
+
+    save('event_date', df['event_date'].to_numpy())
+    for column in CATEGORICAL_COLUMNS:
+        save(f'{column}.codes', df[column].cat.codes.to_numpy())
+        save_strings(f'{column}.categories', df[column].cat.categories)
+    product = df['product'].array
+    save('product.indices', product.sp_index.indices)
+    save('product.values', product.sp_values)
+
+    with open(os.path.join(tmp_path, MANIFEST), 'w') as f:
+        json.dump({'format': FORMAT_VERSION, 'rows': len(df), 'columns': list(df.columns),
+                   'parsed_mb': parsed_mb}, f)
+
+    if read_manifest(path) is None:
+        # incomplete, or written in another format
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another process wrote the same version first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    prefix = path.rsplit('-', 1)[0]
+    for stale in glob.glob(f'{prefix}-*'):
+        if stale != path and not stale.endswith('.tmp'):
+            shutil.rmtree(stale, ignore_errors=True)
+    return path
+
+
+def read_manifest(path):
+    """The manifest of the store at ``path``, None if there is no complete store of this format."""
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    return manifest if manifest.get('format') == FORMAT_VERSION else None
+
+
+def _mapped_categories(path, column):
+    """The categories of ``column`` as an Index over the mapped Arrow file."""
+    reader = pa.ipc.open_file(pa.memory_map(os.path.join(path, f'{column}.categories.arrow')))
+    return pd.Index(pd.arrays.ArrowStringArray(reader.get_batch(0).column(0)))
+
+
+def open_columns(path):
+    """The encoded frame mapped read-only from ``path``, None if it is missing."""
+    manifest = read_manifest(path)
+    if manifest is None:
+        return None
+
+    def load(name):
+        return np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+
+    columns = {'event_date': load('event_date')}
+    for column in CATEGORICAL_COLUMNS:
+        columns[column] = pd.Categorical.from_codes(
+            load(f'{column}.codes'), dtype=pd.CategoricalDtype(_mapped_categories(path, column)),
+            validate=False)
+    product = np.zeros(manifest['rows'], dtype=np.int64)
+    product[load('product.indices')] = load('product.values')
+    columns['product'] = pd.arrays.SparseArray(product, fill_value=0)
+
+    return pd.DataFrame({column: columns[column] for column in manifest['columns']}, copy=False)
+
+
+def main(argv=None):
+    from analytics.encoding import encode_events, memory_mb
+    from analytics.loader import DEFAULT_FILEPATH, dataset_version, read_events
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('filepath', nargs='?', default=DEFAULT_FILEPATH,
+                        help="event CSV to convert")
+    args = parser.parse_args(argv)
+
+    df = read_events(args.filepath)
+    path = write_columns(encode_events(df),
+                         columns_dir(args.filepath, dataset_version(args.filepath)),
+                         parsed_mb=memory_mb(df))
+    print(f"wrote {len(df):,} events to {path}")
+
+
+if __name__ == '__main__':
+    main()
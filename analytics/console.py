@@ -0,0 +1,171 @@
+"""Ad-hoc SQL console over the SQLite copy of the events.
+
+Analysts' queries run against the same database as the SQL tabs (see
+``analytics.sql``), under the same table names, with a few guards so a
+runaway query can't stall the server:
+
+- each query gets its own read-only connection, so it never waits for, or
+  holds, the lock of the shared backend
+- an authorizer only allows reading (``SELECT``, table reads, functions and
+  recursive CTEs), everything else is refused when the query is prepared
+- a progress handler interrupts the query once it runs past its timeout
+- at most ``row_budget`` rows are fetched, the result says if there were more
+
+Queries take named parameters (``:name``) instead of values spliced into
+the text. Results are kept in a bounded, process-wide LRU cache keyed on the
+normalized query text (comments and extra whitespace removed, unquoted text
+lowercased), the parameters, the date range, the row budget and the dataset
+version. Repeated queries, and the same query from another session, return
+without touching SQLite, and a new data version never hits an old result.
+"""
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import pandas as pd
+
+from analytics.sql import TABLE_ALIASES, TABLE_NAME, date_conditions
+
+
+DEFAULT_TIMEOUT_SECONDS = 10
+MAX_TIMEOUT_SECONDS = 60
+DEFAULT_ROW_BUDGET = 10_000
+MAX_ROW_BUDGET = 100_000
+CACHE_SIZE = 32
+
+# SQLite VM instructions between two timeout checks
+PROGRESS_STEPS = 10_000
+
+EXAMPLE_QUERY = """SELECT user, COUNT(*) AS events, COUNT(DISTINCT session) AS sessions
+FROM df
+GROUP BY user
+HAVING COUNT(DISTINCT session) >= :min_sessions
+ORDER BY sessions DESC"""
+EXAMPLE_PARAMS = 'min_sessions=5'
+
+QueryResult = namedtuple('QueryResult', ['frame', 'truncated', 'seconds'])
+
+_READ_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION,
+                 sqlite3.SQLITE_RECURSIVE}
+
+_TOKENS = re.compile(r"""
+    (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])
+  | (?P<comment>--[^\n]*|/\*.*?(?:\*/|$))
+  | (?P<space>\s+)
+  | (?P<other>[^'"`\[\s-]+|-)
+""", re.VERBOSE | re.DOTALL)
+
+_lock = threading.Lock()
+_results = OrderedDict()
+
+
+def normalize_query(sql):
+    """``sql`` without comments, extra whitespace and trailing semicolons.
+
+    Text outside quotes is lowercased, SQLite keywords and unquoted names are
+    case-insensitive.
+    """
+    parts = []
+    for match in _TOKENS.finditer(sql):
+        kind = match.lastgroup
+        if kind in ('comment', 'space'):
+            if parts and parts[-1] != ' ':
+                parts.append(' ')
+        elif kind == 'other':
+            parts.append(match.group().lower())
+        else:
+            parts.append(match.group())
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+def _parse_value(text):
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in '\'"':
+        return text[1:-1]
+    return text
+
+
+def parse_params(text):
+    """Query parameters from ``name=value`` lines, numbers converted."""
+    params = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        name, sep, value = line.partition('=')
+        name = name.strip().lstrip(':')
+        if not sep or not name.isidentifier():
+            raise ValueError(f"Parameters are name=value lines, got: {line}")
+        params[name] = _parse_value(value.strip())
+    return params
+
+
+def _authorize(action, *args):
+    return sqlite3.SQLITE_OK if action in _READ_ACTIONS else sqlite3.SQLITE_DENY
+
+
+def run_query(db_path, sql, params=None, start=None, end=None,
+              timeout=DEFAULT_TIMEOUT_SECONDS, row_budget=DEFAULT_ROW_BUDGET):
+    """Run ``sql`` read-only on the database at ``db_path`` within ``timeout`` seconds.
+
+    Raises ``ValueError`` for queries SQLite rejects (including anything
+    but reads) and ``TimeoutError`` when the query is interrupted.
+    """
+    started = time.perf_counter()
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False)
+    try:
+        if start is not None or end is not None:
+            # temporary views shadow the table names, like SQLiteBackend.query
+            condition = ' AND '.join(date_conditions(start, end))
+            for name in (TABLE_NAME, *TABLE_ALIASES):
+                conn.execute(
+                    f'CREATE TEMP VIEW {name} AS SELECT * FROM main.{TABLE_NAME} WHERE {condition}')
+
+        deadline = started + timeout
+        conn.set_progress_handler(lambda: time.perf_counter() > deadline, PROGRESS_STEPS)
+        conn.set_authorizer(_authorize)
+        try:
+            cursor = conn.execute(sql, params or {})
+            rows = cursor.fetchmany(row_budget + 1)
+        except sqlite3.OperationalError as error:
+            if str(error) == 'interrupted':
+                raise TimeoutError(f"Query stopped after {timeout} s") from None
+            raise ValueError(str(error)) from None
+        except (sqlite3.DatabaseError, sqlite3.ProgrammingError, sqlite3.Warning) as error:
+            raise ValueError(str(error)) from None
+        columns = [column[0] for column in cursor.description or ()]
+    finally:
+        conn.close()
+
+    return QueryResult(pd.DataFrame.from_records(rows[:row_budget], columns=columns),
+                       len(rows) > row_budget, time.perf_counter() - started)
+
+
+def cached_query(db_path, version, sql, params=None, start=None, end=None,
+                 timeout=DEFAULT_TIMEOUT_SECONDS, row_budget=DEFAULT_ROW_BUDGET):
+    """``run_query`` through the result cache, and whether the result was cached.
+
+    The query runs outside the cache lock, so a slow query only holds up its
+    own session.
+    """
+    params = params or {}
+    key = (normalize_query(sql), tuple(sorted(params.items())), str(start), str(end),
+           row_budget, version)
+    with _lock:
+        if key in _results:
+            _results.move_to_end(key)
+            return _results[key], True
+
+    result = run_query(db_path, sql, params, start, end, timeout, row_budget)
+    with _lock:
+        _results[key] = result
+        while len(_results) > CACHE_SIZE:
+            _results.popitem(last=False)
+    return result, False
@@ -0,0 +1,685 @@
+"""Shared computations behind app.py, app_pandas.py and app_sql.py.
+
+The apps ask this module for every number and table they show, so an
+optimisation in the analytics engines reaches all three at once. Results are
+cached per dataset version by ``analytics.loader``. Which engine produces a
+result depends on the ingestion mode (``DASHBOARD_INGESTION``): ``memory``
+loads the events into one shared frame, ``streaming`` folds the CSV in chunks
+under ``DASHBOARD_MEMORY_LIMIT_MB``, and ``incremental`` does the same for the
+CSV and every batch file in ``DASHBOARD_BATCH_DIR``, folding each new batch
+into stored aggregates instead of re-reading the history.
+
+Views limited to a date range (``start`` / ``end`` days, inclusive) read only
+the per-day partitions of that range, written once per dataset version, and
+cache the most recent ranges. Full-history results come from the snapshot of
+``analytics.snapshot`` when one matches the current data.
+
+pandas, numpy and the engines are imported inside the functions. Importing
+this module is cheap, so the apps can draw their page before any of that
+loads.
+"""
+import datetime
+import glob
+import os
+import shutil
+
+
+DEFAULT_FILEPATH = 'data_set_da_test.csv'
+DEFAULT_BATCH_DIR = 'batches'
+
+# rebuilt session tables kept per dataset version, each has a row per session
+SESSION_TABLES = 2
+
+
+def ingestion_mode():
+    return os.environ.get('DASHBOARD_INGESTION', 'memory')
+
+
+def streaming_enabled():
+    """Whether events are folded from the files in chunks, not held in memory."""
+    return ingestion_mode() in ('streaming', 'incremental')
+
+
+def memory_limit_mb():
+    from analytics.streaming import DEFAULT_MEMORY_LIMIT_MB
+
+    return int(os.environ.get('DASHBOARD_MEMORY_LIMIT_MB', DEFAULT_MEMORY_LIMIT_MB))
+
+
+def batch_store(filepath=DEFAULT_FILEPATH):
+    """Incremental store of ``filepath`` and the batches, refreshed with new files."""
+    from analytics.incremental import open_store
+
+    batch_dir = os.environ.get('DASHBOARD_BATCH_DIR', DEFAULT_BATCH_DIR)
+    store = open_store(filepath, memory_limit_mb())
+    store.refresh([filepath, *sorted(glob.glob(os.path.join(batch_dir, '*.csv')))])
+    return store
+
+
+def streamed_aggregates(filepath=DEFAULT_FILEPATH):
+    from analytics.loader import cached
+    from analytics.streaming import stream_aggregates
+
+    if ingestion_mode() == 'incremental':
+        return batch_store(filepath).aggregates()
+
+    limit = memory_limit_mb()
+    return cached(filepath, f'streamed_{limit}',
+                  lambda: stream_aggregates(filepath, limit))
+
+
+def data_version(filepath=DEFAULT_FILEPATH):
+    """Content hash of the data the results are built from.
+
+    The CSV's hash, or in incremental mode a hash of all registered batches.
+    """
+    import hashlib
+
+    from analytics.loader import dataset_version
+
+    if ingestion_mode() != 'incremental':
+        return dataset_version(filepath)
+    digests = '-'.join(batch_store(filepath).version)
+    return hashlib.blake2b(digests.encode(), digest_size=16).hexdigest()
+
+
+def snapshot(filepath=DEFAULT_FILEPATH):
+    """The precomputed results of ``analytics.snapshot`` for the current data, or None."""
+    from analytics.loader import cached_range
+    from analytics.snapshot import read_snapshot, snapshot_path
+
+    version = data_version(filepath)
+    path = snapshot_path(filepath, version)
+    # checked on every call, a nightly job may write it while the app runs
+    if not os.path.exists(path):
+        return None
+    return cached_range(filepath, 'snapshot', version,
+                        lambda: read_snapshot(path, version), maxsize=1)
+
+
+def _versioned_dir(filepath, prefix, version):
+    """``.cache/<prefix>-<version>`` next to the dataset, removing other versions."""
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)), '.cache')
+    path = os.path.join(cache_dir, f'{prefix}-{version}')
+    for stale in glob.glob(os.path.join(cache_dir, f'{prefix}-*')):
+        if stale != path and not stale.endswith('.tmp'):
+            shutil.rmtree(stale, ignore_errors=True)
+    return path
+
+
+def partitions(filepath=DEFAULT_FILEPATH):
+    """Directory of the per-day partitions of the events."""
+    from analytics.loader import cached, dataset_version, iter_events
+    from analytics.partitions import build_partitions
+    from analytics.streaming import chunk_rows
+
+    if ingestion_mode() == 'incremental':
+        return batch_store(filepath).partitions_path
+
+    def build():
+        path = _versioned_dir(filepath, 'partitions', dataset_version(filepath))
+        if os.path.isdir(path):
+            return path
+        # from the CSV, the shared frame is encoded and Parquet has no sparse type
+        return build_partitions(
+            iter_events(filepath, chunk_rows(filepath, memory_limit_mb())), path)
+
+    return cached(filepath, 'partitions', build)
+
+
+def date_bounds(filepath=DEFAULT_FILEPATH):
+    """First and last day with events, as dates."""
+    from analytics.partitions import partition_days
+
+    days = partition_days(partitions(filepath))
+    return datetime.date.fromisoformat(days[0]), datetime.date.fromisoformat(days[-1])
+
+
+def last_days(filepath, days):
+    """Start and end dates of the last ``days`` days with events."""
+    first_day, last_day = date_bounds(filepath)
+    return max(first_day, last_day - datetime.timedelta(days=days - 1)), last_day
+
+
+def _range_key(filepath, start, end):
+    # incremental batches change the data without changing the base file
+    version = batch_store(filepath).version if ingestion_mode() == 'incremental' else None
+    return (str(start), str(end), version)
+
+
+def _range_key_parts(filepath, start, end, column):
+    """The events from ``start`` to ``end``, split by ``column`` into parts that fit the memory limit.
+
+    The parts are written to a temporary directory, removed once they are all read.
+    """
+    import tempfile
+
+    from analytics.parallel import partition_by_user, partition_dirs, read_partition
+    from analytics.partitions import iter_range, range_rows, read_range
+    from analytics.streaming import chunk_rows
+
+    path = partitions(filepath)
+    n_rows = range_rows(path, start, end)
+    if not n_rows:
+        yield read_range(path, start, end)
+        return
+
+    n_parts = -(-n_rows // chunk_rows(filepath, memory_limit_mb()))
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)), '.cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=cache_dir, suffix='.tmp') as tmp:
+        parts = partition_by_user(iter_range(path, start, end), os.path.join(tmp, 'parts'),
+                                  n_parts, column)
+        for part in partition_dirs(parts):
+            yield read_partition(part)
+
+
+def _in_range(filepath, name, start, end, build, merge=None, column='user', variant=None,
+              maxsize=16):
+    """``build(df)`` on the events from ``start`` to ``end``, cached per range and ``variant``.
+
+    The ``maxsize`` most recent ranges and variants are kept. In the
+    streaming modes the range isn't loaded at once: its events are split by
+    ``column`` into parts that fit the memory limit, each holding whole keys,
+    and ``merge`` combines the results of the parts.
+    """
+    from analytics.loader import cached_range
+    from analytics.partitions import read_range
+
+    key = (variant, *_range_key(filepath, start, end))
+    if streaming_enabled():
+        return cached_range(filepath, name, key, lambda: merge(
+            [build(df) for df in _range_key_parts(filepath, start, end, column)]), maxsize)
+
+    range_events = cached_range(
+        filepath, 'range_events', key[1:],
+        lambda: read_range(partitions(filepath), start, end), maxsize=2)
+    return cached_range(filepath, name, key, lambda: build(range_events), maxsize)
+
+
+def _streamed_range(filepath, start, end):
+    """Streaming aggregates of the events from ``start`` to ``end``, folded part by part."""
+    from analytics.loader import cached_range
+    from analytics.partitions import iter_range, read_range
+    from analytics.streaming import EventFold
+
+    def build():
+        fold = EventFold()
+        path = partitions(filepath)
+        for chunk in iter_range(path, start, end):
+            fold.add(chunk)
+        if not fold.n_events:
+            fold.add(read_range(path, start, end))
+        return fold.aggregates()
+
+    return cached_range(filepath, 'streamed_range', _range_key(filepath, start, end), build,
+                        maxsize=2)
+
+
+def workers():
+    return int(os.environ.get('DASHBOARD_WORKERS', 1))
+
+
+def parallel_enabled():
+    """Whether the aggregates are computed on a pool of ``DASHBOARD_WORKERS`` processes."""
+    return workers() > 1 and ingestion_mode() == 'memory'
+
+
+def pooled_aggregates(filepath=DEFAULT_FILEPATH):
+    """Funnel cube, first page types, SQL 1 counts and user summary, per user partition.
+
+    None when the parallel mode is off or can't be used for this dataset.
+    """
+    from analytics.loader import cached, dataset_version, iter_events
+    from analytics.parallel import parallel_aggregates, partition_by_user
+    from analytics.streaming import chunk_rows
+
+    if not parallel_enabled():
+        return None
+    n_workers = workers()
+
+    def build():
+        path = _versioned_dir(filepath, 'users', f'{dataset_version(filepath)}-{n_workers}')
+        if not os.path.isdir(path):
+            partition_by_user(iter_events(filepath, chunk_rows(filepath, memory_limit_mb())),
+                              path, n_workers)
+        return parallel_aggregates(path, n_workers)
+
+    return cached(filepath, f'parallel_{n_workers}', build)
+
+
+def events(filepath=DEFAULT_FILEPATH):
+    from analytics.loader import load_events
+
+    return load_events(filepath)
+
+
+def memory_report(filepath=DEFAULT_FILEPATH):
+    """Size of the shared frame as parsed and as encoded, in MB.
+
+    None until the events are loaded, and in the modes that don't load them.
+    """
+    from analytics.loader import peek
+
+    return peek(filepath, 'memory_report')
+
+
+def first_touch(filepath, scope):
+    from analytics.first_touch import first_touch_index
+    from analytics.loader import cached_result
+
+    return cached_result(filepath, f'first_touch_{scope}',
+                         lambda df: first_touch_index(df, scope))
+
+
+def funnel_cube(filepath=DEFAULT_FILEPATH):
+    from analytics.funnel import build_funnel_cube
+    from analytics.loader import cached_result
+
+    snap = snapshot(filepath)
+    if snap is not None:
+        return snap['funnel_cube']
+    if streaming_enabled():
+        return streamed_aggregates(filepath).funnel_cube
+    pooled = pooled_aggregates(filepath)
+    if pooled is not None:
+        return pooled.funnel_cube
+    return cached_result(filepath, 'funnel_cube', build_funnel_cube)
+
+
+def trend_cube(filepath=DEFAULT_FILEPATH):
+    """Funnel counts of the keys active per scope, day or hour and first page type.
+
+    See ``analytics.trends``. In streaming mode each scope is counted over
+    partitions hashed by its own column, as in ``olap_cube``; in incremental
+    mode the batch store folds the day and hour cells batch by batch.
+    """
+    from analytics.funnel import SCOPES
+    from analytics.loader import cached_range, cached_result
+    from analytics.parallel import partition_dirs, read_partition
+    from analytics.trends import (build_trend_cube, merge_trend_cubes, scope_trend_tables,
+                                  trend_cube_from_tables)
+
+    snap = snapshot(filepath)
+    if snap is not None:
+        return snap['trend_cube']
+    if ingestion_mode() == 'incremental':
+        return batch_store(filepath).trend_cube()
+    if streaming_enabled():
+        def build():
+            return merge_trend_cubes(
+                [trend_cube_from_tables({scope: scope_trend_tables(read_partition(part), scope)})
+                 for scope in SCOPES
+                 for part in partition_dirs(_key_partitions(filepath, scope))])
+
+        return cached_range(filepath, 'trend_cube', data_version(filepath), build, maxsize=1)
+    pooled = pooled_aggregates(filepath)
+    if pooled is not None:
+        return pooled.trend_cube
+    return cached_result(filepath, 'trend_cube', build_trend_cube)
+
+
+def funnel_trend(filepath, page_type, scope, freq='D', start=None, end=None):
+    """Daily (``freq='D'``) or hourly (``'h'``) funnel counts and rates, sliced from the trend cube."""
+    from analytics.profiling import stage
+    from analytics.trends import trend_metrics
+
+    cube = trend_cube(filepath)
+    with stage('trend_metrics') as s:
+        return s.rows(trend_metrics(cube, page_type, scope, freq, start, end))
+
+
+def olap_cube(filepath=DEFAULT_FILEPATH):
+    """Per scope, day and key: first page type and funnel event types, see ``analytics.olap``.
+
+    In streaming mode each scope is built from partitions hashed by its own
+    column, so every key is whole in one partition. In incremental mode the
+    batch store folds each new batch into the cells as it is registered.
+    """
+    from analytics.funnel import SCOPES
+    from analytics.loader import cached_range, cached_result
+    from analytics.olap import build_olap_cube, build_scope_cells, merge_scope_cells
+    from analytics.parallel import partition_dirs, read_partition
+
+    if not streaming_enabled():
+        return cached_result(filepath, 'olap_cube', build_olap_cube)
+    if ingestion_mode() == 'incremental':
+        return batch_store(filepath).olap_cube()
+
+    def build():
+        return {scope: merge_scope_cells(
+                    [build_scope_cells(read_partition(part), scope)
+                     for part in partition_dirs(_key_partitions(filepath, scope))])
+                for scope in SCOPES}
+
+    return cached_range(filepath, 'olap_cube', data_version(filepath), build, maxsize=1)
+
+
+def funnel(filepath, page_type, scope, start=None, end=None):
+    """Funnel metrics for a page type and scope, from ``start`` to ``end``."""
+    from analytics.funnel import funnel_metrics
+    from analytics.loader import cached_range
+    from analytics.olap import rollup_funnel_cube
+
+    if start is None and end is None:
+        cube = funnel_cube(filepath)
+    else:
+        # rolled up once per range, then every page type and scope is a lookup
+        cells = olap_cube(filepath)
+        cube = cached_range(filepath, 'funnel_cube_range',
+                            (str(start), str(end), data_version(filepath)),
+                            lambda: rollup_funnel_cube(cells, start, end))
+    return funnel_metrics(cube, page_type, scope)
+
+
+def funnel_rates(metrics):
+    """Conversion, add to cart and cart abandonment rates, in percent."""
+    interested = metrics['interested_sessions']
+    add_to_cart = metrics['add_to_cart_sessions']
+    purchase = metrics['purchase_sessions']
+
+    session_cr = round(purchase/interested*100, 2)
+    add_to_cart_rate = round(add_to_cart/interested*100, 2)
+    cart_abandonment_rate = round((add_to_cart-purchase)/add_to_cart*100, 2)
+    return session_cr, add_to_cart_rate, cart_abandonment_rate
+
+
+def funnel_shares(metrics):
+    """Interested, add to cart and purchase counts in percent of all sessions/users."""
+    sessions = metrics['sessions']
+    return tuple(round(metrics[stage] / sessions * 100, 2)
+                 for stage in ('interested_sessions', 'add_to_cart_sessions', 'purchase_sessions'))
+
+
+def top_products(filepath, scope, k=50, start=None, end=None):
+    """Top ``k`` products by distinct add to cart sessions/users."""
+    from analytics.first_touch import first_touch_index
+    from analytics.loader import cached_result
+    from analytics.products import top_added_to_cart
+
+    if start is not None or end is not None:
+        if streaming_enabled():
+            return _streamed_range(filepath, start, end).top_products[scope].head(k)
+        return _in_range(filepath, f'top_products_{scope}_{k}_range', start, end,
+                         lambda df: top_added_to_cart(df, first_touch_index(df, scope), scope, k=k))
+
+    snap = snapshot(filepath)
+    if snap is not None and k <= len(snap['top_products'][scope]):
+        return snap['top_products'][scope].head(k)
+    if streaming_enabled():
+        return streamed_aggregates(filepath).top_products[scope].head(k)
+
+    index = first_touch(filepath, scope)
+    return cached_result(filepath, f'top_products_{scope}_{k}',
+                         lambda df: top_added_to_cart(df, index, scope, k=k))
+
+
+def sql_db(filepath=DEFAULT_FILEPATH):
+    """Persistent, indexed SQLite copy of the events for the SQL tabs."""
+    from analytics.sql import sql_backend
+
+    if ingestion_mode() == 'incremental':
+        return batch_store(filepath).sql_backend()
+    if streaming_enabled():
+        return sql_backend(filepath, chunksize=streamed_aggregates(filepath).chunksize)
+    return sql_backend(filepath)
+
+
+def sql_query(filepath, query, start=None, end=None):
+    """Result of ``query`` on the SQLite events, from the snapshot when it holds it."""
+    snap = snapshot(filepath) if start is None and end is None else None
+    if snap is not None and query in snap['queries']:
+        return snap['queries'][query]
+    return sql_db(filepath).query(query, start=start, end=end)
+
+
+def console_query(filepath, query, params=None, start=None, end=None, timeout=None,
+                  row_budget=None):
+    """Ad-hoc ``query`` on the SQLite events and whether it came from the result cache.
+
+    See ``analytics.console`` for the guards and the cache key.
+    """
+    from analytics.console import DEFAULT_ROW_BUDGET, DEFAULT_TIMEOUT_SECONDS, cached_query
+    from analytics.profiling import stage
+
+    db_path = sql_db(filepath).db_path
+    version = data_version(filepath)
+    with stage('sql_console') as s:
+        result, from_cache = cached_query(db_path, version, query, params, start, end,
+                                          timeout or DEFAULT_TIMEOUT_SECONDS,
+                                          row_budget or DEFAULT_ROW_BUDGET)
+        s.rows(result.frame)
+        return result, from_cache
+
+
+def native_engine_available():
+    """Whether the apps offer the columnar SQL 1 engine next to SQLite.
+
+    In the streaming modes ``non_returning_users`` reads the user partitions
+    from disk, so the apps stay on the indexed SQLite copy there.
+    """
+    return not streaming_enabled()
+
+
+def non_returning_users(filepath=DEFAULT_FILEPATH, start=None, end=None):
+    """SQL 1 counts per day from the columnar engine, see ``analytics.first_session``.
+
+    In the streaming modes each user partition is counted on its own and the
+    counts add up.
+    """
+    from analytics.first_session import merge_non_returning_users, non_returning_users_per_day
+    from analytics.loader import cached_range, cached_result
+    from analytics.parallel import partition_dirs, read_partition
+
+    if start is not None or end is not None:
+        return _in_range(filepath, 'non_returning_users_range', start, end,
+                         non_returning_users_per_day, merge_non_returning_users)
+    snap = snapshot(filepath)
+    if snap is not None:
+        return snap['non_returning_users']
+    pooled = pooled_aggregates(filepath)
+    if pooled is not None:
+        return pooled.non_returning_users
+    if not streaming_enabled():
+        return cached_result(filepath, 'non_returning_users', non_returning_users_per_day)
+
+    def build():
+        return merge_non_returning_users(
+            [non_returning_users_per_day(read_partition(part))
+             for part in partition_dirs(_key_partitions(filepath, 'user'))])
+
+    return cached_range(filepath, 'non_returning_users', data_version(filepath), build,
+                        maxsize=1)
+
+
+def user_summary(filepath=DEFAULT_FILEPATH, start=None, end=None):
+    from analytics.loader import cached_result
+    from analytics.user_summary import build_user_summary
+
+    if start is not None or end is not None:
+        if streaming_enabled():
+            return _streamed_range(filepath, start, end).user_summary
+        return _in_range(filepath, 'user_summary_range', start, end, build_user_summary)
+    snap = snapshot(filepath)
+    if snap is not None:
+        return snap['user_summary']
+    if streaming_enabled():
+        return streamed_aggregates(filepath).user_summary
+    pooled = pooled_aggregates(filepath)
+    if pooled is not None:
+        return pooled.user_summary
+    return cached_result(filepath, 'user_summary', build_user_summary)
+
+
+def _key_partitions(filepath, column):
+    """Partitions of the events hashed by ``column``, each small enough for the memory limit.
+
+    In incremental mode the batch store keeps them, with each batch appended
+    as it is registered.
+    """
+    from analytics.loader import iter_events
+    from analytics.parallel import partition_by_user
+    from analytics.streaming import chunk_rows, estimated_rows
+
+    if ingestion_mode() == 'incremental':
+        return batch_store(filepath).key_partitions(column)
+
+    path = _versioned_dir(filepath, f'by_{column}', data_version(filepath))
+    if not os.path.isdir(path):
+        rows = chunk_rows(filepath, memory_limit_mb())
+        n_parts = max(1, -(-estimated_rows(filepath) // rows))
+        partition_by_user(iter_events(filepath, rows), path, n_parts, column)
+    return path
+
+
+def sessions(filepath=DEFAULT_FILEPATH, gap_minutes=None, start=None, end=None):
+    """Sessions rebuilt from ``user`` and ``event_date``, see ``analytics.sessions``.
+
+    Only the ``SESSION_TABLES`` most recent gaps are kept, of the full history
+    and of date ranges each, so moving the gap slider doesn't pile up a
+    table per position. In the streaming modes the events are first split by
+    user into parts that fit the memory limit, and each part is sessionized
+    on its own.
+    """
+    from analytics.loader import cached_range, load_events
+    from analytics.parallel import partition_dirs, read_partition
+    from analytics.sessions import (DEFAULT_GAP_MINUTES, merge_sessions, sessionize,
+                                   sessionize_partitions)
+
+    gap_minutes = gap_minutes or DEFAULT_GAP_MINUTES
+    if start is not None or end is not None:
+        return _in_range(filepath, 'sessions_range', start, end,
+                         lambda df: sessionize(df, gap_minutes), merge_sessions,
+                         variant=gap_minutes, maxsize=SESSION_TABLES)
+
+    def build():
+        if not streaming_enabled():
+            return sessionize(load_events(filepath), gap_minutes)
+        return sessionize_partitions(
+            (read_partition(part) for part in partition_dirs(_key_partitions(filepath, 'user'))),
+            gap_minutes)
+
+    return cached_range(filepath, 'sessions', (gap_minutes, data_version(filepath)), build,
+                        maxsize=SESSION_TABLES)
+
+
+def page_paths(filepath, scope, start=None, end=None):
+    """Page type transitions and sequences of each session or user, see ``analytics.paths``.
+
+    In the streaming modes the events are split by the scope column, so each
+    part holds whole sessions or users and the parts' counts add up.
+    """
+    from analytics.loader import cached_range, cached_result
+    from analytics.parallel import partition_dirs, read_partition
+    from analytics.paths import build_page_paths, merge_page_paths
+    from analytics.profiling import stage
+
+    with stage('page_paths'):
+        if start is not None or end is not None:
+            return _in_range(filepath, f'page_paths_{scope}_range', start, end,
+                             lambda df: build_page_paths(df, scope), merge_page_paths, scope)
+        snap = snapshot(filepath)
+        if snap is not None:
+            return snap['page_paths'][scope]
+        if not streaming_enabled():
+            return cached_result(filepath, f'page_paths_{scope}',
+                                 lambda df: build_page_paths(df, scope))
+
+        def build():
+            return merge_page_paths(
+                [build_page_paths(read_partition(part), scope)
+                 for part in partition_dirs(_key_partitions(filepath, scope))])
+
+        return cached_range(filepath, f'page_paths_{scope}', data_version(filepath), build,
+                            maxsize=1)
+
+
+def cohort_cube(filepath=DEFAULT_FILEPATH, start=None, end=None):
+    """Cohort sizes and return / purchase counts per period, see ``analytics.cohorts``.
+
+    In the streaming modes each user partition is counted on its own and the
+    cubes add up.
+    """
+    from analytics.cohorts import build_cohort_cube, merge_cohort_cubes
+    from analytics.loader import cached_range, cached_result
+    from analytics.parallel import partition_dirs, read_partition
+
+    if start is not None or end is not None:
+        return _in_range(filepath, 'cohort_cube_range', start, end, build_cohort_cube,
+                         merge_cohort_cubes)
+    snap = snapshot(filepath)
+    if snap is not None:
+        return snap['cohort_cube']
+    if not streaming_enabled():
+        return cached_result(filepath, 'cohort_cube', build_cohort_cube)
+
+    def build():
+        return merge_cohort_cubes(
+            [build_cohort_cube(read_partition(part))
+             for part in partition_dirs(_key_partitions(filepath, 'user'))])
+
+    return cached_range(filepath, 'cohort_cube', data_version(filepath), build, maxsize=1)
+
+
+def retention(filepath, scope, granularity='Daily', metric='returned', start=None, end=None):
+    """Cohort x period return or purchase rates, sliced from the cohort cube."""
+    from analytics.cohorts import retention_matrix
+    from analytics.profiling import stage
+
+    cube = cohort_cube(filepath, start, end)
+    with stage('retention_matrix') as s:
+        return s.rows(retention_matrix(cube, scope, granularity, metric))
+
+
+def user_session_summary(filepath=DEFAULT_FILEPATH, gap_minutes=None, start=None, end=None):
+    """The SQL 2 user summary with the rebuilt session metrics of each user."""
+    from analytics.loader import cached_range
+    from analytics.sessions import DEFAULT_GAP_MINUTES, user_session_stats
+
+    gap_minutes = gap_minutes or DEFAULT_GAP_MINUTES
+
+    def build():
+        stats = user_session_stats(sessions(filepath, gap_minutes, start, end))
+        return user_summary(filepath, start, end).merge(stats, on='user', how='left')
+
+    key = (gap_minutes, str(start), str(end), data_version(filepath))
+    return cached_range(filepath, 'user_session_summary', key, build, maxsize=4)
+
+
+def _metric_summary(filepath, metric, gap_minutes, start, end):
+    """The user summary, with the rebuilt session metrics unless ``metric`` is the session count."""
+    if metric == 'total_sessions':
+        return user_summary(filepath, start, end)
+    return user_session_summary(filepath, gap_minutes, start, end)
+
+
+def abnormal_users(filepath, mode='average', multiplier=3.0, start=None, end=None,
+                   metric='total_sessions', gap_minutes=None):
+    """SQL 2 output: the cached user summary flagged for the given threshold.
+
+    Metrics other than ``total_sessions`` come from the rebuilt sessions,
+    with an inactivity gap of ``gap_minutes``.
+    """
+    from analytics.profiling import stage
+    from analytics.user_summary import flag_abnormal
+
+    summary = _metric_summary(filepath, metric, gap_minutes, start, end)
+    with stage('flag_abnormal') as s:
+        return s.rows(flag_abnormal(summary, mode, multiplier, metric))
+
+
+def abnormal_users_page(filepath, mode='average', multiplier=3.0, start=None, end=None,
+                        metric='total_sessions', gap_minutes=None, **page):
+    """One page of the SQL 2 output and the number of abnormal users.
+
+    ``page`` holds the filters, sort and page of ``user_summary.abnormal_page``,
+    applied to the cached summary so only the page's rows are built.
+    """
+    from analytics.profiling import stage
+    from analytics.user_summary import abnormal_page
+
+    summary = _metric_summary(filepath, metric, gap_minutes, start, end)
+    with stage('abnormal_page') as s:
+        result, n_abnormal = abnormal_page(summary, mode, multiplier, metric, **page)
+        s.rows(result.rows)
+        return result, n_abnormal
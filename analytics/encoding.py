@@ -0,0 +1,96 @@
+"""Compact, dictionary-encoded representation of the event table.
+
+As parsed from the CSV, every ``session``, ``user``, ``page_type`` and
+``event_type`` value is a separate Python string, and ``product`` is a dense
+int64 column that is zero except on add to cart events. ``encode_events``
+stores the four string columns as categoricals (each distinct value once,
+plus an int8/int16/int32 code per row) and ``product`` as a sparse column
+with a fill value of 0. That cuts the frame several-fold.
+
+The engines read the codes directly through ``column_codes`` and
+``value_mask``, so grouping by session or user and filtering on page or
+event type never converts a column back to strings. Both helpers also accept
+plain object columns, which is what streamed chunks and date-range reads
+hold.
+"""
+import numpy as np
+import pandas as pd
+
+
+CATEGORICAL_COLUMNS = ('session', 'user', 'page_type', 'event_type')
+
+
+def encode_events(df):
+    """Encoded copy of a parsed event frame."""
+    encoded = pd.DataFrame({'event_date': df['event_date']})
+    for column in CATEGORICAL_COLUMNS:
+        # categories in order of first appearance: unlike astype('category')
+        # this doesn't sort the strings, which is most of the cost
+        codes, categories = pd.factorize(df[column])
+        encoded[column] = pd.Categorical.from_codes(codes, categories=categories)
+    encoded['product'] = pd.arrays.SparseArray(df['product'].to_numpy(), fill_value=0)
+    return encoded[list(df.columns)]
+
+
+def _is_categorical(column):
+    return isinstance(column.dtype, pd.CategoricalDtype)
+
+
+def memory_mb(df):
+    """In-memory size of a frame in MB, strings included."""
+    total = df.index.memory_usage()
+    for name in df.columns:
+        column = df[name]
+        categories = column.cat.categories if _is_categorical(column) else None
+        if categories is not None and categories.dtype != object:
+            # Arrow strings know their size; a deep memory_usage would build the
+            # categories' hash table, a Python string per value
+            total += column.cat.codes.nbytes + categories.array.nbytes
+        else:
+            total += column.memory_usage(deep=True, index=False)
+    return total / 2**20
+
+
+def column_codes(column, sort=False):
+    """``pd.factorize`` of a column, taken from its codes when it is categorical.
+
+    The result is the same as ``pd.factorize``: only the values present are
+    returned, in order of first appearance unless ``sort``, so a filtered
+    categorical column doesn't report keys without events.
+    """
+    if not _is_categorical(column):
+        return pd.factorize(column, sort=sort)
+
+    codes = column.cat.codes.to_numpy()
+    categories = column.cat.categories
+    # present categories in order of first appearance, hashing the small int codes
+    order = pd.unique(codes[codes >= 0]).astype(np.int64)
+    present = categories.take(order)
+    if sort:
+        # categories are unique, so the sort needs no tie-break
+        by_value = present.argsort()
+        order, present = order[by_value], present.take(by_value)
+
+    # renumber the present categories 0..n-1, missing values stay -1
+    remap = np.full(len(categories) + 1, -1, dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    new_codes = remap[codes].astype(np.int64)
+    return new_codes, present
+
+
+def value_mask(column, value):
+    """Boolean array of the rows equal to ``value``."""
+    if not _is_categorical(column):
+        return column.to_numpy() == value
+
+    position = column.cat.categories.get_indexer([value])[0]
+    if position < 0:
+        return np.zeros(len(column), dtype=bool)
+    return column.cat.codes.to_numpy() == position
+
+
+def values_at(column, mask):
+    """Dense values of the rows selected by ``mask``, without densifying the column."""
+    if isinstance(column.dtype, pd.SparseDtype):
+        return np.asarray(column.array[mask])
+    return column.to_numpy()[mask]
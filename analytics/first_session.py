@@ -0,0 +1,77 @@
+"""Columnar engine for the SQL 1 query (non-returning users per day).
+
+The SQL version finds each user's first session (``MIN(session)``) and uses
+two self-joins to keep users whose product page views all happened in that
+session. Here the same answer comes from grouped array operations:
+
+1. sessions are factorized in sorted order, so the grouped minimum of the
+   session codes per user is the lexicographic ``MIN(session)``
+2. every event gets an "in first session" flag by comparing its session code
+   with its user's first session code
+3. users with any product page view outside their first session are flagged
+   with a scatter, and the remaining first-session product views are counted
+   per day and distinct user
+"""
+import numpy as np
+import pandas as pd
+
+from analytics.encoding import column_codes, value_mask
+
+
+RESULT_COLUMNS = ['date', 'non_returning_users']
+
+
+def first_session_flags(df):
+    """Per-event user codes, users, and whether the event is in the user's first session."""
+    user_codes, users = column_codes(df['user'])
+    session_codes, _ = column_codes(df['session'], sort=True)
+
+    first_session = pd.Series(session_codes).groupby(user_codes).min().to_numpy()
+    in_first = session_codes == first_session[user_codes]
+    return user_codes, users, in_first
+
+
+def first_seen(df):
+    """Per-event user and session codes, and each user's first event time and session.
+
+    Unlike ``MIN(session)`` in SQL 1, the first session here is the one of the
+    user's earliest event (ties keep file order). The per-user arrays are
+    indexed by user code.
+    """
+    user_codes, users = column_codes(df['user'])
+    session_codes, _ = column_codes(df['session'])
+    ts = df['event_date'].to_numpy().view('int64')
+
+    order = np.lexsort((ts, user_codes))
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = user_codes[order][1:] != user_codes[order][:-1]
+    firsts = order[starts]
+    return user_codes, users, session_codes, ts[firsts], session_codes[firsts]
+
+
+def non_returning_users_per_day(df):
+    user_codes, users, in_first = first_session_flags(df)
+    n_users = len(users)
+    product_view = value_mask(df['page_type'], 'product_page')
+
+    returned = np.zeros(n_users, dtype=bool)
+    returned[user_codes[product_view & ~in_first]] = True
+
+    selected = product_view & in_first & ~returned[user_codes]
+    days = df['event_date'].to_numpy()[selected].astype('datetime64[D]').view('int64')
+
+    # distinct (day, user) pairs, then users per day
+    day_user = np.unique(days * n_users + user_codes[selected])
+    day, counts = np.unique(day_user // n_users, return_counts=True)
+
+    return pd.DataFrame({
+        'date': np.datetime_as_string(day.astype('datetime64[D]')),
+        'non_returning_users': counts.astype('int64'),
+    }, columns=RESULT_COLUMNS)
+
+
+def merge_non_returning_users(results):
+    """Add up ``non_returning_users_per_day`` of user-disjoint parts of the events."""
+    daily = pd.concat(results, ignore_index=True)
+    return (daily.groupby('date', as_index=False, sort=True)['non_returning_users'].sum()
+            [RESULT_COLUMNS])
@@ -0,0 +1,60 @@
+"""First-touch index: the page type each session or user started on.
+
+Instead of sorting the whole frame by ``[scope, 'event_date']`` and merging a
+``groupby().first()`` back onto it, the index keeps three compact arrays:
+
+- ``codes``: per event, the position of its scope key in ``keys``
+- ``first_page``: per key, the code of its earliest page type
+- ``page_types``: the page type labels those codes refer to
+
+Filtering events by first page type is then ``first_page[codes] == code``,
+without materialising a widened copy of the event table. The earliest event
+of a key is found with a grouped minimum; ties on ``event_date`` go to the
+event that comes first in the file, as the stable sort did before.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from analytics.encoding import column_codes
+
+
+FirstTouch = namedtuple('FirstTouch', ['keys', 'codes', 'first_page', 'page_types'])
+
+
+def _smallest_code(n):
+    return np.int32 if n < np.iinfo(np.int32).max else np.int64
+
+
+def earliest_rows(codes, n_keys, ts):
+    """Row of the earliest event per key code, and that event's timestamp."""
+    first_ts = pd.Series(ts).groupby(codes).min().to_numpy()
+
+    # among the events at a key's earliest timestamp keep the first row:
+    # assigning in reverse row order leaves the lowest row index per key
+    rows = np.flatnonzero(ts == first_ts[codes])[::-1]
+    first_row = np.empty(n_keys, dtype=np.int64)
+    first_row[codes[rows]] = rows
+    return first_row, first_ts
+
+
+def first_touch_index(df, scope):
+    codes, keys = column_codes(df[scope])
+    page_codes, page_types = column_codes(df['page_type'])
+
+    ts = df['event_date'].to_numpy().view('int64')
+    first_row, _ = earliest_rows(codes, len(keys), ts)
+
+    return FirstTouch(
+        keys=keys,
+        codes=codes.astype(_smallest_code(len(keys))),
+        first_page=page_codes[first_row].astype(np.int8),
+        page_types=page_types,
+    )
+
+
+def first_page_types(index):
+    """Per-key first page type labels as a Series indexed by key."""
+    return pd.Series(index.page_types[index.first_page], index=index.keys,
+                     name='page_type_first')
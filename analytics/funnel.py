@@ -0,0 +1,105 @@
+"""Funnel counts for every first page type and scope, built in one pass.
+
+For each scope key (a session or a user) the events are reduced to four
+per-key facts: its first page type (from the first-touch index), whether it reached an interested page,
+whether it added to cart and whether it ordered. Counting those facts per
+first page type gives a small table (the funnel cube) from which every
+combination of the "Filter Funnel" and scope radios is a row lookup.
+"""
+import numpy as np
+import pandas as pd
+
+from analytics.encoding import value_mask
+from analytics.first_touch import first_touch_index
+
+
+SCOPES = ('session', 'user')
+
+PAGE_TYPES = {
+    'Search Listing Page': 'search_listing_page',
+    'Listing Page': 'listing_page',
+    'Product Page': 'product_page',
+}
+
+FUNNEL_STAGES = ['sessions', 'interested_sessions',
+                 'add_to_cart_sessions', 'purchase_sessions']
+
+OVERALL = 'overall'
+
+
+def _any_per_key(codes, n_keys, mask):
+    flags = np.zeros(n_keys, dtype=bool)
+    flags[codes[mask]] = True
+    return flags
+
+
+def funnel_table(first_page, page_types, interested, add_to_cart, purchase):
+    """Funnel rows per first page type from per-key codes and flags."""
+    n_pages = len(page_types)
+
+    # per first page type, purchases only count keys that also added to cart
+    by_first = pd.DataFrame({
+        'interested_sessions': np.bincount(first_page, minlength=n_pages),
+        'add_to_cart_sessions': np.bincount(
+            first_page, weights=add_to_cart, minlength=n_pages),
+        'purchase_sessions': np.bincount(
+            first_page, weights=add_to_cart & purchase, minlength=n_pages),
+    }, index=pd.Index(page_types, name='page_type_first'))
+    by_first = by_first[by_first['interested_sessions'] > 0]
+
+    by_first.loc[OVERALL] = [interested.sum(), add_to_cart.sum(), purchase.sum()]
+    by_first.insert(0, 'sessions', len(first_page))
+    return by_first.astype('int64')
+
+
+def key_flags(df, first_touch):
+    """Per-key interested / add to cart / purchase flags of a first-touch index."""
+    codes = first_touch.codes
+    n_keys = len(first_touch.keys)
+    return {
+        'interested': _any_per_key(codes, n_keys, ~value_mask(df['page_type'], 'order_page')),
+        'add_to_cart': _any_per_key(codes, n_keys, value_mask(df['event_type'], 'add_to_cart')),
+        'purchase': _any_per_key(codes, n_keys, value_mask(df['event_type'], 'order')),
+    }
+
+
+def scope_funnel(df, scope, first_touch=None):
+    if first_touch is None:
+        first_touch = first_touch_index(df, scope)
+    return funnel_table(first_touch.first_page, first_touch.page_types,
+                        **key_flags(df, first_touch))
+
+
+def funnel_cube_from_tables(tables):
+    """Stack per-scope funnel tables into the ``(scope, page_type_first)`` cube."""
+    cube = pd.concat(tables, names=['scope', 'page_type_first'])
+    return cube[FUNNEL_STAGES]
+
+
+def build_funnel_cube(df):
+    """Funnel counts indexed by ``(scope, page_type_first)``.
+
+    The ``overall`` row of each scope holds the unfiltered funnel.
+    """
+    return funnel_cube_from_tables(
+        {scope: scope_funnel(df, scope) for scope in SCOPES})
+
+
+def funnel_metrics(cube, page_type, scope):
+    """Look up the funnel for a "Filter Funnel" radio value and scope."""
+    if page_type is None:
+        key = OVERALL
+    elif page_type in PAGE_TYPES:
+        key = PAGE_TYPES[page_type]
+    else:
+        raise ValueError(f"Unknown page type: {page_type}")
+
+    scope_cube = cube.loc[scope]
+    if key in scope_cube.index:
+        return scope_cube.loc[key].copy()
+
+    # no key started on this page type
+    return pd.Series({'sessions': scope_cube.loc[OVERALL, 'sessions'],
+                      'interested_sessions': 0,
+                      'add_to_cart_sessions': 0,
+                      'purchase_sessions': 0})
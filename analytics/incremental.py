@@ -0,0 +1,373 @@
+"""Incremental ingestion of event batches.
+
+Event files arrive one batch at a time, e.g. a daily export. Instead of
+re-reading the whole history on every change, each new batch is read once in
+chunks and folded into the stored per-key state of ``analytics.streaming``
+(first event and page type, funnel flags and event counts per session and
+user, distinct add to cart rows) and into the day and hour funnel cells of
+``analytics.olap``, and appended to an indexed SQLite copy of the events for
+the SQL tabs, to per-day partitions for date-range views (see
+``analytics.partitions``) and to partitions hashed by session and by user for
+the views that need every event of a key. Sessions and users that continue in
+a later batch are merged into their existing state, and batches are treated
+as if they were concatenated in registration order. Refreshing after a new
+batch costs one pass over that batch plus work proportional to the number of
+distinct sessions and users, never a re-read of earlier batch files.
+
+Batches are append-only. A registered file whose content changes invalidates
+the history, and the store is rebuilt from all batch files.
+
+The store lives in ``<dataset dir>/.cache/incremental/``:
+
+- ``events.sqlite``: the event table, plus a ``batches`` table recording the
+  rowid each batch starts after. A batch interrupted half-way is rolled back
+  from that rowid when the store is opened again.
+- ``partitions/``: the day partitions, with part files named after the batch
+  sequence number so an interrupted batch's parts can be removed.
+- ``by_session/`` and ``by_user/``: the key partitions, with part files named
+  the same way. When the history outgrows them, each partition is split
+  into several (see ``analytics.parallel.split_partitions``). The number of
+  partitions at least doubles on a split, so a row is rewritten about once
+  per doubling of the history rather than once per batch.
+- ``state/batch-<seq>.pickle``: one file per batch with its record and what
+  it added to the folded state and cells (the per-chunk facts of its keys and
+  days), written after the batch is committed to SQLite. Earlier files are
+  never rewritten. Opening the store folds them again in order, and if they
+  fall behind the database, the missing batches are folded again from their
+  files.
+"""
+import glob
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from analytics.funnel import SCOPES
+from analytics.loader import file_digest, iter_events
+from analytics.olap import CellFold
+from analytics.parallel import (append_partition_part, partition_by_user, partition_dirs,
+                                split_partitions)
+from analytics.partitions import write_parts
+from analytics.profiling import stage
+from analytics.sql import TABLE_NAME, SQLiteBackend, append_events, create_indexes
+from analytics.streaming import DEFAULT_MEMORY_LIMIT_MB, EventFold, chunk_rows, estimated_rows
+from analytics.trends import WIDTHS, trend_cube_from_tables, trend_table
+
+
+# bumped when the pickled state changes, an older store is rebuilt from its files
+STATE_FORMAT = 4
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def store_dir(filepath):
+    return os.path.join(os.path.dirname(os.path.abspath(filepath)), '.cache', 'incremental')
+
+
+class BatchStore:
+    """Folded aggregates and SQLite events of every registered batch."""
+
+    def __init__(self, path, memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB):
+        self.path = path
+        self.memory_limit_mb = memory_limit_mb
+        self.state_path = os.path.join(path, 'state')
+        self.db_path = os.path.join(path, 'events.sqlite')
+        self.partitions_path = os.path.join(path, 'partitions')
+        self._lock = threading.RLock()
+        self._signatures = {}
+        self._aggregates = None
+        self._cube = None
+        self._trends = None
+        self._backend = None
+        self._open()
+
+    def _open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.batches, self.fold, self.cells = [], EventFold(), self._new_cells()
+        if os.path.exists(os.path.join(self.path, 'state.pickle')):
+            # a store of the format that pickled the whole state
+            self.reset()
+            return
+        for state_path in sorted(glob.glob(os.path.join(self.state_path, 'batch-*.pickle'))):
+            with open(state_path, 'rb') as f:
+                state_format, batch, facts = pickle.load(f)
+            if state_format != STATE_FORMAT:
+                self.reset()
+                return
+            self._replay(facts)
+            self.batches.append(batch)
+
+        conn = self._connect()
+        try:
+            # roll back a batch that was interrupted before it was committed
+            for seq, digest, after_rowid in conn.execute(
+                    'SELECT seq, digest, after_rowid FROM batches WHERE rows IS NULL').fetchall():
+                for part in (glob.glob(os.path.join(
+                        self.partitions_path, 'day=*', f'part-{seq:06d}-*.parquet'))
+                        + glob.glob(os.path.join(
+                            self.path, 'by_*', 'partition=*', f'part-{seq:06d}-*.parquet'))):
+                    os.remove(part)
+                if after_rowid is None:
+                    conn.execute(f'DROP TABLE IF EXISTS {TABLE_NAME}')
+                else:
+                    conn.execute(f'DELETE FROM {TABLE_NAME} WHERE rowid > ?', (after_rowid,))
+                conn.execute('DELETE FROM batches WHERE digest = ?', (digest,))
+            conn.commit()
+            committed = conn.execute(
+                'SELECT seq, name, digest, rows FROM batches ORDER BY seq').fetchall()
+        finally:
+            conn.close()
+
+        digests = [batch['digest'] for batch in self.batches]
+        if (digests != [digest for _, _, digest, _ in committed[:len(digests)]]
+                or committed and not all(map(os.path.isdir, map(self.key_partitions, SCOPES)))):
+            # the state doesn't match the database, start again from the files
+            self.reset()
+            return
+
+        for seq, name, digest, rows in committed[len(digests):]:
+            if not os.path.exists(name):
+                self.reset()
+                return
+            batch = {'seq': seq, 'name': name, 'digest': digest, 'rows': rows}
+            self._save_batch(batch, self._fold_file(name))
+            self.batches.append(batch)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE IF NOT EXISTS batches ('
+                     'seq INTEGER PRIMARY KEY, name TEXT, digest TEXT UNIQUE, '
+                     'after_rowid INTEGER, rows INTEGER)')
+        return conn
+
+    def _save_batch(self, batch, facts):
+        """Write what ``batch`` added to the state, next to the earlier batches' files."""
+        os.makedirs(self.state_path, exist_ok=True)
+        path = os.path.join(self.state_path, f"batch-{batch['seq']:06d}.pickle")
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((STATE_FORMAT, batch, facts), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def _replay(self, facts):
+        for chunk_facts, chunk_cells in facts:
+            self.fold.apply(chunk_facts)
+            for freq, by_scope in chunk_cells.items():
+                for scope, cells in by_scope.items():
+                    if cells is not None:
+                        self.cells[freq][scope].add_cells(cells)
+
+    def _chunks(self, filepath):
+        return iter_events(filepath, chunk_rows(filepath, self.memory_limit_mb))
+
+    @staticmethod
+    def _new_cells():
+        # day cells for the date ranges and the daily trend, hour cells for the hourly one
+        return {freq: {scope: CellFold(width) for scope in SCOPES}
+                for freq, width in WIDTHS.items()}
+
+    def _fold_chunk(self, chunk):
+        """Fold ``chunk``, returning the facts and cells it added for ``_replay``."""
+        chunk_facts = self.fold.add(chunk)
+        # the fold has seen the chunk, so it knows all of its keys and page types
+        page_codes, page_types = pd.factorize(chunk['page_type'])
+        to_global = np.array([self.fold.page_types.index(p) for p in page_types], dtype=np.int8)
+        chunk_cells = {freq: {} for freq in self.cells}
+        for scope in SCOPES:
+            key_codes, keys = pd.factorize(chunk[scope])
+            state = self.fold.states[scope]
+            chunk_keys = state.lookup(keys)[key_codes]
+            for freq, by_scope in self.cells.items():
+                chunk_cells[freq][scope] = by_scope[scope].add(
+                    chunk, chunk_keys, len(state), to_global[page_codes])
+        return chunk_facts, chunk_cells
+
+    def _fold_file(self, filepath):
+        return [self._fold_chunk(chunk) for chunk in self._chunks(filepath)]
+
+    def key_partitions(self, column):
+        """Directory of the events of all batches, hashed by ``column`` into partitions."""
+        return os.path.join(self.path, f'by_{column}')
+
+    def _fit_key_partitions(self, rows, rows_per_part):
+        """Create or split the key partitions so ``rows`` events fit ``rows_per_part`` each."""
+        needed = max(1, -(-rows // rows_per_part))
+        for column in SCOPES:
+            path = self.key_partitions(column)
+            if not os.path.isdir(path):
+                partition_by_user((), path, needed, column)
+                continue
+            n_partitions, factor = len(partition_dirs(path)), 1
+            while n_partitions * factor < needed:
+                factor *= 2
+            if factor > 1:
+                with stage(f'split_by_{column}'):
+                    split_partitions(path, factor, column)
+
+    def reset(self):
+        """Drop every batch, the next ``refresh`` registers all files again."""
+        with self._lock:
+            if self._backend is not None:
+                self._backend.close()
+                self._backend = None
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path, exist_ok=True)
+            self.batches, self.fold, self.cells = [], EventFold(), self._new_cells()
+            self._signatures = {}
+            self._aggregates = None
+            self._cube = None
+            self._trends = None
+
+    @property
+    def version(self):
+        return tuple(batch['digest'] for batch in self.batches)
+
+    def register(self, filepath, digest=None):
+        """Fold one new batch file into the store.
+
+        Returns False if a file with the same content is already registered.
+        """
+        filepath = os.path.abspath(filepath)
+        digest = digest or file_digest(filepath)
+
+        with self._lock:
+            if digest in self.version:
+                return False
+
+            with stage('register_batch'):
+                try:
+                    seq, rows, facts = self._append(filepath, digest)
+                except BaseException:
+                    # the fold may hold part of the batch, reload the committed state
+                    self._open()
+                    raise
+
+                batch = {'seq': seq, 'name': filepath, 'digest': digest, 'rows': rows}
+                self._save_batch(batch, facts)
+                self.batches.append(batch)
+                self._aggregates = None
+                self._cube = None
+                self._trends = None
+            return True
+
+    def _append(self, filepath, digest):
+        conn = self._connect()
+        try:
+            seq = conn.execute(
+                'INSERT INTO batches (name, digest, after_rowid) VALUES '
+                f'(?, ?, (SELECT max(rowid) FROM {TABLE_NAME}))'
+                if self.batches else
+                'INSERT INTO batches (name, digest, after_rowid) VALUES (?, ?, NULL)',
+                (filepath, digest)).lastrowid
+            conn.commit()
+
+            self._fit_key_partitions(
+                sum(batch['rows'] for batch in self.batches) + estimated_rows(filepath),
+                chunk_rows(filepath, self.memory_limit_mb))
+
+            facts = []
+
+            def folded_chunks():
+                for number, chunk in enumerate(self._chunks(filepath)):
+                    facts.append(self._fold_chunk(chunk))
+                    part = f'{seq:06d}-{number:06d}'
+                    write_parts(chunk, self.partitions_path, part)
+                    for column in SCOPES:
+                        append_partition_part(chunk, self.key_partitions(column), part, column)
+                    yield chunk
+
+            rows = append_events(conn, folded_chunks())
+            create_indexes(conn)
+            if not self.batches:
+                conn.execute('ANALYZE')
+            conn.execute('UPDATE batches SET rows = ? WHERE digest = ?', (rows, digest))
+            conn.commit()
+            return seq, rows, facts
+        finally:
+            conn.close()
+
+    def refresh(self, filepaths):
+        """Register the files that are new or changed since the last refresh.
+
+        ``filepaths`` are the batch files in order. Unchanged files are
+        skipped on their mtime and size, so a refresh with nothing new only
+        stats the files.
+        """
+        with self._lock:
+            for filepath in filepaths:
+                filepath = os.path.abspath(filepath)
+                stat = os.stat(filepath)
+                signature = (stat.st_mtime_ns, stat.st_size)
+                if self._signatures.get(filepath) == signature:
+                    continue
+
+                digest = file_digest(filepath)
+                registered = {batch['name']: batch['digest'] for batch in self.batches}
+                if filepath in registered and registered[filepath] != digest:
+                    # a batch was rewritten: the history changed, rebuild it
+                    self.reset()
+                    return self.refresh(filepaths)
+
+                self.register(filepath, digest)
+                self._signatures[filepath] = signature
+
+    def aggregates(self):
+        """Funnel cube, user summary and top products of all batches."""
+        with self._lock:
+            if self._aggregates is None:
+                if not self.batches:
+                    raise ValueError("No event batches registered")
+                with stage('incremental_aggregates'):
+                    self._aggregates = self.fold.aggregates()
+            return self._aggregates
+
+    def olap_cube(self):
+        """Funnel cells of all batches per scope, day and key, see ``analytics.olap``."""
+        with self._lock:
+            if self._cube is None:
+                if not self.batches:
+                    raise ValueError("No event batches registered")
+                self._cube = self._scope_cells('D')
+            return self._cube
+
+    def trend_cube(self):
+        """Daily and hourly funnel trend counts of all batches, see ``analytics.trends``."""
+        with self._lock:
+            if self._trends is None:
+                if not self.batches:
+                    raise ValueError("No event batches registered")
+                tables = {scope: {} for scope in SCOPES}
+                for freq, width in WIDTHS.items():
+                    cells = self.olap_cube() if freq == 'D' else self._scope_cells(freq)
+                    for scope in SCOPES:
+                        tables[scope][freq] = trend_table(cells[scope], width)
+                self._trends = trend_cube_from_tables(tables)
+            return self._trends
+
+    def _scope_cells(self, freq):
+        page_types = np.array(self.fold.page_types, dtype=object)
+        return {scope: self.cells[freq][scope].cells(len(self.fold.states[scope]), page_types)
+                for scope in SCOPES}
+
+    def sql_backend(self):
+        """Read-only query backend over the events of all batches."""
+        with self._lock:
+            if not self.batches:
+                raise ValueError("No event batches registered")
+            if self._backend is None:
+                self._backend = SQLiteBackend((), self.db_path)
+            return self._backend
+
+
+def open_store(filepath, memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB):
+    """Process-wide batch store next to the dataset at ``filepath``."""
+    path = store_dir(filepath)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = BatchStore(path, memory_limit_mb)
+        return _stores[path]
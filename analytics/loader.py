@@ -0,0 +1,235 @@
+"""Process-wide cache for the event dataset.
+
+Streamlit re-executes the app script on every widget interaction, so the CSV
+is parsed once per process here and the same frame is handed to every browser
+session. The frame is shared: callers must treat it as read-only and derive
+new frames instead of assigning columns in place. It is also
+dictionary-encoded (see ``analytics.encoding``), so engines that read it go
+through the helpers of that module.
+
+A cached frame is reused until the file changes. A new mtime or size triggers
+a content hash, and the CSV is only parsed again when that hash differs. The
+hash is recorded with the file's mtime and size in ``.cache/``, so a new
+process whose file is unchanged takes it from there instead of reading the
+whole file again.
+Results derived from the file (see ``cached`` and ``cached_result``) live in
+the same cache entry, so they are dropped together with the version they were
+built from. The frame itself is one of those results and is only parsed when
+something asks for it.
+
+The process-wide lock only guards lookups and stores. A missing result is
+built outside it, under a lock of its own, so a slow build never delays the
+other sessions' cached lookups, and sessions asking for a result that is
+being built wait for that build instead of repeating it.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from analytics.columnar import columns_dir, open_columns, read_manifest, write_columns
+from analytics.encoding import encode_events, memory_mb
+from analytics.profiling import stage
+
+
+DEFAULT_FILEPATH = 'data_set_da_test.csv'
+
+_lock = threading.Lock()
+_cache = {}
+
+_MISSING = object()
+
+
+def file_digest(filepath, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_events(filepath):
+    with stage('read_csv') as s:
+        df = s.rows(pd.read_csv(filepath))
+    with stage('to_datetime'):
+        df['event_date'] = pd.to_datetime(df['event_date'])
+    return df
+
+
+def iter_events(filepath, chunksize):
+    """Parse the CSV in chunks of ``chunksize`` rows, like ``read_events``."""
+    for chunk in pd.read_csv(filepath, chunksize=chunksize):
+        chunk['event_date'] = pd.to_datetime(chunk['event_date'])
+        yield chunk
+
+
+def _digest_record(path):
+    return os.path.join(os.path.dirname(path), '.cache', f'{os.path.basename(path)}.digest.json')
+
+
+def _file_version(path, signature):
+    """Content hash of ``path``, from the record of an earlier process if ``signature`` matches."""
+    record_path = _digest_record(path)
+    try:
+        with open(record_path) as f:
+            record = json.load(f)
+        if (record['mtime_ns'], record['size']) == signature:
+            return record['digest']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with stage('file_digest'):
+        digest = file_digest(path)
+    tmp_path = f'{record_path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(record_path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump({'mtime_ns': signature[0], 'size': signature[1], 'digest': digest}, f)
+        os.replace(tmp_path, record_path)
+    except OSError:
+        # e.g. a read-only deployment, the next process hashes the file again
+        pass
+    return digest
+
+
+def _entry(filepath):
+    path = os.path.abspath(filepath)
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    with _lock:
+        entry = _cache.get(path)
+    if entry is not None and entry['signature'] == signature:
+        return entry
+
+    # hashed outside the lock, a changed file doesn't hold up other lookups
+    digest = _file_version(path, signature)
+    with _lock:
+        entry = _cache.get(path)
+        if entry is None or entry['digest'] != digest:
+            entry = {'digest': digest, 'derived': {}, 'building': {}}
+        entry['signature'] = signature
+        _cache[path] = entry
+        return entry
+
+
+def _lookup(results, key):
+    """The stored result for ``key``, refreshed as most recently used. Hold ``_lock``."""
+    if key not in results:
+        return _MISSING
+    if isinstance(results, OrderedDict):
+        results.move_to_end(key)
+    return results[key]
+
+
+def _build_once(entry, results, key, build, maxsize=None):
+    """``results[key]``, built with ``build()`` if missing; ``maxsize`` bounds an LRU ``results``."""
+    with _lock:
+        result = _lookup(results, key)
+        if result is not _MISSING:
+            return result
+        key_lock = entry['building'].setdefault((id(results), key), threading.Lock())
+
+    with key_lock:
+        with _lock:
+            # built by another session while this one waited
+            result = _lookup(results, key)
+        if result is not _MISSING:
+            return result
+
+        result = build()
+        with _lock:
+            results[key] = result
+            if maxsize is not None:
+                while len(results) > maxsize:
+                    results.popitem(last=False)
+            entry['building'].pop((id(results), key), None)
+        return result
+
+
+def _is_cached(results, key):
+    with _lock:
+        return key in results
+
+
+def cached(filepath, name, build):
+    """Return ``build()``, computed once per dataset version and shared."""
+    entry = _entry(filepath)
+    derived = entry['derived']
+    with stage(name, cached=_is_cached(derived, name)) as s:
+        return s.rows(_build_once(entry, derived, name, build))
+
+
+def encoding_enabled():
+    """Whether the shared frame is dictionary-encoded, see ``analytics.encoding``."""
+    return os.environ.get('DASHBOARD_ENCODING', 'categorical') != 'plain'
+
+
+def load_events(filepath=DEFAULT_FILEPATH):
+    """Return the parsed event frame, shared by every caller in the process.
+
+    The frame is dictionary-encoded unless ``DASHBOARD_ENCODING=plain``. It is
+    mapped from the column store of ``analytics.columnar`` when one exists
+    for this version, otherwise parsed from the CSV and written to the store
+    for the next process. The sizes before and after encoding are kept as
+    ``memory_report``.
+    """
+    if not encoding_enabled():
+        return cached(filepath, 'events_plain', lambda: read_events(filepath))
+
+    def build():
+        path = columns_dir(filepath, dataset_version(filepath))
+        with stage('map_columns'):
+            mapped = open_columns(path)
+        if mapped is not None:
+            cached(filepath, 'memory_report', lambda: {
+                'parsed_mb': read_manifest(path)['parsed_mb'],
+                'encoded_mb': memory_mb(mapped), 'source': 'column store'})
+            return mapped
+
+        df = read_events(filepath)
+        with stage('encode_events'):
+            encoded = encode_events(df)
+        parsed_mb = memory_mb(df)
+        with stage('write_columns'):
+            write_columns(encoded, path, parsed_mb)
+        # mapped back, so this process shares the store with the next ones too
+        mapped = open_columns(path)
+        cached(filepath, 'memory_report', lambda: {
+            'parsed_mb': parsed_mb, 'encoded_mb': memory_mb(encoded), 'source': 'csv'})
+        return encoded if mapped is None else mapped
+
+    return cached(filepath, 'events', build)
+
+
+def peek(filepath, name):
+    """The cached result ``name`` of the current version, None if not built yet."""
+    entry = _entry(filepath)
+    with _lock:
+        return entry['derived'].get(name)
+
+
+def dataset_version(filepath=DEFAULT_FILEPATH):
+    """Content hash of the dataset currently held in the cache."""
+    return _entry(filepath)['digest']
+
+
+def cached_result(filepath, name, build):
+    """Return ``build(df)``, computed once per dataset version and shared."""
+    return cached(filepath, name, lambda: build(load_events(filepath)))
+
+
+def cached_range(filepath, name, key, build, maxsize=16):
+    """Return ``build()`` for one ``key`` of a result with many variants.
+
+    Used for results that depend on a date range. Only the ``maxsize`` most
+    recently used keys are kept for each dataset version.
+    """
+    entry = _entry(filepath)
+    with _lock:
+        results = entry['derived'].setdefault(name, OrderedDict())
+    with stage(name, cached=_is_cached(results, key)) as s:
+        return s.rows(_build_once(entry, results, key, build, maxsize))
@@ -0,0 +1,230 @@
+"""Funnel cube at page_type_first x event_type x day x scope grain.
+
+A date range used to rebuild the funnel from that range's events. Here the
+events are reduced once per data version to one row per key (session or
+user) and day it was active, holding:
+
+- ``first_page``: the page type of the key's first event that day (ties keep
+  file order, as in ``analytics.first_touch``)
+- ``flags``: bits for the funnel event types of the key that day, see ``FLAGS``
+
+The rows are sorted by day, so a ``(scope, day, page_type_first, event_type)``
+cell is the set of keys in that day's slice with that first page and flag.
+Sets of different days overlap (a user comes back), so a range is not a sum
+of per-day counts. ``rollup_funnel_cube`` instead takes the slice of the
+range with two ``searchsorted`` calls, finds each key's first day in the
+range (whose first page is the key's first page in the range), ORs the flags
+per key with ``np.bincount`` and counts the keys with ``funnel_table``. The
+result equals the funnel of the range's events exactly, and its cost depends
+on the key-days in the range, not on the events.
+
+The same cells at hour grain (``width=HOUR_NS``) give the hourly funnel
+trend, see ``analytics.trends``.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from analytics.encoding import column_codes, value_mask
+from analytics.first_touch import earliest_rows
+from analytics.funnel import SCOPES, funnel_cube_from_tables, funnel_table
+
+
+DAY_NS = 86400 * 10**9
+HOUR_NS = 3600 * 10**9
+
+FLAGS = {'interested': 1, 'add_to_cart': 2, 'purchase': 4}
+
+ScopeCells = namedtuple('ScopeCells', ['day', 'key', 'first_page', 'flags', 'n_keys', 'page_types'])
+
+
+def _day_cells(df, key_codes, n_keys, page_codes, width=DAY_NS):
+    """Day, key, first timestamp, first page code and flags of each active ``(day, key)``.
+
+    Days are ``width`` nanoseconds long, the day number counts them from the epoch.
+    """
+    ts = df['event_date'].to_numpy().view('int64')
+    days = ts // width
+
+    first_day = int(days.min()) if len(days) else 0
+    day_keys, cell_codes = np.unique((days - first_day) * n_keys + key_codes,
+                                     return_inverse=True)
+    cell_codes = cell_codes.ravel()
+    first_row, first_ts = earliest_rows(cell_codes, len(day_keys), ts)
+
+    flags = np.zeros(len(day_keys), dtype=np.uint8)
+    for bit, mask in ((FLAGS['interested'], ~value_mask(df['page_type'], 'order_page')),
+                      (FLAGS['add_to_cart'], value_mask(df['event_type'], 'add_to_cart')),
+                      (FLAGS['purchase'], value_mask(df['event_type'], 'order'))):
+        flags[np.bincount(cell_codes[mask], minlength=len(day_keys)) > 0] |= bit
+
+    return (
+        (day_keys // max(n_keys, 1) + first_day).astype(np.int32),
+        (day_keys % max(n_keys, 1)).astype(np.int64),
+        first_ts,
+        page_codes[first_row].astype(np.int8),
+        flags,
+    )
+
+
+def build_scope_cells(df, scope, width=DAY_NS):
+    """One row per active ``(day, key)`` of ``scope``, ordered by day of ``width`` ns."""
+    key_codes, keys = column_codes(df[scope])
+    page_codes, page_types = column_codes(df['page_type'], sort=True)
+    day, key, _, first_page, flags = _day_cells(df, key_codes, len(keys), page_codes, width)
+
+    return ScopeCells(
+        day=day,
+        key=key,
+        first_page=first_page,
+        flags=flags,
+        n_keys=len(keys),
+        page_types=np.asarray(page_types, dtype=object),
+    )
+
+
+def build_olap_cube(df):
+    return {scope: build_scope_cells(df, scope) for scope in SCOPES}
+
+
+def merge_scope_cells(parts):
+    """Cells of key-disjoint parts of the events, keys renumbered, ordered by day."""
+    page_types = np.array(sorted({page for part in parts for page in part.page_types}),
+                          dtype=object)
+    offsets = np.cumsum([0] + [part.n_keys for part in parts])
+    day = np.concatenate([part.day for part in parts])
+    order = np.argsort(day, kind='stable')
+
+    def stack(values):
+        return np.concatenate(values)[order]
+
+    return ScopeCells(
+        day=day[order],
+        key=stack([part.key + offset for part, offset in zip(parts, offsets)]),
+        first_page=stack([pd.Index(page_types).get_indexer(part.page_types)[part.first_page]
+                          .astype(np.int8) for part in parts]),
+        flags=stack([part.flags for part in parts]),
+        n_keys=int(offsets[-1]),
+        page_types=page_types,
+    )
+
+
+def merge_olap_cubes(cubes):
+    return {scope: merge_scope_cells([cube[scope] for cube in cubes]) for scope in SCOPES}
+
+
+class CellFold:
+    """Cells of one scope, folded from event chunks in file order.
+
+    Each cell also keeps the timestamp of its first event, so a ``(day, key)``
+    that continues in a later chunk keeps the earlier first page and ORs the
+    flags. Only the cells from the chunk's first day on are merged and
+    rewritten, in arrays that grow by doubling, and chunks of later batches
+    mostly start where the earlier ones ended. ``width`` is the length of a
+    day in nanoseconds, ``HOUR_NS`` folds hour cells.
+    """
+
+    DTYPES = {'day': np.int32, 'key': np.int64, 'first_ts': np.int64, 'first_page': np.int8,
+              'flags': np.uint8}
+
+    def __init__(self, width=DAY_NS):
+        self.width = width
+        self._columns = {name: np.empty(0, dtype=dtype) for name, dtype in self.DTYPES.items()}
+        self.size = 0
+
+    @property
+    def columns(self):
+        return {name: values[:self.size] for name, values in self._columns.items()}
+
+    def add(self, chunk, key_codes, n_keys, page_codes):
+        """Fold ``chunk``, whose rows have global key codes ``key_codes`` out of ``n_keys``.
+
+        Returns the chunk's own cells, which ``add_cells`` folds again on replay.
+        """
+        if not len(chunk):
+            return None
+        new = dict(zip(self.DTYPES, _day_cells(chunk, key_codes, n_keys, page_codes,
+                                                   self.width)))
+        self.add_cells(new)
+        return new
+
+    def add_cells(self, new):
+        """Fold the cells of a later chunk."""
+        state = self.columns
+        lo = np.searchsorted(state['day'], new['day'][0], side='left')
+
+        # lexsort is stable, a cell of the state sorts before the same cell of the chunk
+        tail = {name: np.concatenate([state[name][lo:], new[name]]) for name in state}
+        order = np.lexsort((tail['key'], tail['day']))
+        tail = {name: values[order] for name, values in tail.items()}
+
+        starts = np.flatnonzero(np.r_[True, (np.diff(tail['day']) != 0)
+                                      | (np.diff(tail['key']) != 0)])
+        cell_codes = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(order)]))
+        first_row, first_ts = earliest_rows(cell_codes, len(starts), tail['first_ts'])
+
+        merged = {
+            'day': tail['day'][starts],
+            'key': tail['key'][starts],
+            'first_ts': first_ts,
+            'first_page': tail['first_page'][first_row],
+            'flags': np.bitwise_or.reduceat(tail['flags'], starts),
+        }
+        size = lo + len(starts)
+        if size > len(self._columns['day']):
+            capacity = max(size, 2 * len(self._columns['day']))
+            for name, values in self._columns.items():
+                grown = np.empty(capacity, dtype=values.dtype)
+                grown[:lo] = values[:lo]
+                self._columns[name] = grown
+        for name, values in merged.items():
+            self._columns[name][lo:size] = values
+        self.size = size
+
+    def cells(self, n_keys, page_types):
+        """The folded cells; ``page_types`` are the page types in the order of their codes."""
+        sorted_types = np.array(sorted(page_types), dtype=object)
+        to_sorted = pd.Index(sorted_types).get_indexer(page_types).astype(np.int8)
+        state = self.columns
+        # copied, later chunks rewrite the tail of the state in place
+        return ScopeCells(
+            day=state['day'].copy(),
+            key=state['key'].copy(),
+            first_page=to_sorted[state['first_page']],
+            flags=state['flags'].copy(),
+            n_keys=n_keys,
+            page_types=sorted_types,
+        )
+
+
+def _day_number(date):
+    return pd.Timestamp(date).value // DAY_NS
+
+
+def rollup_scope(cells, start=None, end=None):
+    """Funnel table of the keys active from day ``start`` to day ``end``."""
+    lo = 0 if start is None else np.searchsorted(cells.day, _day_number(start), side='left')
+    hi = len(cells.day) if end is None else np.searchsorted(cells.day, _day_number(end),
+                                                            side='right')
+    key, flags = cells.key[lo:hi], cells.flags[lo:hi]
+
+    # the first row of each key is its first day in the range: assigning in
+    # reverse row order leaves the lowest row per key
+    rows = np.arange(len(key))[::-1]
+    first_row = np.full(cells.n_keys, -1, dtype=np.int64)
+    first_row[key[rows]] = rows
+    active = first_row >= 0
+
+    def any_flag(name):
+        hits = np.bincount(key[(flags & FLAGS[name]) > 0], minlength=cells.n_keys)
+        return (hits > 0)[active]
+
+    return funnel_table(cells.first_page[lo:hi][first_row[active]], cells.page_types,
+                        any_flag('interested'), any_flag('add_to_cart'), any_flag('purchase'))
+
+
+def rollup_funnel_cube(cube, start=None, end=None):
+    """The ``(scope, page_type_first)`` funnel cube of the events from ``start`` to ``end``."""
+    return funnel_cube_from_tables({scope: rollup_scope(cube[scope], start, end)
+                                    for scope in SCOPES})
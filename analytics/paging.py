@@ -0,0 +1,47 @@
+"""Server-side pages of large result tables.
+
+The apps used to send whole result frames to the browser (capped at 30K
+rows), and filtered what had been sent. Here filtering and sorting run on
+the cached result as boolean masks and one stable argsort of the sort
+column, and only the rows of the requested page are copied out and sent.
+Filters therefore see the full result, and the payload is one page whatever
+the number of rows.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_PAGE_SIZE = 100
+PAGE_SIZES = (50, 100, 500, 1000)
+
+Page = namedtuple('Page', ['rows', 'positions', 'total', 'number', 'n_pages', 'size'])
+
+
+def contains_mask(column, text):
+    """Rows of ``column`` containing ``text``, ignoring case."""
+    return (pd.Series(column.to_numpy(), dtype=object)
+            .str.contains(text, case=False, regex=False).to_numpy(dtype=bool))
+
+
+def page_of(table, mask=None, sort_by=None, descending=False, number=1, size=DEFAULT_PAGE_SIZE):
+    """Page ``number`` (from 1) of the rows of ``table`` selected by ``mask``, sorted by ``sort_by``.
+
+    Ties keep the table order. Without ``sort_by`` the rows stay in table
+    order, reversed if ``descending``. ``number`` is clamped to the existing
+    pages, ``positions`` are the page's row positions in ``table``.
+    """
+    positions = np.arange(len(table)) if mask is None else np.flatnonzero(mask)
+    if sort_by is None:
+        if descending:
+            positions = positions[::-1]
+    else:
+        values = pd.Series(table[sort_by].to_numpy()[positions])
+        positions = positions[values.sort_values(ascending=not descending, kind='stable').index]
+
+    total = len(positions)
+    n_pages = max(1, -(-total // size))
+    number = min(max(1, int(number)), n_pages)
+    positions = positions[(number - 1) * size:number * size]
+    return Page(table.iloc[positions], positions, total, number, n_pages, size)
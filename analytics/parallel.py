@@ -0,0 +1,214 @@
+"""Multi-core aggregation over partitions hashed by user.
+
+The events are split once per dataset version into ``n`` partitions by a
+stable hash of ``user`` and written as Parquet parts. A session belongs to one
+user, so every session and every user falls entirely inside one partition,
+and per-key results of different partitions never overlap. A process pool
+then computes, for each partition, the funnel and trend tables of both
+scopes, the first page type per session and user, the SQL 1 daily counts and
+the SQL 2 user summary, with the same functions as the serial path. Merging
+is cheap: funnel, trend and daily counts add up, and per-key results
+concatenate.
+
+Workers read their own partition from disk, so nothing large is pickled on
+the way in, and only the per-key results come back. The pool runs in a
+helper process (``python -m analytics.parallel``): spawned workers import the
+main module of the process that starts them, and under ``streamlit run``
+that is the app script, which must not run again in every worker. If some session turns
+out to span several users, its events land in several partitions and the
+session scope can't be merged; ``parallel_aggregates`` then returns None and
+the caller stays on the serial path.
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from analytics.first_session import merge_non_returning_users, non_returning_users_per_day
+from analytics.first_touch import first_page_types, first_touch_index
+from analytics.funnel import OVERALL, SCOPES, funnel_cube_from_tables, scope_funnel
+from analytics.trends import build_trend_cube, merge_trend_cubes
+from analytics.user_summary import build_user_summary
+
+
+ParallelAggregates = namedtuple('ParallelAggregates', [
+    'funnel_cube', 'trend_cube', 'first_page_types', 'non_returning_users', 'user_summary',
+    'n_partitions'])
+
+
+def user_partition(users, n_partitions):
+    """Partition number of each user, stable across processes and runs."""
+    return (pd.util.hash_array(np.asarray(users, dtype=object)) % n_partitions).astype(np.int64)
+
+
+def _write_partitioned(chunk, path, n_partitions, part, column, targets=None):
+    partitions = user_partition(chunk[column].to_numpy(), n_partitions)
+    # stable, so rows keep their input order within a partition
+    order = np.argsort(partitions, kind='stable')
+    bounds = np.searchsorted(partitions[order], np.arange(n_partitions + 1))
+    for partition in range(n_partitions) if targets is None else targets:
+        rows = chunk.iloc[order[bounds[partition]:bounds[partition + 1]]]
+        rows.to_parquet(os.path.join(path, f'partition={partition:03d}', f'part-{part}.parquet'),
+                        index=False)
+
+
+def partition_by_user(frames, path, n_partitions, column='user'):
+    """Write ``frames`` as ``n_partitions`` partitions under ``path``, hashed by ``column``."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    for partition in range(n_partitions):
+        os.makedirs(os.path.join(tmp_path, f'partition={partition:03d}'))
+
+    for number, chunk in enumerate(frames):
+        _write_partitioned(chunk, tmp_path, n_partitions, f'{number:06d}', column)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def append_partition_part(chunk, path, part, column='user'):
+    """Add ``chunk`` to the existing partitions under ``path`` as part ``part`` of each."""
+    _write_partitioned(chunk, path, len(partition_dirs(path)), part, column)
+
+
+def split_partitions(path, factor, column='user'):
+    """Split each of the ``n`` partitions under ``path`` into ``factor`` partitions.
+
+    A key in partition ``p`` of ``n`` is in partition ``p + i * n`` of
+    ``n * factor`` for some ``i``, so each part file is split on its own and
+    its rows keep their name and order.
+    """
+    dirs = partition_dirs(path)
+    n_partitions = len(dirs) * factor
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    for partition in range(n_partitions):
+        os.makedirs(os.path.join(tmp_path, f'partition={partition:03d}'))
+
+    for partition, partition_dir in enumerate(dirs):
+        # the other partitions have part files of the same name
+        targets = range(partition, n_partitions, len(dirs))
+        for part in sorted(glob.glob(os.path.join(partition_dir, 'part-*.parquet'))):
+            name = os.path.basename(part)[len('part-'):-len('.parquet')]
+            _write_partitioned(pd.read_parquet(part), tmp_path, n_partitions, name, column,
+                               targets)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def partition_dirs(path):
+    return sorted(glob.glob(os.path.join(path, 'partition=*')))
+
+
+def read_partition(partition_dir):
+    """All events of one partition, in input order."""
+    return pd.concat([pd.read_parquet(part) for part in
+                      sorted(glob.glob(os.path.join(partition_dir, 'part-*.parquet')))],
+                     ignore_index=True)
+
+
+def partition_aggregates(partition_dir):
+    """Per-partition results, run in a worker process."""
+    df = read_partition(partition_dir)
+
+    tables, indexes, first_pages = {}, {}, {}
+    for scope in SCOPES:
+        indexes[scope] = first_touch_index(df, scope)
+        tables[scope] = scope_funnel(df, scope, indexes[scope])
+        first_pages[scope] = first_page_types(indexes[scope])
+
+    return (tables, build_trend_cube(df), first_pages,
+            non_returning_users_per_day(df), build_user_summary(df))
+
+
+def merge_funnel_tables(tables):
+    """Add up funnel tables of key-disjoint partitions."""
+    merged = pd.concat(tables).groupby(level=0, sort=False).sum()
+    # every row repeats the number of keys, a page type missing from a
+    # partition would drop that partition's keys from the sum
+    merged['sessions'] = sum(table.loc[OVERALL, 'sessions'] for table in tables)
+    rows = [page_type for page_type in merged.index if page_type != OVERALL]
+    return merged.loc[rows + [OVERALL]]
+
+
+def merge_partition_aggregates(results):
+    """Merged results, None if the partitions share session keys."""
+    tables, trend_cubes, first_pages, daily, summaries = zip(*results)
+
+    first_page_types = {scope: pd.concat([f[scope] for f in first_pages])
+                        for scope in SCOPES}
+    if first_page_types['session'].index.has_duplicates:
+        return None
+
+    summary = (pd.concat(summaries, ignore_index=True)
+               .sort_values('user', kind='stable', ignore_index=True))
+
+    return ParallelAggregates(
+        funnel_cube=funnel_cube_from_tables(
+            {scope: merge_funnel_tables([t[scope] for t in tables]) for scope in SCOPES}),
+        trend_cube=merge_trend_cubes(trend_cubes),
+        first_page_types=first_page_types,
+        non_returning_users=merge_non_returning_users(daily),
+        user_summary=summary,
+        n_partitions=len(results),
+    )
+
+
+def pool_aggregates(path, workers):
+    """Aggregate the partitions under ``path`` on a pool started from this process."""
+    dirs = partition_dirs(path)
+    # spawn, not fork: the Streamlit server process runs several threads
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(workers, len(dirs)), mp_context=context) as pool:
+        results = list(pool.map(partition_aggregates, dirs))
+    return merge_partition_aggregates(results)
+
+
+def parallel_aggregates(path, workers):
+    """Aggregate the partitions under ``path`` on ``workers`` processes, in a helper process.
+
+    Returns None when a session spans several users, see the module docstring.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [root, os.environ.get('PYTHONPATH')])))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'aggregates.pickle')
+        subprocess.run([sys.executable, '-m', 'analytics.parallel', path, str(workers), output],
+                       env=env, check=True)
+        with open(output, 'rb') as f:
+            return pickle.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Aggregate user partitions on a process pool.")
+    parser.add_argument('path', help="directory written by partition_by_user")
+    parser.add_argument('workers', type=int)
+    parser.add_argument('output', help="pickle file to write the aggregates to")
+    args = parser.parse_args(argv)
+
+    # run from the imported module, so the results unpickle as analytics.parallel
+    # classes rather than as classes of this script's __main__
+    from analytics import parallel
+
+    aggregates = parallel.pool_aggregates(args.path, args.workers)
+    with open(args.output, 'wb') as f:
+        pickle.dump(aggregates, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+if __name__ == '__main__':
+    main()
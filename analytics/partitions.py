@@ -0,0 +1,102 @@
+"""Per-day partitions of the events, for date-range views.
+
+The events are written once per dataset version as Parquet files, one
+directory per day (``day=YYYY-MM-DD/part-*.parquet``). A range view reads only
+the directories of the days it covers, so a week of data costs a week of
+reads no matter how long the history is. Parquet support comes from pyarrow,
+which Streamlit already depends on.
+
+Parts are written in input order, and events of different days never tie on
+timestamp, so a range read yields the same first touches and tie-breaks as
+filtering the full frame.
+"""
+import glob
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+def day_string(day):
+    """``YYYY-MM-DD`` for a date, timestamp or string."""
+    return str(np.datetime64(day, 'D'))
+
+
+def write_parts(chunk, path, part):
+    """Split ``chunk`` by day and write each day's rows as part ``part``."""
+    days = chunk['event_date'].to_numpy().astype('datetime64[D]')
+    unique_days, day_codes = np.unique(days, return_inverse=True)
+    # stable, so rows keep their input order within a day
+    order = np.argsort(day_codes, kind='stable')
+    bounds = np.searchsorted(day_codes[order], np.arange(len(unique_days) + 1))
+
+    for pos, day in enumerate(unique_days):
+        day_dir = os.path.join(path, f'day={day}')
+        os.makedirs(day_dir, exist_ok=True)
+        rows = chunk.iloc[order[bounds[pos]:bounds[pos + 1]]]
+        rows.to_parquet(os.path.join(day_dir, f'part-{part}.parquet'), index=False)
+
+
+def build_partitions(frames, path):
+    """Write ``frames`` as day partitions under ``path``, replacing it atomically."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    for number, chunk in enumerate(frames):
+        write_parts(chunk, tmp_path, f'{number:06d}')
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def partition_days(path):
+    """Days with events under ``path``, as sorted ``YYYY-MM-DD`` strings."""
+    return sorted(os.path.basename(day_dir)[len('day='):]
+                  for day_dir in glob.glob(os.path.join(path, 'day=*')))
+
+
+def range_parts(path, start=None, end=None):
+    """Part files of the days from ``start`` to ``end`` (inclusive, None is open), in order."""
+    start = day_string(start) if start is not None else None
+    end = day_string(end) if end is not None else None
+
+    parts = []
+    for day in partition_days(path):
+        if (start is None or day >= start) and (end is None or day <= end):
+            parts.extend(sorted(glob.glob(os.path.join(path, f'day={day}', 'part-*.parquet'))))
+    return parts
+
+
+def range_rows(path, start=None, end=None):
+    """Number of events from ``start`` to ``end``, from the Parquet footers."""
+    import pyarrow.parquet as pq
+
+    return sum(pq.ParquetFile(part).metadata.num_rows for part in range_parts(path, start, end))
+
+
+def iter_range(path, start=None, end=None):
+    """Events from ``start`` to ``end``, one part at a time.
+
+    Each part holds at most one chunk of the input, so the memory limit the
+    partitions were written with also bounds what is read at once.
+    """
+    for part in range_parts(path, start, end):
+        yield pd.read_parquet(part)
+
+
+def read_range(path, start=None, end=None):
+    """Events of the days from ``start`` to ``end`` (inclusive, None is open)."""
+    parts = list(iter_range(path, start, end))
+    if not parts:
+        return pd.DataFrame({
+            'event_date': pd.Series(dtype='datetime64[ns]'),
+            'session': pd.Series(dtype=object),
+            'user': pd.Series(dtype=object),
+            'page_type': pd.Series(dtype=object),
+            'event_type': pd.Series(dtype=object),
+            'product': pd.Series(dtype='int64'),
+        })
+    return pd.concat(parts, ignore_index=True)
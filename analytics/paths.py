@@ -0,0 +1,156 @@
+"""Page type paths: transitions, step flows and full sequences per session or user.
+
+The funnel only looks at the first page type of each key. Here the events are
+ordered by key and timestamp once (one ``lexsort``, ties keep file order) and
+every count comes from shifted arrays over that order:
+
+- ``transitions``: counts of consecutive ``(from, to)`` page types within a
+  key, from comparing each event with the next
+- ``flows``: the same counts split by step, for the first ``MAX_STEPS``
+  pages of each key, which is what the Sankey chart draws
+- ``sequences``: how many keys followed each exact page sequence. A sequence
+  is encoded as one integer, its page codes being the digits of a base
+  ``n_pages + 2`` number summed with ``np.add.reduceat``. Digit 0 means no
+  page, and sequences longer than ``SEQUENCE_LENGTH`` end in a "more" digit.
+
+Only the top sequences are decoded into labels. Results of key-disjoint parts
+of the events (see ``merge_page_paths``) add up after their page codes are
+mapped onto the union of the parts' page types.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from analytics.encoding import column_codes
+
+
+MAX_STEPS = 8
+SEQUENCE_LENGTH = 20
+MORE = '…'
+
+PagePaths = namedtuple('PagePaths', ['page_types', 'transitions', 'flows', 'sequences'])
+
+
+def _sequence_length(base):
+    """Longest sequence, plus its "more" digit, whose code fits in an int64."""
+    return min(SEQUENCE_LENGTH, int(63 * np.log(2) / np.log(base)) - 1)
+
+
+def build_page_paths(df, scope):
+    """Transitions, step flows and sequence counts of the keys of ``scope``."""
+    key_codes, _ = column_codes(df[scope])
+    # sorted, so parts with the same page types share their codes
+    page_codes, page_types = column_codes(df['page_type'], sort=True)
+    ts = df['event_date'].to_numpy().view('int64')
+    n_pages = len(page_types)
+
+    order = np.lexsort((ts, key_codes))
+    keys, pages = key_codes[order], page_codes[order].astype(np.int64)
+
+    starts_key = np.ones(len(keys), dtype=bool)
+    starts_key[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(starts_key)
+    step = np.arange(len(keys)) - starts[np.cumsum(starts_key) - 1]
+
+    # consecutive events of the same key
+    follows = ~starts_key[1:]
+    pair = pages[:-1][follows] * n_pages + pages[1:][follows]
+    transitions = np.bincount(pair, minlength=n_pages * n_pages).reshape(n_pages, n_pages)
+
+    from_step = step[:-1][follows]
+    early = from_step < MAX_STEPS - 1
+    flows = np.bincount(from_step[early] * n_pages * n_pages + pair[early],
+                        minlength=(MAX_STEPS - 1) * n_pages * n_pages
+                        ).reshape(MAX_STEPS - 1, n_pages, n_pages)
+
+    base = n_pages + 2
+    length = _sequence_length(base)
+    weights = base ** np.arange(length + 1, dtype=np.int64)
+    digits = np.where(step < length, (pages + 1) * weights[np.minimum(step, length)], 0)
+    codes = np.add.reduceat(digits, starts) if len(starts) else np.zeros(0, dtype=np.int64)
+    lengths = np.diff(np.append(starts, len(keys)))
+    codes = codes + np.where(lengths > length, (n_pages + 1) * weights[length], 0)
+
+    sequences = pd.Series(codes).value_counts(sort=False)
+    return PagePaths(np.asarray(page_types, dtype=object), transitions, flows, sequences)
+
+
+def _recode_sequences(sequences, from_base, to_base, mapping):
+    """Sequence codes re-encoded with page codes mapped by ``mapping``.
+
+    A larger base fits fewer pages in an int64, sequences that no longer fit
+    are cut and end in the "more" digit.
+    """
+    codes = sequences.index.to_numpy()
+    digit_map = np.concatenate([[0], mapping + 1, [to_base - 1]])
+    length = _sequence_length(to_base)
+    weights = to_base ** np.arange(length + 1, dtype=np.int64)
+
+    recoded = np.zeros(len(codes), dtype=np.int64)
+    more = np.zeros(len(codes), dtype=bool)
+    for position in range(_sequence_length(from_base) + 1):
+        codes, digit = np.divmod(codes, from_base)
+        if position < length:
+            recoded += digit_map[digit] * weights[position]
+        else:
+            more |= digit > 0
+    recoded += np.where(more, (to_base - 1) * weights[length], 0)
+    return pd.Series(sequences.to_numpy(), index=recoded)
+
+
+def merge_page_paths(parts):
+    """Add up page paths of key-disjoint parts of the events."""
+    page_types = np.array(sorted({page for part in parts for page in part.page_types}),
+                          dtype=object)
+    n_pages = len(page_types)
+    transitions = np.zeros((n_pages, n_pages), dtype=np.int64)
+    flows = np.zeros((MAX_STEPS - 1, n_pages, n_pages), dtype=np.int64)
+    sequences = []
+
+    for part in parts:
+        mapping = pd.Index(page_types).get_indexer(part.page_types)
+        transitions[np.ix_(mapping, mapping)] += part.transitions
+        flows[:, mapping[:, None], mapping[None, :]] += part.flows
+        sequences.append(_recode_sequences(part.sequences, len(part.page_types) + 2,
+                                           n_pages + 2, mapping))
+
+    merged = pd.concat(sequences).groupby(level=0).sum() if sequences else pd.Series(dtype='int64')
+    return PagePaths(page_types, transitions, flows, merged)
+
+
+def transition_table(paths):
+    """Transition counts as a ``from`` x ``to`` table of page types."""
+    return pd.DataFrame(paths.transitions,
+                        index=pd.Index(paths.page_types, name='from_page'),
+                        columns=pd.Index(paths.page_types, name='to_page'))
+
+
+def step_flows(paths, steps=4):
+    """Links of the first ``steps`` pages: ``step``, ``from_page``, ``to_page``, ``count``."""
+    flows = paths.flows[:max(steps - 1, 0)]
+    step, source, target = np.nonzero(flows)
+    return pd.DataFrame({
+        'step': step + 1,
+        'from_page': paths.page_types[source],
+        'to_page': paths.page_types[target],
+        'count': flows[step, source, target],
+    })
+
+
+def top_sequences(paths, n=20):
+    """The ``n`` most common page sequences and the number of keys that followed them."""
+    base = len(paths.page_types) + 2
+    labels = np.concatenate([[''], paths.page_types, [MORE]])
+    # most common first, ties by code so the order doesn't depend on the engine
+    codes, counts = paths.sequences.index.to_numpy(), paths.sequences.to_numpy()
+    top = paths.sequences.iloc[np.lexsort((codes, -counts))[:n]]
+
+    sequences = []
+    for code in top.index:
+        pages = []
+        while code:
+            code, digit = divmod(int(code), base)
+            pages.append(labels[digit])
+        sequences.append(' → '.join(pages))
+    return pd.DataFrame({'sequence': sequences, 'count': top.to_numpy()})
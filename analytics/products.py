@@ -0,0 +1,70 @@
+"""Top products added to cart, overall and per first page type.
+
+Only add to cart events are scanned. Each distinct (product, scope key) pair
+is counted once overall and once under the first page type of its key, so the
+four "Add to Cart" columns come out of a single ``bincount``. The top ``k``
+products are then picked with a partial sort (``np.partition``) rather than
+sorting every product. Ties are ordered by product id.
+"""
+import numpy as np
+import pandas as pd
+
+from analytics.encoding import value_mask, values_at
+
+
+PRODUCT_PAGE_TYPES = [
+    ('Product Page', 'product_page'),
+    ('Listing Page', 'listing_page'),
+    ('Search Listing Page', 'search_listing_page'),
+]
+
+
+def _top_k(counts, k):
+    if len(counts) > k:
+        kth = np.partition(counts, len(counts) - k)[len(counts) - k]
+        candidates = np.flatnonzero(counts >= kth)
+    else:
+        candidates = np.arange(len(counts))
+
+    # product codes are sorted, so ties resolve to the lowest product id
+    order = np.lexsort((candidates, -counts[candidates]))[:k]
+    return candidates[order]
+
+
+def rank_products(products, key_codes, first_page, page_types, scope, k=50):
+    """Top ``k`` products from add to cart events given as parallel arrays.
+
+    ``key_codes`` index into ``first_page``, the per-key first page type codes
+    whose labels are ``page_types``.
+    """
+    product_codes, product_ids = pd.factorize(products, sort=True)
+    key_codes = np.asarray(key_codes, dtype=np.int64)
+    n_keys = len(first_page)
+    n_pages = len(page_types)
+
+    pairs = np.unique(product_codes * n_keys + key_codes)
+    pair_products = pairs // n_keys
+    pair_first_page = first_page[pairs % n_keys]
+
+    overall = np.bincount(pair_products, minlength=len(product_ids))
+    by_page = np.bincount(pair_products * n_pages + pair_first_page,
+                          minlength=len(product_ids) * n_pages).reshape(len(product_ids), n_pages)
+
+    top = _top_k(overall, k)
+    label = scope.capitalize()
+    table = {'product': product_ids[top],
+             f'Add to Cart {label}s': overall[top]}
+    for name, page_type in PRODUCT_PAGE_TYPES:
+        matches = np.flatnonzero(np.asarray(page_types) == page_type)
+        table[f'{name} Add to Cart {label}s'] = (
+            by_page[top, matches[0]] if len(matches)
+            else np.zeros(len(top), dtype=np.int64))
+
+    return pd.DataFrame(table)
+
+
+def top_added_to_cart(df, first_touch, scope, k=50):
+    """Top ``k`` products by distinct add to cart ``scope`` keys."""
+    atc = value_mask(df['event_type'], 'add_to_cart')
+    return rank_products(values_at(df['product'], atc), first_touch.codes[atc],
+                         first_touch.first_page, first_touch.page_types, scope, k)
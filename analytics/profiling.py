@@ -0,0 +1,127 @@
+"""Opt-in per-stage timing of a dashboard rerun.
+
+An app calls ``start(enabled)`` at the top of the script. While a profile is
+active, every ``stage(name)`` block records its wall time, the change in
+resident memory and the number of rows it produced, nested under the stage
+that was running when it started. Cached results are recorded too, flagged
+with ``cached`` so a fast rerun shows where the time was saved.
+
+The active profile is held in a context variable, so concurrent browser
+sessions profile independently. With no active profile ``stage`` returns a
+shared no-op object, which keeps the instrumentation free when it is off.
+"""
+import contextvars
+import json
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+RECORD_FIELDS = ['stage', 'depth', 'seconds', 'memory_delta_mb', 'rows', 'cached']
+
+_current = contextvars.ContextVar('analytics_profile', default=None)
+
+
+def rss():
+    """Resident memory of the process in bytes, None where /proc is unavailable."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+class Profile:
+    """Stage records of one rerun, in the order the stages started."""
+
+    def __init__(self):
+        self.records = []
+        self.depth = 0
+        self.started = time.perf_counter()
+        self.seconds = None
+
+    def stop(self):
+        """Close the profile and log each record as one JSON line."""
+        self.seconds = time.perf_counter() - self.started
+        if _current.get() is self:
+            _current.set(None)
+        for record in self.records:
+            logger.info(json.dumps(record))
+
+    def to_frame(self):
+        import pandas as pd
+
+        frame = pd.DataFrame(self.records, columns=RECORD_FIELDS)
+        frame['rows'] = frame['rows'].astype('Int64')
+        # mark nested stages so the table reads as a tree
+        frame['stage'] = [name if not depth else '\u2003' * (depth - 1) + '\u2514 ' + name
+                          for depth, name in zip(frame['depth'], frame['stage'])]
+        return frame.drop(columns='depth')
+
+    def to_json(self):
+        return json.dumps({'seconds': self.seconds, 'stages': self.records}, indent=2)
+
+
+class _Stage:
+
+    __slots__ = ('profile', 'record', '_start', '_rss')
+
+    def __init__(self, profile, name, cached):
+        self.profile = profile
+        self.record = dict.fromkeys(RECORD_FIELDS)
+        self.record.update(stage=name, depth=profile.depth, cached=cached)
+
+    def __enter__(self):
+        self.profile.records.append(self.record)
+        self.profile.depth += 1
+        self._rss = rss()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.record['seconds'] = round(time.perf_counter() - self._start, 6)
+        if self._rss is not None:
+            self.record['memory_delta_mb'] = round((rss() - self._rss) / (1 << 20), 2)
+        self.profile.depth -= 1
+        return False
+
+    def rows(self, result):
+        """Record the row count of ``result`` if it has one, returns ``result``."""
+        shape = getattr(result, 'shape', None)
+        if shape:
+            self.record['rows'] = int(shape[0])
+        return result
+
+
+class _NullStage:
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def rows(self, result):
+        return result
+
+
+_NULL_STAGE = _NullStage()
+
+
+def start(enabled=True):
+    """Begin profiling this rerun, or turn profiling off for it."""
+    profile = Profile() if enabled else None
+    _current.set(profile)
+    return profile
+
+
+def stage(name, cached=None):
+    """Context manager timing ``name`` under the active profile, if any."""
+    profile = _current.get()
+    if profile is None:
+        return _NULL_STAGE
+    return _Stage(profile, name, cached)
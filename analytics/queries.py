@@ -0,0 +1,102 @@
+"""SQL text shown and run by the SQL tabs.
+
+The queries read from ``df``, the name the SQLite backend gives the event
+table in the apps (query_1.sql / query_2.sql use its ``sql_df`` alias).
+"""
+
+
+NON_RETURNING_USERS_QUERY = """
+    WITH first_sessions AS (
+        SELECT user, MIN(session) AS first_session
+        FROM df
+        GROUP BY user
+    ),
+    first_session_products AS (
+        SELECT df.*
+        FROM df
+        JOIN first_sessions
+        ON df.user = first_sessions.user
+        AND df.session = first_sessions.first_session
+        WHERE df.page_type = 'product_page'
+    ),
+    next_sessions AS (
+        SELECT DISTINCT df.user
+        FROM df
+        JOIN first_sessions
+        ON df.user = first_sessions.user
+        WHERE df.session != first_sessions.first_session
+        AND df.page_type = 'product_page'
+    ),
+    users_only_first_session_products AS (
+        SELECT first_session_products.user
+        FROM first_session_products
+        LEFT JOIN next_sessions
+        ON first_session_products.user = next_sessions.user
+        WHERE next_sessions.user IS NULL
+    )
+
+    SELECT 
+        DATE(first_session_products.event_date) AS date,
+        COUNT(DISTINCT first_session_products.user) AS non_returning_users
+    FROM first_session_products
+    JOIN users_only_first_session_products
+    ON first_session_products.user = users_only_first_session_products.user
+    GROUP BY date;
+
+    """
+
+
+def abnormal_sessions_query(multiplier, abnormal_only=False, min_sessions=None, search=None,
+                            sort_by=None, descending=False, limit=None, offset=0):
+    """SQL 2 query flagging users above ``multiplier`` times the average.
+
+    The filters, sort and page of the SQL 2 table are added as ``WHERE``,
+    ``ORDER BY`` and ``LIMIT`` / ``OFFSET`` clauses, the same push-down
+    ``user_summary.abnormal_page`` does on the cached summary.
+    """
+    conditions = []
+    if abnormal_only:
+        conditions.append("abnormal_behavior != 'Normal'")
+    if min_sessions:
+        conditions.append(f"total_sessions >= {int(min_sessions)}")
+    if search:
+        text = search.lower().replace("'", "''")
+        conditions.append(f"INSTR(LOWER(user), '{text}') > 0")
+
+    clauses = ''
+    if conditions:
+        clauses += '\n    WHERE ' + '\n    AND '.join(conditions)
+    if sort_by is not None:
+        order = ' DESC' if descending else ''
+        clauses += f'\n    ORDER BY {sort_by}{order}' + (', user' if sort_by != 'user' else '')
+    if limit is not None:
+        clauses += f'\n    LIMIT {int(limit)} OFFSET {int(offset)}'
+
+    return f"""
+    WITH user_summary AS (
+    SELECT
+        user,
+        COUNT(*) AS total_sessions,
+        COUNT(DISTINCT page_type) AS page_types_visited
+    FROM df
+    GROUP BY user
+    ),
+    avg_values AS (
+    SELECT
+        AVG(total_sessions) AS avg_total_sessions
+    FROM user_summary
+    ),
+    flagged AS (
+    SELECT
+    user,
+    total_sessions,
+    page_types_visited,
+    CASE
+        WHEN total_sessions > {multiplier} * avg_values.avg_total_sessions THEN 'Abnormal Session Count'
+        ELSE 'Normal'
+    END AS abnormal_behavior
+    FROM user_summary, avg_values
+    )
+
+    SELECT * FROM flagged{clauses}
+    """
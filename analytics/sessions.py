@@ -0,0 +1,77 @@
+"""Sessions rebuilt from user activity, with duration metrics.
+
+The upstream ``session`` column is taken as given everywhere else. Here
+sessions are rebuilt from ``user`` and ``event_date`` alone: a user's events
+in time order start a new session whenever the gap since the previous event
+exceeds the inactivity gap. Everything is done on sorted arrays:
+
+1. one ``lexsort`` orders the events by user code and timestamp
+2. a session starts where the user changes or the timestamp difference to
+   the previous event is above the gap
+3. the start positions delimit the sessions, so counts are differences of
+   positions, durations are last minus first timestamp, and page views are
+   summed with ``np.add.reduceat``
+
+``depth`` is the number of page views in the session. ``user_session_stats``
+reduces the sessions per user for the abnormal-behavior thresholds of
+``analytics.user_summary``.
+"""
+import numpy as np
+import pandas as pd
+
+from analytics.encoding import column_codes, value_mask
+
+
+DEFAULT_GAP_MINUTES = 30
+
+SESSION_COLUMNS = ['user', 'session_start', 'session_end', 'duration_seconds',
+                   'events', 'depth']
+
+
+def sessionize(df, gap_minutes=DEFAULT_GAP_MINUTES):
+    """One row per rebuilt session, ordered by user and start."""
+    user_codes, users = column_codes(df['user'], sort=True)
+    ts = df['event_date'].to_numpy().view('int64')
+    page_views = value_mask(df['event_type'], 'page_view')
+
+    order = np.lexsort((ts, user_codes))
+    user_codes, ts, page_views = user_codes[order], ts[order], page_views[order]
+
+    starts_session = np.ones(len(ts), dtype=bool)
+    starts_session[1:] = ((user_codes[1:] != user_codes[:-1])
+                          | (np.diff(ts) > gap_minutes * 60 * 10**9))
+    starts = np.flatnonzero(starts_session)
+    ends = np.append(starts[1:], len(ts))[:len(starts)] - 1
+
+    depth = (np.add.reduceat(page_views.astype(np.int64), starts)
+             if len(starts) else np.zeros(0, dtype=np.int64))
+    return pd.DataFrame({
+        'user': np.asarray(users, dtype=object)[user_codes[starts]],
+        'session_start': ts[starts].view('datetime64[ns]'),
+        'session_end': ts[ends].view('datetime64[ns]'),
+        'duration_seconds': (ts[ends] - ts[starts]) / 10**9,
+        'events': ends - starts + 1,
+        'depth': depth,
+    })
+
+
+def merge_sessions(parts):
+    """Sessions of user-disjoint parts of the events, ordered like ``sessionize``."""
+    sessions = pd.concat(parts, ignore_index=True)
+    return sessions.sort_values(['user', 'session_start'], kind='stable', ignore_index=True)
+
+
+def sessionize_partitions(frames, gap_minutes=DEFAULT_GAP_MINUTES):
+    """``sessionize`` over frames that each hold all events of their users."""
+    return merge_sessions([sessionize(df, gap_minutes) for df in frames])
+
+
+def user_session_stats(sessions):
+    """Rebuilt session count, mean and longest duration and events per session, per user."""
+    by_user = sessions.groupby('user', sort=True)
+    return pd.DataFrame({
+        'rebuilt_sessions': by_user.size(),
+        'avg_session_seconds': by_user['duration_seconds'].mean(),
+        'max_session_seconds': by_user['duration_seconds'].max(),
+        'events_per_session': by_user['events'].mean(),
+    }).reset_index()
@@ -0,0 +1,128 @@
+"""Precomputed dashboard snapshot, written by a headless batch run.
+
+``python -m analytics.snapshot [data.csv]`` runs the whole pipeline offline
+(e.g. as a nightly job) and writes every full-history result the apps show:
+
+- ``funnels``: metrics and conversion / add to cart / cart abandonment rates
+  of every page type and scope, and the ``funnel_cube`` they come from
+- ``trend_cube``: the counts the daily and hourly funnel trends are sliced from
+- ``cohort_cube``: the cohort sizes and counts the retention matrices are
+  sliced from
+- ``page_paths``: the page type transitions and sequences of each scope
+- ``top_products``: the top 50 products of each scope
+- ``queries``: SQL 1 as run by SQLite, keyed by query text
+- ``non_returning_users`` and ``user_summary``: the native SQL 1 result and
+  the per-user summary SQL 2 flags
+
+The snapshot is a pickle in ``<dataset dir>/.cache/snapshot-<version>.pickle``
+tagged with ``FORMAT_VERSION`` and the data version it was built from (see
+``core.data_version``). ``analytics.core`` answers full-history requests from
+it while the data is unchanged, so a dashboard started after the job renders
+without computing anything. Date-range views are still computed on demand.
+"""
+import argparse
+import datetime
+import glob
+import os
+import pickle
+import time
+
+import pandas as pd
+
+
+FORMAT_VERSION = 5
+TOP_PRODUCTS = 50
+
+
+def snapshot_path(filepath, version):
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)), '.cache')
+    return os.path.join(cache_dir, f'snapshot-{version}.pickle')
+
+
+def funnel_report(filepath):
+    """Funnel metrics and rates of every page type and scope, one row each."""
+    from analytics import core
+    from analytics.funnel import PAGE_TYPES, SCOPES
+
+    rows = []
+    for scope in SCOPES:
+        for page_type in (None, *PAGE_TYPES):
+            metrics = core.funnel(filepath, page_type, scope)
+            conversion_rate, add_to_cart_rate, cart_abandonment_rate = core.funnel_rates(metrics)
+            rows.append({'scope': scope, 'page_type': page_type or 'Overall', **metrics,
+                         'conversion_rate': conversion_rate,
+                         'add_to_cart_rate': add_to_cart_rate,
+                         'cart_abandonment_rate': cart_abandonment_rate})
+    return pd.DataFrame(rows)
+
+
+def build_snapshot(filepath):
+    """Every full-history result of the apps for the data at ``filepath``."""
+    from analytics import core
+    from analytics.funnel import SCOPES
+    from analytics.queries import NON_RETURNING_USERS_QUERY
+
+    return {
+        'format': FORMAT_VERSION,
+        'version': core.data_version(filepath),
+        'ingestion': core.ingestion_mode(),
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'funnel_cube': core.funnel_cube(filepath),
+        'funnels': funnel_report(filepath),
+        'trend_cube': core.trend_cube(filepath),
+        'cohort_cube': core.cohort_cube(filepath),
+        'page_paths': {scope: core.page_paths(filepath, scope) for scope in SCOPES},
+        'top_products': {scope: core.top_products(filepath, scope, k=TOP_PRODUCTS)
+                         for scope in SCOPES},
+        'queries': {NON_RETURNING_USERS_QUERY:
+                    core.sql_db(filepath).query(NON_RETURNING_USERS_QUERY)},
+        'non_returning_users': core.non_returning_users(filepath),
+        'user_summary': core.user_summary(filepath),
+    }
+
+
+def write_snapshot(snapshot, path):
+    """Write ``snapshot`` atomically to ``path``, removing other versions next to it."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    for stale in glob.glob(os.path.join(os.path.dirname(path), 'snapshot-*.pickle')):
+        if stale != path:
+            os.remove(stale)
+    return path
+
+
+def read_snapshot(path, version):
+    """The snapshot at ``path``, None if it is missing or doesn't match ``version``."""
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    if snapshot.get('format') != FORMAT_VERSION or snapshot.get('version') != version:
+        return None
+    return snapshot
+
+
+def main(argv=None):
+    from analytics import core
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('filepath', nargs='?', default=core.DEFAULT_FILEPATH,
+                        help="event CSV to report on")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    snapshot = build_snapshot(args.filepath)
+    path = write_snapshot(snapshot, snapshot_path(args.filepath, snapshot['version']))
+
+    print(snapshot['funnels'].to_string(index=False))
+    print(f"wrote snapshot of version {snapshot['version']} to {path} "
+          f"in {time.perf_counter() - started:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""Query backends for the SQL tabs.
+
+``pandasql.sqldf`` copies the whole frame into a fresh in-memory SQLite
+database on every call. ``SQLiteBackend`` instead loads the events once per
+dataset version into a SQLite file, indexes the columns the queries filter and
+join on, and keeps one connection open for the life of the process. The event
+table is exposed under the names the queries already use (``df`` in the apps,
+``sql_df`` in query_1.sql / query_2.sql), so the query text runs unchanged.
+
+``PandasqlBackend`` keeps the original behaviour behind the same interface.
+Use ``sql_backend`` to get the shared backend for a dataset.
+"""
+import glob
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+from analytics.loader import cached, dataset_version, iter_events, load_events
+from analytics.partitions import day_string
+from analytics.profiling import stage
+
+
+TABLE_NAME = 'events'
+TABLE_ALIASES = ('df', 'sql_df')
+INDEXED_COLUMNS = ('user', 'session', 'page_type', 'event_type', 'event_date')
+
+
+def date_conditions(start=None, end=None):
+    """SQL conditions selecting events from day ``start`` to day ``end``."""
+    # event_date is stored as 'YYYY-MM-DD HH:MM:SS' text, so days compare as prefixes
+    conditions = []
+    if start is not None:
+        conditions.append(f"event_date >= '{day_string(start)}'")
+    if end is not None:
+        end = day_string(np.datetime64(day_string(end)) + np.timedelta64(1, 'D'))
+        conditions.append(f"event_date < '{end}'")
+    return conditions
+
+
+def _cache_dir(filepath):
+    return os.path.join(os.path.dirname(os.path.abspath(filepath)), '.cache')
+
+
+def append_events(conn, frames):
+    """Append event frames to the event table, creating it on first use."""
+    n_rows = 0
+    for df in frames:
+        df.to_sql(TABLE_NAME, conn, index=False, if_exists='append',
+                  chunksize=100_000)
+        n_rows += len(df)
+    return n_rows
+
+
+def create_indexes(conn):
+    """Index the filter and join columns and add the query aliases, if missing."""
+    for column in INDEXED_COLUMNS:
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS idx_{TABLE_NAME}_{column} ON {TABLE_NAME} ("{column}")')
+    for alias in TABLE_ALIASES:
+        conn.execute(f'CREATE VIEW IF NOT EXISTS {alias} AS SELECT * FROM {TABLE_NAME}')
+
+
+def build_database(frames, db_path):
+    """Write ``frames`` and the indexes to ``db_path``, replacing it atomically.
+
+    ``frames`` is any iterable of event frames, e.g. the whole dataset as a
+    single frame or the chunks of a streamed CSV.
+    """
+    tmp_path = f'{db_path}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        append_events(conn, frames)
+        create_indexes(conn)
+        conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, db_path)
+
+
+class SQLiteBackend:
+    """Persistent, indexed SQLite copy of the events for one dataset version."""
+
+    def __init__(self, frames, db_path):
+        if not os.path.exists(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            with stage('sqlite_build'):
+                build_database(frames, db_path)
+
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True,
+                                     check_same_thread=False)
+
+    def query(self, sql, params=None, start=None, end=None):
+        """Run ``sql``, on the events from ``start`` to ``end`` if either is given."""
+        with self._lock, stage('sqlite_query') as s:
+            if start is None and end is None:
+                return s.rows(pd.read_sql_query(sql, self._conn, params=params))
+
+            # temporary views shadow the aliases, so the query text runs unchanged
+            condition = ' AND '.join(date_conditions(start, end))
+            for alias in TABLE_ALIASES:
+                self._conn.execute(
+                    f'CREATE TEMP VIEW {alias} AS SELECT * FROM main.{TABLE_NAME} WHERE {condition}')
+            try:
+                return s.rows(pd.read_sql_query(sql, self._conn, params=params))
+            finally:
+                for alias in TABLE_ALIASES:
+                    self._conn.execute(f'DROP VIEW temp.{alias}')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class PandasqlBackend:
+    """Original behaviour: copy the frame into a new database per query."""
+
+    def __init__(self, frames, db_path=None):
+        frames = list(frames)
+        self.df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+    def query(self, sql, params=None, start=None, end=None):
+        import pandasql as ps
+
+        if params:
+            raise ValueError("pandasql backend does not support query parameters")
+
+        df = self.df
+        if start is not None:
+            df = df[df['event_date'] >= pd.Timestamp(day_string(start))]
+        if end is not None:
+            df = df[df['event_date'] < pd.Timestamp(day_string(end)) + pd.Timedelta(days=1)]
+        with stage('pandasql_sqldf') as s:
+            return s.rows(ps.sqldf(sql, {alias: df for alias in TABLE_ALIASES}))
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'pandasql': PandasqlBackend,
+}
+
+
+def _remove_stale_databases(cache_dir, keep):
+    for path in glob.glob(os.path.join(cache_dir, 'events-*.sqlite')):
+        if os.path.abspath(path) != os.path.abspath(keep):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _frames(filepath, chunksize):
+    if chunksize:
+        yield from iter_events(filepath, chunksize)
+    else:
+        yield load_events(filepath)
+
+
+def sql_backend(filepath, name='sqlite', chunksize=None):
+    """Shared query backend for the dataset at ``filepath``.
+
+    With ``chunksize`` the SQLite database is filled from the CSV in chunks of
+    that many rows, without loading the whole dataset into memory. Either way
+    the events are only read when no database exists yet for this version.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown SQL backend: {name}")
+
+    def build():
+        cache_dir = _cache_dir(filepath)
+        db_path = os.path.join(
+            cache_dir, f'events-{dataset_version(filepath)}.sqlite')
+        if name == 'sqlite':
+            _remove_stale_databases(cache_dir, keep=db_path)
+        return BACKENDS[name](_frames(filepath, chunksize), db_path)
+
+    return cached(filepath, f'sql_backend_{name}', build)
@@ -0,0 +1,240 @@
+"""Chunked ingestion for event files larger than memory.
+
+The CSV is read in chunks sized to stay under a memory ceiling, and each
+chunk is folded into per-key state for both scopes: the earliest event
+(timestamp and page type), the interested / add to cart / ordered flags, the
+event count and a bitmask of the page types seen. Distinct add to cart
+(product, session, user) rows are kept for the product ranking. Only that
+state grows with the data, never the number of events held at once.
+
+From the folded state the funnel cube, first page types, SQL 2 user summary
+and top products are built with the same code as the in-memory path, so the
+numbers shown in the tabs are identical.
+"""
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from analytics.first_touch import earliest_rows
+from analytics.funnel import SCOPES, funnel_cube_from_tables, funnel_table
+from analytics.loader import iter_events
+from analytics.products import rank_products
+
+
+DEFAULT_MEMORY_LIMIT_MB = 512
+
+# parsing a chunk and building its per-key intermediates takes a few times
+# the in-memory size of the parsed rows
+WORKING_SET_FACTOR = 4
+
+FLAGS = ('interested', 'add_to_cart', 'purchase')
+
+StreamedAggregates = namedtuple('StreamedAggregates', [
+    'funnel_cube', 'first_page_types', 'user_summary', 'top_products',
+    'n_events', 'chunksize'])
+
+
+def chunk_rows(filepath, memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB, sample_rows=10_000):
+    """Rows per chunk that keep one chunk's working set under the ceiling."""
+    sample = pd.read_csv(filepath, nrows=sample_rows)
+    if sample.empty:
+        return sample_rows
+
+    bytes_per_row = sample.memory_usage(deep=True).sum() / len(sample)
+    return max(1_000, int(memory_limit_mb * 2**20 / (bytes_per_row * WORKING_SET_FACTOR)))
+
+
+def estimated_rows(filepath, sample_rows=10_000):
+    """Number of rows in the CSV, extrapolated from the size of its first lines."""
+    with open(filepath, 'rb') as f:
+        sample = [line for _, line in zip(range(sample_rows + 1), f)]
+    if len(sample) <= sample_rows:
+        return max(0, len(sample) - 1)
+    return int(os.path.getsize(filepath) * sample_rows / sum(map(len, sample)))
+
+
+class KeyState:
+    """Per-key aggregates for one scope, folded chunk by chunk.
+
+    Keys are coded in order of first appearance through a dict, and the state
+    arrays grow by doubling, so a chunk costs time in proportion to its own
+    keys, not to the keys folded before it.
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def keys(self):
+        return pd.Index(list(self.codes), dtype=object)
+
+    @property
+    def columns(self):
+        return {name: values[:len(self)] for name, values in self._columns.items()}
+
+    def lookup(self, keys):
+        """Codes of ``keys``, keys not seen before get the next codes."""
+        codes = self.codes
+        return np.fromiter((codes.setdefault(key, len(codes)) for key in keys),
+                           dtype=np.int64, count=len(keys))
+
+    def _reserve(self, size, facts):
+        state = self._columns
+        capacity = len(state['events']) if state else 0
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for name, values in facts.items():
+            grown = np.zeros(capacity, dtype=values.dtype)
+            if name in state:
+                grown[:len(state[name])] = state[name]
+            state[name] = grown
+
+    def fold(self, keys, facts):
+        if not len(keys):
+            return
+        known = len(self)
+        pos = self.lookup(keys)
+        self._reserve(len(self), facts)
+        state = self._columns
+
+        seen = pos < known
+        at = pos[seen]
+        # ties keep the state: its events come earlier in the file
+        earlier = facts['first_ts'][seen] < state['first_ts'][at]
+        for name in ('first_ts', 'first_page'):
+            state[name][at[earlier]] = facts[name][seen][earlier]
+        for name in FLAGS + ('page_mask',):
+            state[name][at] |= facts[name][seen]
+        state['events'][at] += facts['events'][seen]
+
+        new = ~seen
+        for name in state:
+            state[name][pos[new]] = facts[name][new]
+
+
+def chunk_key_facts(chunk, scope, page_codes):
+    """Per-key facts of a single chunk; ``page_codes`` are global page type codes."""
+    codes, keys = pd.factorize(chunk[scope])
+    n_keys = len(keys)
+    ts = chunk['event_date'].to_numpy().view('int64')
+    first_row, first_ts = earliest_rows(codes, n_keys, ts)
+
+    def any_per_key(mask):
+        flags = np.zeros(n_keys, dtype=bool)
+        flags[codes[mask]] = True
+        return flags
+
+    page_type = chunk['page_type'].to_numpy()
+    event_type = chunk['event_type'].to_numpy()
+
+    page_mask = np.zeros(n_keys, dtype=np.int64)
+    np.bitwise_or.at(page_mask, codes, np.left_shift(1, page_codes.astype(np.int64)))
+
+    return keys, {
+        'first_ts': first_ts,
+        'first_page': page_codes[first_row],
+        'interested': any_per_key(page_type != 'order_page'),
+        'add_to_cart': any_per_key(event_type == 'add_to_cart'),
+        'purchase': any_per_key(event_type == 'order'),
+        'events': np.bincount(codes, minlength=n_keys),
+        'page_mask': page_mask,
+    }
+
+
+class EventFold:
+    """Per-key state of both scopes, folded from event chunks in file order."""
+
+    def __init__(self):
+        self.states = {scope: KeyState() for scope in SCOPES}
+        self.page_types = []
+        self.atc_rows = []
+        self.n_events = 0
+
+    def _add_page_types(self, page_types):
+        for page_type in page_types:
+            if page_type not in self.page_types:
+                self.page_types.append(page_type)
+        if len(self.page_types) > 62:
+            raise ValueError("Too many distinct page types for the page type bitmask")
+
+    def chunk_facts(self, chunk):
+        """What ``chunk`` adds to the state, to fold with ``apply``."""
+        chunk_codes, chunk_page_types = pd.factorize(chunk['page_type'])
+        self._add_page_types(chunk_page_types)
+        to_global = np.array([self.page_types.index(p) for p in chunk_page_types], dtype=np.int8)
+        page_codes = to_global[chunk_codes]
+
+        atc = chunk[chunk['event_type'] == 'add_to_cart']
+        return {
+            'page_types': list(chunk_page_types),
+            'keys': {scope: chunk_key_facts(chunk, scope, page_codes) for scope in SCOPES},
+            'atc_rows': atc[['product', 'session', 'user']].drop_duplicates(),
+            'events': len(chunk),
+        }
+
+    def apply(self, facts):
+        """Fold the facts of one chunk, also when replayed from an earlier process."""
+        self._add_page_types(facts['page_types'])
+        for scope in SCOPES:
+            self.states[scope].fold(*facts['keys'][scope])
+        self.atc_rows.append(facts['atc_rows'])
+        self.n_events += facts['events']
+
+    def add(self, chunk):
+        facts = self.chunk_facts(chunk)
+        self.apply(facts)
+        return facts
+
+    def aggregates(self, chunksize=None, top_k=50):
+        page_types = np.array(self.page_types, dtype=object)
+        atc = pd.concat(self.atc_rows, ignore_index=True).drop_duplicates(ignore_index=True)
+        # keep the distinct rows only, so later folds don't carry duplicates
+        self.atc_rows = [atc]
+
+        tables, first_page_types, top_products = {}, {}, {}
+        for scope in SCOPES:
+            keys, state = self.states[scope].keys, self.states[scope].columns
+            tables[scope] = funnel_table(state['first_page'], page_types,
+                                         *(state[name] for name in FLAGS))
+            first_page_types[scope] = pd.Series(page_types[state['first_page']],
+                                                index=keys, name='page_type_first')
+            top_products[scope] = rank_products(
+                atc['product'].to_numpy(), keys.get_indexer(atc[scope]),
+                state['first_page'], page_types, scope, top_k)
+
+        users, state = self.states['user'].keys, self.states['user'].columns
+        order = np.argsort(users.to_numpy(), kind='stable')
+        page_mask = state['page_mask'][order]
+        user_summary = pd.DataFrame({
+            'user': users.to_numpy()[order],
+            'total_sessions': state['events'][order],
+            'page_types_visited': sum((page_mask >> bit) & 1
+                                      for bit in range(len(page_types))),
+        })
+
+        return StreamedAggregates(
+            funnel_cube=funnel_cube_from_tables(tables),
+            first_page_types=first_page_types,
+            user_summary=user_summary,
+            top_products=top_products,
+            n_events=self.n_events,
+            chunksize=chunksize,
+        )
+
+
+def stream_aggregates(filepath, memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB,
+                      chunksize=None, top_k=50):
+    if chunksize is None:
+        chunksize = chunk_rows(filepath, memory_limit_mb)
+
+    fold = EventFold()
+    for chunk in iter_events(filepath, chunksize):
+        fold.add(chunk)
+    return fold.aggregates(chunksize, top_k)
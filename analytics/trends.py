@@ -0,0 +1,136 @@
+"""Funnel trends over time, rolled up from one cached cube.
+
+A day or hour counts every session or user active in it, with the page type
+of its first event in that bucket and the funnel event types it had there:
+the same cells as ``analytics.olap``, at day and at hour grain. A point of
+the daily trend is therefore the funnel of that day's events, as the cards
+show it for a one-day range. Keys that come back are counted again on each
+day they are active, so a day's count is not a sum of its hours and a range
+of the series sums to more than the range's distinct keys.
+
+The cells are counted once per ``(scope, freq, start, page_type_first)``,
+which gives a cube whose size depends on the number of days, hours and page
+types, not on the number of events. A daily or hourly series for any page
+type and date range is a slice of that cube, so changing the granularity,
+the page type or the range never reads events.
+
+Counts follow the funnel cube: a page type counts the keys that started the
+bucket on it, and only their purchases that followed an add to cart in the
+bucket; the overall series counts interested keys and every purchase.
+"""
+import numpy as np
+import pandas as pd
+
+from analytics.funnel import PAGE_TYPES, SCOPES
+from analytics.olap import DAY_NS, FLAGS, HOUR_NS, build_scope_cells
+
+
+FREQUENCIES = {'Daily': 'D', 'Hourly': 'h'}
+
+# bucket length of each frequency, in nanoseconds
+WIDTHS = {'D': DAY_NS, 'h': HOUR_NS}
+
+TREND_COLUMNS = ['keys', 'interested', 'add_to_cart', 'cart_purchase', 'purchase']
+
+
+def trend_table(cells, width):
+    """Per ``(start, page_type_first)`` counts of keys and funnel flags of one scope's cells.
+
+    ``cells`` are ``analytics.olap.ScopeCells`` in buckets of ``width`` nanoseconds.
+    """
+    bucket_values, bucket_codes = np.unique(cells.day, return_inverse=True)
+    n_pages = len(cells.page_types)
+    codes = bucket_codes.ravel() * n_pages + cells.first_page
+    size = len(bucket_values) * n_pages
+
+    def count(*names):
+        if not names:
+            return np.bincount(codes, minlength=size)
+        bits = sum(FLAGS[name] for name in names)
+        return np.bincount(codes, weights=(cells.flags & bits) == bits, minlength=size)
+
+    table = pd.DataFrame({
+        'keys': count(),
+        'interested': count('interested'),
+        'add_to_cart': count('add_to_cart'),
+        'cart_purchase': count('add_to_cart', 'purchase'),
+        'purchase': count('purchase'),
+    }, index=pd.MultiIndex.from_product(
+        [(bucket_values.astype(np.int64) * width).view('datetime64[ns]'),
+         np.asarray(cells.page_types, dtype=object)],
+        names=['start', 'page_type_first'])).astype('int64')
+    return table[table['keys'] > 0]
+
+
+def scope_trend_tables(df, scope):
+    """Trend tables of ``scope`` per frequency."""
+    return {freq: trend_table(build_scope_cells(df, scope, width), width)
+            for freq, width in WIDTHS.items()}
+
+
+def trend_cube_from_tables(tables):
+    """Stack per-scope, per-frequency trend tables into the cube."""
+    return pd.concat({(scope, freq): table for scope, by_freq in tables.items()
+                      for freq, table in by_freq.items()},
+                     names=['scope', 'freq'])[TREND_COLUMNS]
+
+
+def build_trend_cube(df):
+    """Trend counts of both scopes at both frequencies."""
+    return trend_cube_from_tables({scope: scope_trend_tables(df, scope) for scope in SCOPES})
+
+
+def merge_trend_cubes(cubes):
+    """Add up trend cubes of key-disjoint parts of the events."""
+    return pd.concat(cubes).groupby(level=[0, 1, 2, 3], sort=True).sum()[TREND_COLUMNS]
+
+
+def trend_metrics(cube, page_type, scope, freq='D', start=None, end=None):
+    """Funnel counts and rates per day (``freq='D'``) or hour (``'h'``).
+
+    ``page_type`` is a "Filter Funnel" radio value, ``start`` / ``end`` are
+    inclusive days. Each bucket counts the keys active in it, see the module
+    docstring. Rates are in percent and NaN where undefined.
+    """
+    if page_type is not None and page_type not in PAGE_TYPES:
+        raise ValueError(f"Unknown page type: {page_type}")
+    if freq not in WIDTHS:
+        raise ValueError(f"Unknown trend frequency: {freq}")
+
+    table = cube.loc[(scope, freq)]
+    starts = table.index.get_level_values('start')
+    in_range = np.ones(len(table), dtype=bool)
+    if start is not None:
+        in_range &= starts >= pd.Timestamp(start)
+    if end is not None:
+        in_range &= starts < pd.Timestamp(end) + pd.Timedelta(days=1)
+    table = table[in_range]
+
+    buckets = table.index.get_level_values('start')
+    totals = table.groupby(buckets).sum()
+    if page_type is None:
+        counts = totals.rename(columns={'interested': 'interested_sessions',
+                                        'add_to_cart': 'add_to_cart_sessions',
+                                        'purchase': 'purchase_sessions'})
+    else:
+        rows = table.index.get_level_values('page_type_first') == PAGE_TYPES[page_type]
+        counts = (table[rows].groupby(buckets[rows]).sum()
+                  .reindex(totals.index, fill_value=0)
+                  .rename(columns={'keys': 'interested_sessions',
+                                   'add_to_cart': 'add_to_cart_sessions',
+                                   'cart_purchase': 'purchase_sessions'}))
+
+    trend = pd.DataFrame({
+        'sessions': totals['keys'],
+        'interested_sessions': counts['interested_sessions'],
+        'add_to_cart_sessions': counts['add_to_cart_sessions'],
+        'purchase_sessions': counts['purchase_sessions'],
+    })
+    interested = trend['interested_sessions'].where(trend['interested_sessions'] > 0)
+    add_to_cart = trend['add_to_cart_sessions'].where(trend['add_to_cart_sessions'] > 0)
+    trend['conversion_rate'] = (trend['purchase_sessions'] / interested * 100).round(2)
+    trend['add_to_cart_rate'] = (trend['add_to_cart_sessions'] / interested * 100).round(2)
+    trend['cart_abandonment_rate'] = ((trend['add_to_cart_sessions'] - trend['purchase_sessions'])
+                                      / add_to_cart * 100).round(2)
+    trend.index.name = 'day' if freq == 'D' else 'hour'
+    return trend
@@ -0,0 +1,116 @@
+"""Per-user summary behind the SQL 2 tab, with abnormal-behavior thresholds.
+
+``build_user_summary`` computes the ``user_summary`` CTE of the SQL 2 query
+(events and distinct page types per user, ordered by user) once per dataset
+version. Thresholding that summary is a vectorized comparison, so moving the
+multiplier slider or switching threshold mode never re-aggregates events.
+
+Threshold modes:
+
+- ``average``: ``total_sessions > multiplier * mean`` (the SQL 2 query)
+- ``median``: ``total_sessions > multiplier * median``
+- ``p75`` / ``p95`` / ``p99``: ``total_sessions`` above that percentile
+
+Any other metric column of the summary, such as the rebuilt session
+durations of ``analytics.sessions``, can be thresholded the same way.
+
+``abnormal_page`` serves the SQL 2 table one page at a time: the threshold is
+taken over every user, the filters and the sort run on the summary columns,
+and only the rows of the page are labelled (see ``analytics.paging``).
+"""
+import numpy as np
+import pandas as pd
+
+from analytics.encoding import column_codes
+from analytics.paging import DEFAULT_PAGE_SIZE, contains_mask, page_of
+
+
+THRESHOLD_MODES = {
+    'average': 'Multiplier of average',
+    'median': 'Multiplier of median',
+    'p75': '75th percentile',
+    'p95': '95th percentile',
+    'p99': '99th percentile',
+}
+
+MULTIPLIER_MODES = ('average', 'median')
+
+METRICS = {
+    'total_sessions': 'Session Count',
+    'rebuilt_sessions': 'Rebuilt Session Count',
+    'avg_session_seconds': 'Average Session Duration',
+    'max_session_seconds': 'Longest Session Duration',
+    'events_per_session': 'Events per Session',
+}
+
+ABNORMAL = 'Abnormal Session Count'
+NORMAL = 'Normal'
+
+
+def build_user_summary(df):
+    user_codes, users = column_codes(df['user'], sort=True)
+    page_codes, page_types = column_codes(df['page_type'])
+    n_users = len(users)
+
+    user_page = np.unique(user_codes * len(page_types) + page_codes)
+
+    return pd.DataFrame({
+        'user': users,
+        'total_sessions': np.bincount(user_codes, minlength=n_users),
+        'page_types_visited': np.bincount(user_page // len(page_types),
+                                          minlength=n_users),
+    })
+
+
+def abnormal_threshold(summary, mode='average', multiplier=3.0, metric='total_sessions'):
+    values = summary[metric].to_numpy()
+    if mode in THRESHOLD_MODES and not len(values):
+        # an empty date range, nothing to flag
+        return 0.0
+
+    if mode == 'average':
+        return multiplier * values.mean()
+    if mode == 'median':
+        return multiplier * np.median(values)
+    if mode in ('p75', 'p95', 'p99'):
+        return float(np.percentile(values, int(mode[1:])))
+
+    raise ValueError(f"Unknown threshold mode: {mode}")
+
+
+def _labels(abnormal, metric):
+    label = ABNORMAL if metric == 'total_sessions' else f'Abnormal {METRICS[metric]}'
+    return np.where(abnormal, label, NORMAL)
+
+
+def flag_abnormal(summary, mode='average', multiplier=3.0, metric='total_sessions'):
+    """Summary with an ``abnormal_behavior`` column for the given threshold on ``metric``."""
+    threshold = abnormal_threshold(summary, mode, multiplier, metric)
+    abnormal = summary[metric].to_numpy() > threshold
+    return summary.assign(abnormal_behavior=_labels(abnormal, metric))
+
+
+def abnormal_page(summary, mode='average', multiplier=3.0, metric='total_sessions',
+                  abnormal_only=False, min_sessions=None, search=None, sort_by='user',
+                  descending=False, page=1, page_size=DEFAULT_PAGE_SIZE):
+    """One page of ``flag_abnormal``'s result, and the number of abnormal users.
+
+    ``abnormal_only``, ``min_sessions`` (on ``total_sessions``) and ``search``
+    (part of the user id, any case) filter the rows before sorting by
+    ``sort_by``; the threshold is still computed over every user.
+    """
+    threshold = abnormal_threshold(summary, mode, multiplier, metric)
+    abnormal = summary[metric].to_numpy() > threshold
+
+    mask = abnormal.copy() if abnormal_only else np.ones(len(summary), dtype=bool)
+    if min_sessions:
+        mask &= summary['total_sessions'].to_numpy() >= min_sessions
+    if search:
+        mask &= contains_mask(summary['user'], search)
+
+    if sort_by == 'user':
+        # the summary is already in user order, and users are unique
+        sort_by = None
+    result = page_of(summary, mask, sort_by, descending, page, page_size)
+    rows = result.rows.assign(abnormal_behavior=_labels(abnormal[result.positions], metric))
+    return result._replace(rows=rows), int(abnormal.sum())
@@ -1,7 +1,9 @@
+import os
+
 import streamlit as st
-import pandas as pd
-import plotly.graph_objects as go
-import pandasql as ps
+
+from analytics import core, profiling
+from analytics.queries import NON_RETURNING_USERS_QUERY, abnormal_sessions_query
 
 
 # STREAMLIT Page setup ----------------------
@@ -52,6 +54,21 @@ elif user_scope == 'User-scope':
     scope = 'user'
 
 
+date_range = st.sidebar.radio(
+    'Date range (shorter ranges only read the days they cover)',
+    ('All time', 'Last 7 days', 'Custom'),
+    horizontal=True
+)
+date_picker = st.sidebar.container()
+
+
+# opt-in timing of each pipeline stage, results are added to the panel at the end of the rerun
+profiling_panel = st.sidebar.expander('Profiling')
+profile = profiling.start(profiling_panel.toggle(
+    'Time each pipeline stage on every rerun',
+    value=os.environ.get('DASHBOARD_PROFILING') == '1'))
+
+
 st.sidebar.divider()
 
 
@@ -83,110 +100,32 @@ st.sidebar.markdown(
 
 filepath = 'data_set_da_test.csv'
 
-df = pd.read_csv(filepath)
-
-# sql_df = df  # use for sql exercises
-
-total_sessions = df[scope].nunique()
-
-
-interested_session_df = df[df['page_type'] != 'order_page']
-interested_sessions = interested_session_df[scope].nunique()
-
-add_to_cart_df = df[df['event_type'] == 'add_to_cart']
-add_to_cart_sessions = add_to_cart_df[scope].nunique()
-
-
-purchase_df = df[df['event_type'] == 'order']
-purchase_sessions = purchase_df[scope].nunique()
-
-
-# funnel metrics
-
-# 1st page type visited in each session
-df['event_date'] = pd.to_datetime(df['event_date'])
-
-df_sorted = df.sort_values(by=[scope, 'event_date'])
-first_page_type_df = df_sorted.groupby(scope).first().reset_index()[
-    [scope, 'page_type']]
-df_first = df.merge(first_page_type_df, on=scope,
-                    how='left', suffixes=('', '_first'))
-
-
-# 2nd is the funnel function
-def funnel_merge_df_type(df, page_type):
-
-    total_type_sessions = total_sessions
-
-    if page_type == 'Search Listing Page':
-        first_search_listing_df = df[df['page_type_first']
-                                     == 'search_listing_page']
-        interested_type_sessions = first_search_listing_df[scope].nunique()
-
-        first_search_listing_atc_df = df[(df['page_type_first'] == 'search_listing_page') & (
-            df['event_type'] == 'add_to_cart')]
-        atc_type_sessions = first_search_listing_atc_df[scope].nunique()
-
-        purchase_type_sessions = first_search_listing_atc_df.merge(
-            purchase_df, on=scope, how='inner')[scope].nunique()
+# date range, None for the full history
+start = end = None
+if date_range == 'Last 7 days':
+    start, end = core.last_days(filepath, 7)
+elif date_range == 'Custom':
+    first_day, last_day = core.date_bounds(filepath)
+    picked = date_picker.date_input('From / to', (first_day, last_day),
+                                    min_value=first_day, max_value=last_day)
+    start, end = (*picked, None, None)[:2]
 
-    elif page_type == 'Listing Page':
-        first_listing_df = df[df['page_type_first'] == 'listing_page']
-        interested_type_sessions = first_listing_df[scope].nunique()
+# funnel metrics per page_type, looked up from the cached funnel cube (rolled
+# up from the per-day cube for a date range); the insight numbers below come
+# from the same metrics
+metrics = core.funnel(filepath, page_type, scope, start, end)
 
-        first_listing_atc_df = df[(df['page_type_first'] == 'listing_page') & (
-            df['event_type'] == 'add_to_cart')]
-        atc_type_sessions = first_listing_atc_df[scope].nunique()
+interested_sessions = metrics['interested_sessions']
+add_to_cart_sessions = metrics['add_to_cart_sessions']
+purchase_sessions = metrics['purchase_sessions']
 
-        purchase_type_sessions = first_listing_atc_df.merge(
-            purchase_df, on=scope, how='inner')[scope].nunique()
+session_cr, add_to_cart_rate, cart_abandonment_rate = core.funnel_rates(metrics)
+interested_share, add_to_cart_share, purchase_share = core.funnel_shares(metrics)
+cart_conversion_rate = round(100 - cart_abandonment_rate, 2)
 
-    elif page_type == 'Product Page':
-        first_product_page_df = df[df['page_type_first'] == 'product_page']
-        interested_type_sessions = first_product_page_df[scope].nunique()
 
-        first_product_page_atc_df = df[(df['page_type_first'] == 'product_page') & (
-            df['event_type'] == 'add_to_cart')]
-        atc_type_sessions = first_product_page_atc_df[scope].nunique()
-
-        purchase_type_sessions = first_product_page_atc_df.merge(
-            purchase_df, on=scope, how='inner')[scope].nunique()
-
-    elif page_type is None:
-        interested_type_sessions = interested_sessions
-        atc_type_sessions = add_to_cart_sessions
-        purchase_type_sessions = purchase_sessions
-
-    else:
-        raise ValueError(f"Unknown page type: {page_type}")
-
-    return pd.Series({
-        'sessions': total_type_sessions,
-        'interested_sessions': interested_type_sessions,
-        'add_to_cart_sessions': atc_type_sessions,
-        'purchase_sessions': purchase_type_sessions
-    })
-
-
-# metrics per page_type
-metrics = funnel_merge_df_type(df_first, page_type)
-
-if page_type != None:
-
-    interested_sessions = metrics['interested_sessions']
-    add_to_cart_sessions = metrics['add_to_cart_sessions']
-    purchase_sessions = metrics['purchase_sessions']
-
-session_cr = round(purchase_sessions/interested_sessions*100, 2)
-
-add_to_cart_rate = round(add_to_cart_sessions/interested_sessions*100, 2)
-
-
-cart_abandonment_rate = round(
-    (add_to_cart_sessions-purchase_sessions)/add_to_cart_sessions*100, 2)
-
-
-tab1, tab2, tab3 = st.tabs(['Ecommerce Funnel', 'SQL 1', 'SQL 2'])
+tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(
+    ['Ecommerce Funnel', 'Page Paths', 'Cohort Retention', 'SQL 1', 'SQL 2', 'SQL Console'])
 
 with tab1:
 
@@ -196,32 +135,32 @@ with tab1:
 
     if page_type == None:
         st.markdown(
-            r"""
-        Almost 100% of result in some but only 3% result in add to cart. However it has a very high overall cart conversion rate of 71.6% which indicates good product and shopping experience after adding to cart.
+            rf"""
+        {interested_share}% of {scope}s result in some interest but only {add_to_cart_share}% result in add to cart. However {cart_conversion_rate}% of those go on to purchase, an overall cart conversion rate which indicates good product and shopping experience after adding to cart.
 
     """
         )
     elif page_type == "Search Listing Page":
         st.markdown(
-            r"""
-        Only 4% of sessions result in a user making first a session. Also, only 6.8% of those add a product to cart which indicates search might need to be improved or experiment giving it higher visibility when a user accesses the website/app.
+            rf"""
+        Only {interested_share}% of {scope}s start on the Search Listing Page. Also, only {add_to_cart_rate}% of those add a product to cart which indicates search might need to be improved or experiment giving it higher visibility when a user accesses the website/app.
     """
         )
 
     elif page_type == "Listing Page":
         st.markdown(
-            r"""
-        Users access first the Listing Page in 52% of sessions which should indicate that menu and category structures and visibility should be good.
-        However, considering that users can add products through the listing page,less that 1% actually do it.
+            rf"""
+        Users access first the Listing Page in {interested_share}% of {scope}s which should indicate that menu and category structures and visibility should be good.
+        However, considering that users can add products through the listing page, only {add_to_cart_share}% actually do it.
         Most likely, users will prefer to go to the Product Page to know more about the products before adding it. Curious that this does not happen the same way in Search Listing Page.
     """
         )
 
     elif page_type == "Product Page":
         st.markdown(
-            r"""
-        Users access Product Page 48% of sessions, which is also a good indicator of its easy discovery.
-        It is also the main way of adding products to the cart (3%) and then purchase (1%).
+            rf"""
+        Users access Product Page in {interested_share}% of {scope}s, which is also a good indicator of its easy discovery.
+        It is also the main way of adding products to the cart ({add_to_cart_share}%) and then purchase ({purchase_share}%).
     """
         )
 
@@ -248,7 +187,9 @@ with tab1:
 
     st.subheader('Funnel Visualization by First Type page visited')
 
-    # Plotly funnel chart
+    # Plotly funnel chart, imported here so the page renders before plotly loads
+    import plotly.graph_objects as go
+
     stages = ['Total Sessions', 'Interested Sessions',
               'Add to Cart Sessions', 'Purchase Sessions']
     values = [metrics['sessions'], metrics['interested_sessions'],
@@ -264,92 +205,149 @@ with tab1:
 
     st.plotly_chart(fig)
 
-    # st.divider()
+    st.divider()
+
+    st.subheader('Funnel Trends')
 
-    # REMOVED DUE TO BEING HEAVY PROCESSING
+    # each day or hour counts the keys active in it; sliced from one cached cube,
+    # so switching granularity, page type or range never reads the events again
+    from analytics.trends import FREQUENCIES
 
-    # st.subheader("Top 50 Products Added to Cart")
-    # # Calculate the number of unique products added to the cart per product
+    granularity = st.radio('Trend granularity', tuple(FREQUENCIES), horizontal=True)
+    trend = core.funnel_trend(filepath, page_type, scope, FREQUENCIES[granularity], start, end)
 
-    # df_product_overall_top_atc = df_first[df_first['event_type'] == 'add_to_cart'].groupby(
-    #     'product')[scope].nunique().reset_index(name=f'Add to Cart {scope.capitalize()}s')
+    st.line_chart(trend[['interested_sessions', 'add_to_cart_sessions', 'purchase_sessions']]
+                  .rename(columns={'interested_sessions': f'{scope.capitalize()}s',
+                                   'add_to_cart_sessions': f'Add to Cart {scope.capitalize()}s',
+                                   'purchase_sessions': f'Purchase {scope.capitalize()}s'}))
+    st.line_chart(trend[['conversion_rate', 'add_to_cart_rate', 'cart_abandonment_rate']]
+                  .rename(columns={'conversion_rate': 'Conversion Rate %',
+                                   'add_to_cart_rate': 'Add to Cart Rate %',
+                                   'cart_abandonment_rate': 'Cart Abandonment Rate %'}))
 
-    # df_product_pageview_top_atc = df_first[(df_first['event_type'] == 'add_to_cart') & (df_first['page_type_first'] == 'product_page')].groupby(
-    #     'product')[scope].nunique().reset_index(name=f'Product Page Add to Cart {scope.capitalize()}s')
+    st.divider()
+
+    st.subheader("Top 50 Products Added to Cart")
+    # Distinct add to cart sessions/users per product, overall and per first page type
+    st.dataframe(core.top_products(filepath, scope, k=50, start=start, end=end))
 
-    # df_product_listing_top_atc = df_first[(df_first['event_type'] == 'add_to_cart') & (df_first['page_type_first'] == 'listing_page')].groupby(
-    #     'product')[scope].nunique().reset_index(name=f'Listing Page Add to Cart {scope.capitalize()}s')
 
-    # df_product_search_listing_atc = df_first[(df_first['event_type'] == 'add_to_cart') & (df_first['page_type_first'] == 'search_listing_page')].groupby(
-    #     'product')[scope].nunique().reset_index(name=f'Search Listing Page Add to Cart {scope.capitalize()}s')
+# page type paths within each session / user
 
-    # merged_product_df = df_product_overall_top_atc.merge(
-    #     df_product_pageview_top_atc, on='product', how='outer'
 
-    # ).merge(
-    #     df_product_listing_top_atc, on='product', how='outer'
+with tab2:
+    st.subheader(f"Page Type Paths per {scope.capitalize()}")
 
-    # ).merge(
-    #     df_product_search_listing_atc, on='product', how='outer'
-    # )
+    st.markdown(
+        f"""How {scope}s move between page types, from their events in time order.
+        The flow chart follows the first pages of each {scope} step by step, the
+        transition table counts every move from one page type to the next and the
+        top sequences are the most common complete paths.
+        """
+    )
 
-    # df['product'] = df['product'].astype('string')
+    from analytics.paths import MAX_STEPS, SEQUENCE_LENGTH, step_flows, top_sequences, transition_table
 
-    # top_50_products = merged_product_df.sort_values(
-    #     by=merged_product_df.columns[1], ascending=False).head(50)
+    paths = core.page_paths(filepath, scope, start, end)
+    steps = st.slider('Pages to follow', 2, MAX_STEPS, 4)
+    flows = step_flows(paths, steps)
 
-    # st.dataframe(top_50_products)
+    # one node per (step, page type), so the flow never loops back
+    import plotly.graph_objects as go
+
+    nodes = sorted({(step, page) for step, page in zip(flows['step'], flows['from_page'])}
+                   | {(step + 1, page) for step, page in zip(flows['step'], flows['to_page'])})
+    node_index = {node: number for number, node in enumerate(nodes)}
+
+    fig = go.Figure(go.Sankey(
+        node=dict(label=[f"{step}. {page}" for step, page in nodes], pad=15),
+        link=dict(
+            source=[node_index[node] for node in zip(flows['step'], flows['from_page'])],
+            target=[node_index[node] for node in zip(flows['step'] + 1, flows['to_page'])],
+            value=flows['count'],
+        ),
+    ))
+    fig.update_layout(title=f"First {steps} pages of each {scope}")
+    st.plotly_chart(fig)
+
+    st.subheader("Page Type Transitions")
+    st.caption("Rows are the page type moved from, columns the page type moved to.")
+    st.dataframe(transition_table(paths))
+
+    st.subheader("Top 20 Page Sequences")
+    st.caption(f"Sequences longer than {SEQUENCE_LENGTH} pages are cut and end in …")
+    st.dataframe(top_sequences(paths, 20), hide_index=True)
+
+
+# retention of users by the day / week of their first session
+
+
+with tab3:
+    st.subheader("Cohort Retention")
+
+    st.markdown(
+        """Users are grouped by the day or week of their first session. Each column
+        shows the share of a cohort that came back in another session, or that
+        purchased, N days or weeks after its first day. In session scope the
+        cells count returning or purchasing sessions per 100 users of the cohort.
+        """
+    )
+
+    from analytics.cohorts import GRANULARITIES, RATES
+
+    col1, col2 = st.columns(2)
+    with col1:
+        cohort_granularity = st.radio('Cohort granularity', tuple(GRANULARITIES), horizontal=True)
+    with col2:
+        cohort_metric = st.radio('Rate', tuple(RATES), format_func=lambda x: RATES[x],
+                                 horizontal=True)
+
+    # sliced from one cached cube, so switching granularity, rate or scope is instant
+    matrix = core.retention(filepath, scope, cohort_granularity, cohort_metric, start, end)
+
+    import plotly.graph_objects as go
+
+    rates = matrix.drop(columns='users')
+    fig = go.Figure(go.Heatmap(
+        z=rates.to_numpy(),
+        x=list(rates.columns),
+        y=[str(cohort) for cohort in rates.index],
+        colorscale='Blues',
+        texttemplate='%{z}',
+        hoverongaps=False,
+    ))
+    fig.update_layout(title=f"{RATES[cohort_metric]} rate by cohort (%)",
+                      yaxis=dict(autorange='reversed', type='category'))
+    st.plotly_chart(fig)
+
+    st.dataframe(matrix)
 
 
 # second part of exercise (SQL Queries)
 
 
-with tab2:
+with tab4:
     st.subheader(
         "Query that displays number of users per day that only viewed products in their first session")
 
-    query = """
-    WITH first_sessions AS (
-        SELECT user, MIN(session) AS first_session
-        FROM df
-        GROUP BY user
-    ),
-    first_session_products AS (
-        SELECT df.*
-        FROM df
-        JOIN first_sessions
-        ON df.user = first_sessions.user
-        AND df.session = first_sessions.first_session
-        WHERE df.page_type = 'product_page'
-    ),
-    next_sessions AS (
-        SELECT DISTINCT df.user
-        FROM df
-        JOIN first_sessions
-        ON df.user = first_sessions.user
-        WHERE df.session != first_sessions.first_session
-        AND df.page_type = 'product_page'
-    ),
-    users_only_first_session_products AS (
-        SELECT first_session_products.user
-        FROM first_session_products
-        LEFT JOIN next_sessions
-        ON first_session_products.user = next_sessions.user
-        WHERE next_sessions.user IS NULL
-    )
-
-    SELECT 
-        DATE(first_session_products.event_date) AS date,
-        COUNT(DISTINCT first_session_products.user) AS non_returning_users
-    FROM first_session_products
-    JOIN users_only_first_session_products
-    ON first_session_products.user = users_only_first_session_products.user
-    GROUP BY date;
+    query = NON_RETURNING_USERS_QUERY
 
-    """
+    # the native engine needs the events in memory
+    if not core.native_engine_available():
+        sql1_engine = 'SQL'
+    else:
+        sql1_engine = st.radio(
+            'Query engine',
+            ('SQL', 'Native'),
+            format_func=lambda x: 'SQL (SQLite)' if x == 'SQL' else 'Native (columnar, same result)',
+            horizontal=True
+        )
 
-    # Run SQL query on DataFrame
-    first_query_result = ps.sqldf(query, locals())
+    # Run SQL query on DataFrame, or its columnar equivalent
+    if sql1_engine == 'SQL':
+        first_query_result = core.sql_query(filepath, query, start, end)
+    else:
+        first_query_result = core.non_returning_users(filepath, start, end)
 
     st.code(query, language="sql")
 
@@ -360,63 +358,152 @@ with tab2:
 # second sql query
 
 
-with tab3:
+with tab5:
     st.subheader(
         "Query that will return any abnormal user behavior")
 
     st.markdown(
         """Here we are trying to analyze traffic outliers (abnormal session counts). 
-        Ideally I would prefer to consider any traffic count that goes beyond a certain percentile (like 75th or 95th percentile).
-        However the pandasql library uses SQLite and we cannot perform percentile calculation with it. 
-        So in that case I made it a bit more interactive by calculating the average session count per user and calculate the abnormal values based on a user input multiplier that you can change.
+        The session count per user is summarised once, so any traffic count that goes beyond a certain percentile (75th, 95th or 99th percentile) can be flagged directly.
+        It can also be made a bit more interactive by calculating the average or median session count per user and calculate the abnormal values based on a user input multiplier that you can change.
         This query can also be adapted to detect abnormal event actions like add to cart or purchase or even session duration.
+        Session durations come from sessions rebuilt from each user's events, a new session starting after the selected inactivity gap.
         """""
     )
 
-    multiplier = st.slider("Select Multiplier to detect abnormal Session Count per User",
-                           min_value=1.0, max_value=8.0, value=3.0, step=0.5)
-
-    second_query = f"""
-    WITH user_summary AS (
-    SELECT
-        user,
-        COUNT(*) AS total_sessions,
-        COUNT(DISTINCT page_type) AS page_types_visited
-    FROM df
-    GROUP BY user
-    ),
-    avg_values AS (
-    SELECT
-        AVG(total_sessions) AS avg_total_sessions
-    FROM user_summary
+    # threshold options live with the summary engine, loaded with this tab
+    from analytics.sessions import DEFAULT_GAP_MINUTES
+    from analytics.user_summary import METRICS, MULTIPLIER_MODES, THRESHOLD_MODES
+
+    abnormal_metric = st.radio(
+        'Flag users on',
+        tuple(METRICS),
+        format_func=lambda x: METRICS[x],
+        horizontal=True
     )
 
-    SELECT
-    user,
-    total_sessions,
-    page_types_visited,
-    CASE
-        WHEN total_sessions > {multiplier} * avg_values.avg_total_sessions THEN 'Abnormal Session Count'
-        ELSE 'Normal'
-    END AS abnormal_behavior
-    FROM user_summary, avg_values
-    LIMIT 30000 -- limited to 30K rows to be lighter on performance after dataframe creation
-    """
+    # every metric but the session count comes from sessions rebuilt from user + event_date
+    if abnormal_metric != 'total_sessions':
+        gap_minutes = st.slider("Inactivity gap that ends a rebuilt session (minutes)",
+                                min_value=5, max_value=120, value=DEFAULT_GAP_MINUTES, step=5)
+        rebuilt = core.sessions(filepath, gap_minutes, start, end)
+        st.caption(f"{len(rebuilt)} sessions rebuilt from the events, "
+                   f"median duration {rebuilt['duration_seconds'].median() / 60:.1f} min")
+    else:
+        gap_minutes = None
+
+    threshold_mode = st.radio(
+        'Abnormal Session Count threshold',
+        tuple(THRESHOLD_MODES),
+        format_func=lambda x: THRESHOLD_MODES[x],
+        horizontal=True
+    )
+
+    if threshold_mode in MULTIPLIER_MODES:
+        multiplier = st.slider(f"Select Multiplier to detect abnormal {METRICS[abnormal_metric]} per User",
+                               min_value=1.0, max_value=8.0, value=3.0, step=0.5)
+    else:
+        multiplier = None
+
+    from analytics.paging import DEFAULT_PAGE_SIZE, PAGE_SIZES
 
-    st.code(second_query, language="sql")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        abnormal_only = st.toggle("Abnormal Only")
+        search = st.text_input("Search user")
+    with col2:
+        min_sessions = st.number_input("Min sessions", min_value=0, value=0, step=1)
+        sort_by = st.selectbox("Sort by", ('user', 'total_sessions', 'page_types_visited'))
+    with col3:
+        descending = st.toggle("Descending")
+        page_size = st.selectbox("Rows per page", PAGE_SIZES,
+                                 index=PAGE_SIZES.index(DEFAULT_PAGE_SIZE))
+    page_number = st.number_input("Page", min_value=1, value=1, step=1)
+
+    if threshold_mode == 'average' and abnormal_metric == 'total_sessions':
+        second_query = abnormal_sessions_query(
+            multiplier, abnormal_only, min_sessions, search, sort_by, descending,
+            page_size, (page_number - 1) * page_size)
+
+        st.code(second_query, language="sql")
 
-    # Run the SQL query on the DataFrame
-    second_query_result = ps.sqldf(second_query, locals())
+    # Re-threshold the cached per-user summary instead of re-running the query,
+    # filtering, sorting and paging it on the server so only this page is sent
+    page, n_abnormal = core.abnormal_users_page(
+        filepath, threshold_mode, multiplier, start, end, abnormal_metric, gap_minutes,
+        abnormal_only=abnormal_only, min_sessions=min_sessions, search=search,
+        sort_by=sort_by, descending=descending, page=page_number, page_size=page_size)
 
     st.subheader("2nd query output")
 
-    st.button("Reset", type="primary")
+    first_row = (page.number - 1) * page.size
+    st.caption(f"{n_abnormal} abnormal users. Page {page.number} of {page.n_pages}, "
+               f"rows {min(first_row + 1, page.total)}-{first_row + len(page.rows)} "
+               f"of {page.total} matching users.")
+    st.dataframe(page.rows, hide_index=True)
 
-    if st.button("Toggle Abnormal Only"):
-        second_query_df = second_query_result[second_query_result['abnormal_behavior']
-                                              == 'Abnormal Session Count']
 
-        st.dataframe(second_query_df)
+# ad-hoc queries
 
-    else:
-        st.dataframe(second_query_result)
+
+with tab6:
+    st.subheader("SQL Console")
+
+    st.markdown(
+        """Run your own read-only query on the events, as `df`, `sql_df` or `events`
+        (the sidebar date range applies). Pass values as named parameters (`:name`
+        in the query, one `name=value` per line below) rather than in the query text.
+        Each query stops at its timeout and row budget, and results are cached per
+        query, parameters and data version, so repeated queries return instantly.
+        """
+    )
+
+    from analytics.console import (DEFAULT_ROW_BUDGET, DEFAULT_TIMEOUT_SECONDS, EXAMPLE_PARAMS,
+                                   EXAMPLE_QUERY, MAX_ROW_BUDGET, MAX_TIMEOUT_SECONDS,
+                                   parse_params)
+
+    with st.form('sql_console'):
+        console_query = st.text_area("Query", EXAMPLE_QUERY, height=200)
+        console_params = st.text_area("Parameters", EXAMPLE_PARAMS, height=80)
+        col1, col2 = st.columns(2)
+        with col1:
+            console_timeout = st.number_input("Timeout (seconds)", min_value=1,
+                                              max_value=MAX_TIMEOUT_SECONDS,
+                                              value=DEFAULT_TIMEOUT_SECONDS)
+        with col2:
+            console_rows = st.number_input("Row budget", min_value=1, max_value=MAX_ROW_BUDGET,
+                                           value=DEFAULT_ROW_BUDGET, step=1000)
+        if st.form_submit_button("Run query", type="primary"):
+            # kept across reruns, a cached result comes back without running again
+            st.session_state['console_request'] = (console_query, console_params,
+                                                   console_timeout, console_rows)
+
+    if 'console_request' in st.session_state:
+        console_query, console_params, console_timeout, console_rows = \
+            st.session_state['console_request']
+        try:
+            console_result, from_cache = core.console_query(
+                filepath, console_query, parse_params(console_params), start, end,
+                console_timeout, console_rows)
+        except (ValueError, TimeoutError) as error:
+            st.error(f"Query failed: {error}")
+        else:
+            source = 'cached result' if from_cache else f'ran in {console_result.seconds:.3f} s'
+            st.caption(f"{len(console_result.frame)} rows, {source}.")
+            if console_result.truncated:
+                st.warning(f"Stopped at the row budget of {console_rows} rows.")
+            st.dataframe(console_result.frame, hide_index=True)
+
+
+# profiling results of this rerun, also logged as JSON lines by analytics.profiling
+if profile is not None:
+    profile.stop()
+
+    profiling_panel.caption(f'Rerun took {profile.seconds:.3f} s')
+    memory = core.memory_report()
+    if memory is not None:
+        profiling_panel.caption(f"Events in memory: {memory['encoded_mb']:.1f} MB "
+                                f"({memory['parsed_mb']:.1f} MB as parsed), read from {memory['source']}")
+    profiling_panel.dataframe(profile.to_frame(), hide_index=True)
+    profiling_panel.download_button('Export as JSON', profile.to_json(),
+                                    file_name='profile.json', mime='application/json')
@@ -1,6 +1,8 @@
+import os
+
 import streamlit as st
-import pandas as pd
-import plotly.graph_objects as go
+
+from analytics import core, profiling
 
 
 # STREAMLIT Page setup ----------------------
@@ -51,6 +53,21 @@ elif user_scope == 'User-scope':
     scope = 'user'
 
 
+date_range = st.sidebar.radio(
+    'Date range (shorter ranges only read the days they cover)',
+    ('All time', 'Last 7 days', 'Custom'),
+    horizontal=True
+)
+date_picker = st.sidebar.container()
+
+
+# opt-in timing of each pipeline stage, results are added to the panel at the end of the rerun
+profiling_panel = st.sidebar.expander('Profiling')
+profile = profiling.start(profiling_panel.toggle(
+    'Time each pipeline stage on every rerun',
+    value=os.environ.get('DASHBOARD_PROFILING') == '1'))
+
+
 st.sidebar.divider()
 
 
@@ -82,105 +99,28 @@ st.sidebar.markdown(
 
 filepath = 'data_set_da_test.csv'
 
-df = pd.read_csv(filepath)
-
-total_sessions = df[scope].nunique()
-
-
-interested_session_df = df[df['page_type'] != 'order_page']
-interested_sessions = interested_session_df[scope].nunique()
-
-add_to_cart_df = df[df['event_type'] == 'add_to_cart']
-add_to_cart_sessions = add_to_cart_df[scope].nunique()
-
-
-purchase_df = df[df['event_type'] == 'order']
-purchase_sessions = purchase_df[scope].nunique()
-
-
-# funnel metrics
-
-# 1st page type visited in each session
-df['event_date'] = pd.to_datetime(df['event_date'])
-
-df_sorted = df.sort_values(by=[scope, 'event_date'])
-first_page_type_df = df_sorted.groupby(scope).first().reset_index()[
-    [scope, 'page_type']]
-df_first = df.merge(first_page_type_df, on=scope,
-                    how='left', suffixes=('', '_first'))
-
-
-# 2nd is the funnel function
-def funnel_merge_df_type(df, page_type):
-
-    total_type_sessions = total_sessions
-
-    if page_type == 'Search Listing Page':
-        first_search_listing_df = df[df['page_type_first']
-                                     == 'search_listing_page']
-        interested_type_sessions = first_search_listing_df[scope].nunique()
-
-        first_search_listing_atc_df = df[(df['page_type_first'] == 'search_listing_page') & (
-            df['event_type'] == 'add_to_cart')]
-        atc_type_sessions = first_search_listing_atc_df[scope].nunique()
-
-        purchase_type_sessions = first_search_listing_atc_df.merge(
-            purchase_df, on=scope, how='inner')[scope].nunique()
+# date range, None for the full history
+start = end = None
+if date_range == 'Last 7 days':
+    start, end = core.last_days(filepath, 7)
+elif date_range == 'Custom':
+    first_day, last_day = core.date_bounds(filepath)
+    picked = date_picker.date_input('From / to', (first_day, last_day),
+                                    min_value=first_day, max_value=last_day)
+    start, end = (*picked, None, None)[:2]
 
-    elif page_type == 'Listing Page':
-        first_listing_df = df[df['page_type_first'] == 'listing_page']
-        interested_type_sessions = first_listing_df[scope].nunique()
+# funnel metrics per page_type, looked up from the cached funnel cube (rolled
+# up from the per-day cube for a date range); the insight numbers below come
+# from the same metrics
+metrics = core.funnel(filepath, page_type, scope, start, end)
 
-        first_listing_atc_df = df[(df['page_type_first'] == 'listing_page') & (
-            df['event_type'] == 'add_to_cart')]
-        atc_type_sessions = first_listing_atc_df[scope].nunique()
+interested_sessions = metrics['interested_sessions']
+add_to_cart_sessions = metrics['add_to_cart_sessions']
+purchase_sessions = metrics['purchase_sessions']
 
-        purchase_type_sessions = first_listing_atc_df.merge(
-            purchase_df, on=scope, how='inner')[scope].nunique()
-
-    elif page_type == 'Product Page':
-        first_product_page_df = df[df['page_type_first'] == 'product_page']
-        interested_type_sessions = first_product_page_df[scope].nunique()
-
-        first_product_page_atc_df = df[(df['page_type_first'] == 'product_page') & (
-            df['event_type'] == 'add_to_cart')]
-        atc_type_sessions = first_product_page_atc_df[scope].nunique()
-
-        purchase_type_sessions = first_product_page_atc_df.merge(
-            purchase_df, on=scope, how='inner')[scope].nunique()
-
-    elif page_type is None:
-        interested_type_sessions = interested_sessions
-        atc_type_sessions = add_to_cart_sessions
-        purchase_type_sessions = purchase_sessions
-
-    else:
-        raise ValueError(f"Unknown page type: {page_type}")
-
-    return pd.Series({
-        'sessions': total_type_sessions,
-        'interested_sessions': interested_type_sessions,
-        'add_to_cart_sessions': atc_type_sessions,
-        'purchase_sessions': purchase_type_sessions
-    })
-
-
-# metrics per page_type
-metrics = funnel_merge_df_type(df_first, page_type)
-
-if page_type != None:
-
-    interested_sessions = metrics['interested_sessions']
-    add_to_cart_sessions = metrics['add_to_cart_sessions']
-    purchase_sessions = metrics['purchase_sessions']
-
-session_cr = round(purchase_sessions/interested_sessions*100, 2)
-
-add_to_cart_rate = round(add_to_cart_sessions/interested_sessions*100, 2)
-
-
-cart_abandonment_rate = round(
-    (add_to_cart_sessions-purchase_sessions)/add_to_cart_sessions*100, 2)
+session_cr, add_to_cart_rate, cart_abandonment_rate = core.funnel_rates(metrics)
+interested_share, add_to_cart_share, purchase_share = core.funnel_shares(metrics)
+cart_conversion_rate = round(100 - cart_abandonment_rate, 2)
 
 
 # Funnel Analysis per Page Type
@@ -189,32 +129,32 @@ st.subheader("Insights")
 
 if page_type == None:
     st.markdown(
-        r"""
-    Almost 100% of result in some but only 3% result in add to cart. However it has a very high overall cart conversion rate of 71.6% which indicates good product and shopping experience after adding to cart.
+        rf"""
+    {interested_share}% of {scope}s result in some interest but only {add_to_cart_share}% result in add to cart. However {cart_conversion_rate}% of those go on to purchase, an overall cart conversion rate which indicates good product and shopping experience after adding to cart.
 
 """
     )
 elif page_type == "Search Listing Page":
     st.markdown(
-        r"""
-    Only 4% of sessions result in a user making first a session. Also, only 6.8% of those add a product to cart which indicates search might need to be improved or experiment giving it higher visibility when a user accesses the website/app.
+        rf"""
+    Only {interested_share}% of {scope}s start on the Search Listing Page. Also, only {add_to_cart_rate}% of those add a product to cart which indicates search might need to be improved or experiment giving it higher visibility when a user accesses the website/app.
 """
     )
 
 elif page_type == "Listing Page":
     st.markdown(
-        r"""
-    Users access first the Listing Page in 52% of sessions which should indicate that menu and category structures and visibility should be good.
-    However, considering that users can add products through the listing page,less that 1% actually do it.
+        rf"""
+    Users access first the Listing Page in {interested_share}% of {scope}s which should indicate that menu and category structures and visibility should be good.
+    However, considering that users can add products through the listing page, only {add_to_cart_share}% actually do it.
     Most likely, users will prefer to go to the Product Page to know more about the products before adding it. Curious that this does not happen the same way in Search Listing Page.
 """
     )
 
 elif page_type == "Product Page":
     st.markdown(
-        r"""
-    Users access Product Page 48% of sessions, which is also a good indicator of its easy discovery.
-    It is also the main way of adding products to the cart (3%) and then purchase (1%).
+        rf"""
+    Users access Product Page in {interested_share}% of {scope}s, which is also a good indicator of its easy discovery.
+    It is also the main way of adding products to the cart ({add_to_cart_share}%) and then purchase ({purchase_share}%).
 """
     )
 
@@ -241,7 +181,9 @@ st.divider()
 
 st.subheader('Funnel Visualization by First Type page visited')
 
-# Plotly funnel chart
+# Plotly funnel chart, imported here so the page renders before plotly loads
+import plotly.graph_objects as go
+
 stages = ['Total Sessions', 'Interested Sessions',
           'Add to Cart Sessions', 'Purchase Sessions']
 values = [metrics['sessions'], metrics['interested_sessions'],
@@ -260,34 +202,40 @@ st.plotly_chart(fig)
 
 st.divider()
 
-st.subheader("Top 50 Products Added to Cart")
-# Calculate the number of unique products added to the cart per product
-
-df_product_overall_top_atc = df_first[df_first['event_type'] == 'add_to_cart'].groupby(
-    'product')[scope].nunique().reset_index(name=f'Add to Cart {scope.capitalize()}s')
-
-df_product_pageview_top_atc = df_first[(df_first['event_type'] == 'add_to_cart') & (df_first['page_type_first'] == 'product_page')].groupby(
-    'product')[scope].nunique().reset_index(name=f'Product Page Add to Cart {scope.capitalize()}s')
+st.subheader('Funnel Trends')
 
-df_product_listing_top_atc = df_first[(df_first['event_type'] == 'add_to_cart') & (df_first['page_type_first'] == 'listing_page')].groupby(
-    'product')[scope].nunique().reset_index(name=f'Listing Page Add to Cart {scope.capitalize()}s')
+# each day or hour counts the keys active in it; sliced from one cached cube,
+# so switching granularity, page type or range never reads the events again
+from analytics.trends import FREQUENCIES
 
-df_product_search_listing_atc = df_first[(df_first['event_type'] == 'add_to_cart') & (df_first['page_type_first'] == 'search_listing_page')].groupby(
-    'product')[scope].nunique().reset_index(name=f'Search Listing Page Add to Cart {scope.capitalize()}s')
+granularity = st.radio('Trend granularity', tuple(FREQUENCIES), horizontal=True)
+trend = core.funnel_trend(filepath, page_type, scope, FREQUENCIES[granularity], start, end)
 
-merged_product_df = df_product_overall_top_atc.merge(
-    df_product_pageview_top_atc, on='product', how='outer'
+st.line_chart(trend[['interested_sessions', 'add_to_cart_sessions', 'purchase_sessions']]
+              .rename(columns={'interested_sessions': f'{scope.capitalize()}s',
+                               'add_to_cart_sessions': f'Add to Cart {scope.capitalize()}s',
+                               'purchase_sessions': f'Purchase {scope.capitalize()}s'}))
+st.line_chart(trend[['conversion_rate', 'add_to_cart_rate', 'cart_abandonment_rate']]
+              .rename(columns={'conversion_rate': 'Conversion Rate %',
+                               'add_to_cart_rate': 'Add to Cart Rate %',
+                               'cart_abandonment_rate': 'Cart Abandonment Rate %'}))
 
-).merge(
-    df_product_listing_top_atc, on='product', how='outer'
-
-).merge(
-    df_product_search_listing_atc, on='product', how='outer'
-)
-
-df['product'] = df['product'].astype('string')
-
-top_50_products = merged_product_df.sort_values(
-    by=merged_product_df.columns[1], ascending=False).head(50)
+st.divider()
 
-st.dataframe(top_50_products)
+st.subheader("Top 50 Products Added to Cart")
+# Distinct add to cart sessions/users per product, overall and per first page type
+st.dataframe(core.top_products(filepath, scope, k=50, start=start, end=end))
+
+
+# profiling results of this rerun, also logged as JSON lines by analytics.profiling
+if profile is not None:
+    profile.stop()
+
+    profiling_panel.caption(f'Rerun took {profile.seconds:.3f} s')
+    memory = core.memory_report()
+    if memory is not None:
+        profiling_panel.caption(f"Events in memory: {memory['encoded_mb']:.1f} MB "
+                                f"({memory['parsed_mb']:.1f} MB as parsed), read from {memory['source']}")
+    profiling_panel.dataframe(profile.to_frame(), hide_index=True)
+    profiling_panel.download_button('Export as JSON', profile.to_json(),
+                                    file_name='profile.json', mime='application/json')
@@ -1,7 +1,9 @@
+import os
+
 import streamlit as st
-import pandas as pd
-import plotly.graph_objects as go
-import pandasql as ps
+
+from analytics import core, profiling
+from analytics.queries import NON_RETURNING_USERS_QUERY, abnormal_sessions_query
 
 
 # STREAMLIT Page setup ----------------------
@@ -13,6 +15,25 @@ st.set_page_config(layout="centered",
 st.title(f"Ecommerce Analytics")
 
 
+date_range = st.sidebar.radio(
+    'Date range (shorter ranges only read the days they cover)',
+    ('All time', 'Last 7 days', 'Custom'),
+    horizontal=True
+)
+date_picker = st.sidebar.container()
+
+st.sidebar.divider()
+
+
+# opt-in timing of each pipeline stage, results are added to the panel at the end of the rerun
+profiling_panel = st.sidebar.expander('Profiling')
+profile = profiling.start(profiling_panel.toggle(
+    'Time each pipeline stage on every rerun',
+    value=os.environ.get('DASHBOARD_PROFILING') == '1'))
+
+st.sidebar.divider()
+
+
 st.sidebar.text("Created by João Valente. Enjoy!")
 st.sidebar.markdown(
     "[Linkedin](https://www.linkedin.com/in/joao-valente-analytics/)", unsafe_allow_html=True)
@@ -27,57 +48,41 @@ st.sidebar.markdown(
 
 filepath = 'data_set_da_test.csv'
 
-df = pd.read_csv(filepath)
+# date range, None for the full history
+start = end = None
+if date_range == 'Last 7 days':
+    start, end = core.last_days(filepath, 7)
+elif date_range == 'Custom':
+    first_day, last_day = core.date_bounds(filepath)
+    picked = date_picker.date_input('From / to', (first_day, last_day),
+                                    min_value=first_day, max_value=last_day)
+    start, end = (*picked, None, None)[:2]
 
 
-tab2, tab3 = st.tabs(['SQL 1', 'SQL 2'])
+tab2, tab3, tab4 = st.tabs(['SQL 1', 'SQL 2', 'SQL Console'])
 
 with tab2:
     st.subheader(
         "Query that displays number of users per day that only viewed products in their first session")
 
-    query = """
-    WITH first_sessions AS (
-        SELECT user, MIN(session) AS first_session
-        FROM df
-        GROUP BY user
-    ),
-    first_session_products AS (
-        SELECT df.*
-        FROM df
-        JOIN first_sessions
-        ON df.user = first_sessions.user
-        AND df.session = first_sessions.first_session
-        WHERE df.page_type = 'product_page'
-    ),
-    next_sessions AS (
-        SELECT DISTINCT df.user
-        FROM df
-        JOIN first_sessions
-        ON df.user = first_sessions.user
-        WHERE df.session != first_sessions.first_session
-        AND df.page_type = 'product_page'
-    ),
-    users_only_first_session_products AS (
-        SELECT first_session_products.user
-        FROM first_session_products
-        LEFT JOIN next_sessions
-        ON first_session_products.user = next_sessions.user
-        WHERE next_sessions.user IS NULL
-    )
-
-    SELECT 
-        DATE(first_session_products.event_date) AS date,
-        COUNT(DISTINCT first_session_products.user) AS non_returning_users
-    FROM first_session_products
-    JOIN users_only_first_session_products
-    ON first_session_products.user = users_only_first_session_products.user
-    GROUP BY date;
-
-    """
+    query = NON_RETURNING_USERS_QUERY
 
-    # Run SQL query on DataFrame
-    first_query_result = ps.sqldf(query, locals())
+    # the native engine needs the events in memory
+    if not core.native_engine_available():
+        sql1_engine = 'SQL'
+    else:
+        sql1_engine = st.radio(
+            'Query engine',
+            ('SQL', 'Native'),
+            format_func=lambda x: 'SQL (SQLite)' if x == 'SQL' else 'Native (columnar, same result)',
+            horizontal=True
+        )
+
+    # Run SQL query on DataFrame, or its columnar equivalent
+    if sql1_engine == 'SQL':
+        first_query_result = core.sql_query(filepath, query, start, end)
+    else:
+        first_query_result = core.non_returning_users(filepath, start, end)
 
     st.code(query, language="sql")
 
@@ -94,57 +99,146 @@ with tab3:
 
     st.markdown(
         """Here we are trying to analyze traffic outliers (abnormal session counts). 
-        Ideally I would prefer to consider any traffic count that goes beyond a certain percentile (like 75th or 95th percentile).
-        However the pandasql library uses SQLite and we cannot perform percentile calculation with it. 
-        So in that case I made it a bit more interactive by calculating the average session count per user and calculate the abnormal values based on a user input multiplier that you can change.
+        The session count per user is summarised once, so any traffic count that goes beyond a certain percentile (75th, 95th or 99th percentile) can be flagged directly.
+        It can also be made a bit more interactive by calculating the average or median session count per user and calculate the abnormal values based on a user input multiplier that you can change.
         This query can also be adapted to detect abnormal event actions like add to cart or purchase or even session duration.
+        Session durations come from sessions rebuilt from each user's events, a new session starting after the selected inactivity gap.
         """""
     )
 
-    multiplier = st.slider("Select Multiplier to detect abnormal Session Count per User",
-                           min_value=1.0, max_value=8.0, value=3.0, step=0.5)
-
-    second_query = f"""
-    WITH user_summary AS (
-    SELECT
-        user,
-        COUNT(*) AS total_sessions,
-        COUNT(DISTINCT page_type) AS page_types_visited
-    FROM df
-    GROUP BY user
-    ),
-    avg_values AS (
-    SELECT
-        AVG(total_sessions) AS avg_total_sessions
-    FROM user_summary
+    # threshold options live with the summary engine, loaded with this tab
+    from analytics.sessions import DEFAULT_GAP_MINUTES
+    from analytics.user_summary import METRICS, MULTIPLIER_MODES, THRESHOLD_MODES
+
+    abnormal_metric = st.radio(
+        'Flag users on',
+        tuple(METRICS),
+        format_func=lambda x: METRICS[x],
+        horizontal=True
     )
 
-    SELECT
-    user,
-    total_sessions,
-    page_types_visited,
-    CASE
-        WHEN total_sessions > {multiplier} * avg_values.avg_total_sessions THEN 'Abnormal Session Count'
-        ELSE 'Normal'
-    END AS abnormal_behavior
-    FROM user_summary, avg_values
-    LIMIT 30000 -- limited to 30K rows to be lighter on performance after dataframe creation
-    """
+    # every metric but the session count comes from sessions rebuilt from user + event_date
+    if abnormal_metric != 'total_sessions':
+        gap_minutes = st.slider("Inactivity gap that ends a rebuilt session (minutes)",
+                                min_value=5, max_value=120, value=DEFAULT_GAP_MINUTES, step=5)
+        rebuilt = core.sessions(filepath, gap_minutes, start, end)
+        st.caption(f"{len(rebuilt)} sessions rebuilt from the events, "
+                   f"median duration {rebuilt['duration_seconds'].median() / 60:.1f} min")
+    else:
+        gap_minutes = None
 
-    st.code(second_query, language="sql")
+    threshold_mode = st.radio(
+        'Abnormal Session Count threshold',
+        tuple(THRESHOLD_MODES),
+        format_func=lambda x: THRESHOLD_MODES[x],
+        horizontal=True
+    )
 
-    # Run the SQL query on the DataFrame
-    second_query_result = ps.sqldf(second_query, locals())
+    if threshold_mode in MULTIPLIER_MODES:
+        multiplier = st.slider(f"Select Multiplier to detect abnormal {METRICS[abnormal_metric]} per User",
+                               min_value=1.0, max_value=8.0, value=3.0, step=0.5)
+    else:
+        multiplier = None
+
+    from analytics.paging import DEFAULT_PAGE_SIZE, PAGE_SIZES
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        abnormal_only = st.toggle("Abnormal Only")
+        search = st.text_input("Search user")
+    with col2:
+        min_sessions = st.number_input("Min sessions", min_value=0, value=0, step=1)
+        sort_by = st.selectbox("Sort by", ('user', 'total_sessions', 'page_types_visited'))
+    with col3:
+        descending = st.toggle("Descending")
+        page_size = st.selectbox("Rows per page", PAGE_SIZES,
+                                 index=PAGE_SIZES.index(DEFAULT_PAGE_SIZE))
+    page_number = st.number_input("Page", min_value=1, value=1, step=1)
+
+    if threshold_mode == 'average' and abnormal_metric == 'total_sessions':
+        second_query = abnormal_sessions_query(
+            multiplier, abnormal_only, min_sessions, search, sort_by, descending,
+            page_size, (page_number - 1) * page_size)
+
+        st.code(second_query, language="sql")
+
+    # Re-threshold the cached per-user summary instead of re-running the query,
+    # filtering, sorting and paging it on the server so only this page is sent
+    page, n_abnormal = core.abnormal_users_page(
+        filepath, threshold_mode, multiplier, start, end, abnormal_metric, gap_minutes,
+        abnormal_only=abnormal_only, min_sessions=min_sessions, search=search,
+        sort_by=sort_by, descending=descending, page=page_number, page_size=page_size)
 
     st.subheader("2nd query output")
 
-    st.button("Reset", type="primary")
+    first_row = (page.number - 1) * page.size
+    st.caption(f"{n_abnormal} abnormal users. Page {page.number} of {page.n_pages}, "
+               f"rows {min(first_row + 1, page.total)}-{first_row + len(page.rows)} "
+               f"of {page.total} matching users.")
+    st.dataframe(page.rows, hide_index=True)
 
-    if st.button("Toggle Abnormal Only"):
-        second_query_df = second_query_result[second_query_result['abnormal_behavior']
-                                              == 'Abnormal Session Count']
 
-        st.dataframe(second_query_df)
+# ad-hoc queries
 
-    else:
-        st.dataframe(second_query_result)
+
+with tab4:
+    st.subheader("SQL Console")
+
+    st.markdown(
+        """Run your own read-only query on the events, as `df`, `sql_df` or `events`
+        (the sidebar date range applies). Pass values as named parameters (`:name`
+        in the query, one `name=value` per line below) rather than in the query text.
+        Each query stops at its timeout and row budget, and results are cached per
+        query, parameters and data version, so repeated queries return instantly.
+        """
+    )
+
+    from analytics.console import (DEFAULT_ROW_BUDGET, DEFAULT_TIMEOUT_SECONDS, EXAMPLE_PARAMS,
+                                   EXAMPLE_QUERY, MAX_ROW_BUDGET, MAX_TIMEOUT_SECONDS,
+                                   parse_params)
+
+    with st.form('sql_console'):
+        console_query = st.text_area("Query", EXAMPLE_QUERY, height=200)
+        console_params = st.text_area("Parameters", EXAMPLE_PARAMS, height=80)
+        col1, col2 = st.columns(2)
+        with col1:
+            console_timeout = st.number_input("Timeout (seconds)", min_value=1,
+                                              max_value=MAX_TIMEOUT_SECONDS,
+                                              value=DEFAULT_TIMEOUT_SECONDS)
+        with col2:
+            console_rows = st.number_input("Row budget", min_value=1, max_value=MAX_ROW_BUDGET,
+                                           value=DEFAULT_ROW_BUDGET, step=1000)
+        if st.form_submit_button("Run query", type="primary"):
+            # kept across reruns, a cached result comes back without running again
+            st.session_state['console_request'] = (console_query, console_params,
+                                                   console_timeout, console_rows)
+
+    if 'console_request' in st.session_state:
+        console_query, console_params, console_timeout, console_rows = \
+            st.session_state['console_request']
+        try:
+            console_result, from_cache = core.console_query(
+                filepath, console_query, parse_params(console_params), start, end,
+                console_timeout, console_rows)
+        except (ValueError, TimeoutError) as error:
+            st.error(f"Query failed: {error}")
+        else:
+            source = 'cached result' if from_cache else f'ran in {console_result.seconds:.3f} s'
+            st.caption(f"{len(console_result.frame)} rows, {source}.")
+            if console_result.truncated:
+                st.warning(f"Stopped at the row budget of {console_rows} rows.")
+            st.dataframe(console_result.frame, hide_index=True)
+
+
+# profiling results of this rerun, also logged as JSON lines by analytics.profiling
+if profile is not None:
+    profile.stop()
+
+    profiling_panel.caption(f'Rerun took {profile.seconds:.3f} s')
+    memory = core.memory_report()
+    if memory is not None:
+        profiling_panel.caption(f"Events in memory: {memory['encoded_mb']:.1f} MB "
+                                f"({memory['parsed_mb']:.1f} MB as parsed), read from {memory['source']}")
+    profiling_panel.dataframe(profile.to_frame(), hide_index=True)
+    profiling_panel.download_button('Export as JSON', profile.to_json(),
+                                    file_name='profile.json', mime='application/json')
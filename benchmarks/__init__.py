@@ -0,0 +1 @@
+"""Synthetic data generator and stage-by-stage benchmarks for the dashboard."""
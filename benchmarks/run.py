@@ -0,0 +1,260 @@
+"""Stage-by-stage benchmark of the dashboard pipeline on synthetic data.
+
+Each stage runs once on a synthetic event file of the requested size (see
+``benchmarks.synthetic``), timed with ``perf_counter`` while a sampler thread
+records the peak resident memory of the process. The stages follow the order
+the apps run them: CSV load, datetime parsing, first page type per session and
+user, the funnel for every page type and scope, both SQL queries and the
+product ranking. ``--legacy`` also times the original implementations (sort +
+merge funnel, pandasql) on the same frame for comparison, and ``--workers``
+the process-pool aggregation of ``analytics.parallel`` at each pool size.
+
+Results are written as JSON, one run per file size:
+
+    python -m benchmarks.run --rows 1000000 10000000 --output bench_results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from analytics.cohorts import build_cohort_cube, retention_matrix
+from analytics.first_session import non_returning_users_per_day
+from analytics.first_touch import first_touch_index
+from analytics.loader import iter_events
+from analytics.funnel import PAGE_TYPES, SCOPES, build_funnel_cube, funnel_metrics
+from analytics.olap import build_olap_cube, rollup_funnel_cube
+from analytics.parallel import parallel_aggregates, partition_by_user
+from analytics.paths import build_page_paths, top_sequences
+from analytics.products import top_added_to_cart
+from analytics.profiling import rss
+from analytics.queries import NON_RETURNING_USERS_QUERY, abnormal_sessions_query
+from analytics.sessions import sessionize, user_session_stats
+from analytics.sql import PandasqlBackend, SQLiteBackend
+from analytics.trends import build_trend_cube, trend_metrics
+from analytics.user_summary import abnormal_page, build_user_summary, flag_abnormal
+from benchmarks.synthetic import write_events
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+MB = 1 << 20
+
+
+def _max_rss():
+    import resource
+
+    # ru_max_rss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_max_rss
+    return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+class PeakMemory:
+    """Samples resident memory in a background thread while a stage runs.
+
+    Falls back to the process high-water mark where /proc is unavailable, in
+    which case the peak of a stage can't be lower than that of earlier ones.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = self.peak = rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss())
+
+    def __enter__(self):
+        if self.start is not None:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is None:
+            self.start, self.peak = None, _max_rss()
+            return
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss())
+
+
+class Stages:
+    """Runs and records named stages."""
+
+    def __init__(self, verbose=True):
+        self.records = []
+        self.verbose = verbose
+
+    def __call__(self, name, func, *args, **kwargs):
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            seconds = time.perf_counter() - start
+
+        record = {
+            'stage': name,
+            'seconds': round(seconds, 4),
+            'peak_rss_mb': round(memory.peak / MB, 1),
+            'rss_growth_mb': None if memory.start is None else round((memory.peak - memory.start) / MB, 1),
+        }
+        self.records.append(record)
+        if self.verbose:
+            print(f"  {name:<40} {seconds:9.3f}s  peak {record['peak_rss_mb']:9.1f} MB")
+        return result
+
+
+def legacy_funnel(df, scope):
+    """The original funnel: sort, first row per key, merge back, nunique per page type."""
+    df_sorted = df.sort_values(by=[scope, 'event_date'])
+    first_page_type_df = df_sorted.groupby(scope).first().reset_index()[[scope, 'page_type']]
+    df_first = df.merge(first_page_type_df, on=scope, how='left', suffixes=('', '_first'))
+    purchase_df = df[df['event_type'] == 'order']
+
+    metrics = {}
+    for page_type in PAGE_TYPES.values():
+        atc_df = df_first[(df_first['page_type_first'] == page_type)
+                          & (df_first['event_type'] == 'add_to_cart')]
+        metrics[page_type] = (
+            df_first.loc[df_first['page_type_first'] == page_type, scope].nunique(),
+            atc_df[scope].nunique(),
+            atc_df.merge(purchase_df, on=scope, how='inner')[scope].nunique(),
+        )
+    return metrics
+
+
+def all_funnels(cube):
+    return {(scope, page_type): funnel_metrics(cube, page_type, scope)
+            for scope in SCOPES for page_type in (None, *PAGE_TYPES)}
+
+
+def all_trends(cube, freq='D'):
+    return {(scope, page_type): trend_metrics(cube, page_type, scope, freq)
+            for scope in SCOPES for page_type in (None, *PAGE_TYPES)}
+
+
+def run_pipeline(filepath, legacy=False, workers=(), verbose=True):
+    """Time every stage on ``filepath``, returns the stage records."""
+    stage = Stages(verbose)
+
+    df = stage('csv_load', pd.read_csv, filepath)
+    df['event_date'] = stage('datetime_parse', pd.to_datetime, df['event_date'])
+
+    touch = {}
+    for scope in SCOPES:
+        touch[scope] = stage(f'first_page_type[{scope}]', first_touch_index, df, scope)
+
+    cube = stage('funnel_cube', build_funnel_cube, df)
+    stage('funnel_lookup[all page types x scopes]', all_funnels, cube)
+    trends = stage('trend_cube', build_trend_cube, df)
+    stage('trend_rollup[daily, all funnels]', all_trends, trends)
+    olap = stage('olap_cube', build_olap_cube, df)
+    last_day = df['event_date'].max().date()
+    stage('funnel_rollup[last 7 days]', rollup_funnel_cube, olap,
+          last_day - datetime.timedelta(days=6), last_day)
+    if legacy:
+        for scope in SCOPES:
+            stage(f'legacy_funnel[{scope}]', legacy_funnel, df, scope)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        backend = stage('sqlite_load', SQLiteBackend, [df], os.path.join(tmp, 'events.sqlite'))
+        stage('sql1_sqlite', backend.query, NON_RETURNING_USERS_QUERY)
+        stage('sql1_native', non_returning_users_per_day, df)
+        stage('sql2_sqlite', backend.query, abnormal_sessions_query(3.0))
+        backend.close()
+
+    summary = stage('sql2_user_summary', build_user_summary, df)
+    stage('sql2_threshold[average]', flag_abnormal, summary, 'average', 3.0)
+    stage('sql2_threshold[p95]', flag_abnormal, summary, 'p95')
+    stage('sql2_page[abnormal only, by sessions]', abnormal_page, summary, 'average', 3.0,
+          abnormal_only=True, sort_by='total_sessions', descending=True)
+
+    sessions = stage('sessionize[30 min gap]', sessionize, df)
+    stage('session_stats', user_session_stats, sessions)
+
+    for scope in SCOPES:
+        paths = stage(f'page_paths[{scope}]', build_page_paths, df, scope)
+        stage(f'top_sequences[{scope}]', top_sequences, paths)
+
+    cohorts = stage('cohort_cube', build_cohort_cube, df)
+    stage('retention_matrix[weekly, users]', retention_matrix, cohorts, 'user', 'Weekly')
+
+    if legacy:
+        pandasql = PandasqlBackend([df])
+        stage('legacy_sql1_pandasql', pandasql.query, NON_RETURNING_USERS_QUERY)
+        stage('legacy_sql2_pandasql', pandasql.query, abnormal_sessions_query(3.0))
+
+    for scope in SCOPES:
+        stage(f'product_ranking[{scope}]', top_added_to_cart, df, touch[scope], scope, 50)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in workers:
+            path = stage(f'parallel_partition[{n}]', partition_by_user,
+                         iter_events(filepath, 1_000_000), os.path.join(tmp, f'users-{n}'), n)
+            stage(f'parallel_aggregates[{n} workers]', parallel_aggregates, path, n)
+
+    return stage.records
+
+
+def dataset(rows, seed=0, data_dir=DATA_DIR):
+    """Path of the synthetic file with ``rows`` events, generated on first use."""
+    os.makedirs(data_dir, exist_ok=True)
+    filepath = os.path.join(data_dir, f'events_{rows}_{seed}.csv')
+    if not os.path.exists(filepath):
+        tmp_path = f'{filepath}.{os.getpid()}.tmp'
+        write_events(tmp_path, rows, seed=seed)
+        os.replace(tmp_path, filepath)
+    return filepath
+
+
+def environment():
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000_000],
+                        help="synthetic file sizes to run, e.g. 1000000 10000000 100000000")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help="where the synthetic files are generated and reused")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--legacy', action='store_true',
+                        help="also time the original sort + merge funnel and pandasql")
+    parser.add_argument('--workers', type=int, nargs='*', default=[],
+                        help="process pool sizes to time the parallel aggregation with, e.g. 2 8 32")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for rows in args.rows:
+        filepath = dataset(rows, args.seed, args.data_dir)
+        print(f"{rows:,} rows ({os.path.getsize(filepath) / MB:,.0f} MB): {filepath}")
+        runs.append({
+            'rows': rows,
+            'file_mb': round(os.path.getsize(filepath) / MB, 1),
+            'stages': run_pipeline(filepath, legacy=args.legacy,
+                                   workers=args.workers),
+        })
+
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'runs': runs}, f, indent=2)
+    print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
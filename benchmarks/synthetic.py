@@ -0,0 +1,128 @@
+"""Synthetic event files with the schema and funnel shape of the real export.
+
+Events are generated user by user in vectorized batches: a user has one or
+more sessions, a session a handful of page views starting on a listing,
+product or search listing page, a few percent of sessions add products to
+cart, and most of those place an order. The defaults approximate the
+proportions of ``data_set_da_test.csv`` (about 1.2 sessions per user, 2 events
+per session, 3% add to cart and 70% of carts ordered).
+
+    python -m benchmarks.synthetic events.csv --rows 1000000
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = ['event_date', 'session', 'user', 'page_type', 'event_type', 'product']
+
+FIRST_PAGE_PROBS = {
+    'listing_page': 0.52,
+    'product_page': 0.43,
+    'search_listing_page': 0.05,
+}
+
+NEXT_PAGE_PROBS = {
+    'listing_page': 0.36,
+    'product_page': 0.46,
+    'search_listing_page': 0.18,
+}
+
+START = np.datetime64('2022-09-30T00:00:00', 's')
+DAYS = 14
+
+# expected events per user with the default rates, used to size batches
+_EVENTS_PER_USER = 2.3
+
+
+def _choice(rng, probs, size):
+    labels = np.array(list(probs), dtype=object)
+    return labels[rng.choice(len(labels), size=size, p=list(probs.values()))]
+
+
+def _ids(rng, size, suffix):
+    return np.char.add(rng.integers(1, 2**63, size=size, dtype=np.int64).astype(str), suffix)
+
+
+def generate_batch(rng, n_users, days=DAYS, extra_session_p=0.15,
+                   extra_event_p=0.47, add_to_cart_p=0.03, order_p=0.7,
+                   n_products=50_000):
+    """One batch of events for ``n_users`` new users, in random order."""
+    sessions_per_user = rng.geometric(1 - extra_session_p, size=n_users)
+    n_sessions = int(sessions_per_user.sum())
+    session_user = np.repeat(_ids(rng, n_users, 'u'), sessions_per_user)
+    session_ids = _ids(rng, n_sessions, 's')
+    session_start = START + rng.integers(0, days * 86400, size=n_sessions).astype('timedelta64[s]')
+
+    events_per_session = rng.geometric(1 - extra_event_p, size=n_sessions)
+    n_views = int(events_per_session.sum())
+    view_session = np.repeat(np.arange(n_sessions), events_per_session)
+
+    # position of each view within its session and time since session start
+    first_view = np.repeat(np.cumsum(events_per_session) - events_per_session, events_per_session)
+    position = np.arange(n_views) - first_view
+    gaps = rng.exponential(120, size=n_views).astype('int64')
+    gaps[position == 0] = 0
+    offset = np.cumsum(gaps) - np.repeat(np.cumsum(gaps)[first_view[position == 0]], events_per_session)
+
+    page_type = _choice(rng, NEXT_PAGE_PROBS, n_views)
+    page_type[position == 0] = _choice(rng, FIRST_PAGE_PROBS, n_sessions)
+    event_type = np.full(n_views, 'page_view', dtype=object)
+    product = np.zeros(n_views, dtype=np.int64)
+
+    # carts: one view of a cart session becomes an add to cart, mostly on a
+    # product page, with a long-tailed product popularity
+    cart_session = rng.random(n_sessions) < add_to_cart_p
+    last_view = np.cumsum(events_per_session) - 1
+    cart_view = last_view[cart_session]
+    event_type[cart_view] = 'add_to_cart'
+    page_type[cart_view] = np.where(rng.random(len(cart_view)) < 0.8,
+                                    'product_page', page_type[cart_view])
+    product[cart_view] = np.minimum(rng.zipf(1.3, size=len(cart_view)), n_products)
+
+    ordered = cart_session & (rng.random(n_sessions) < order_p)
+    order_session = np.flatnonzero(ordered)
+    order_offset = offset[last_view[ordered]] + rng.exponential(300, size=len(order_session)).astype('int64') + 1
+
+    event_session = np.concatenate([view_session, order_session])
+    batch = pd.DataFrame({
+        'event_date': (session_start[event_session]
+                       + np.concatenate([offset, order_offset]).astype('timedelta64[s]')),
+        'session': session_ids[event_session],
+        'user': session_user[event_session],
+        'page_type': np.concatenate([page_type, np.full(len(order_session), 'order_page', dtype=object)]),
+        'event_type': np.concatenate([event_type, np.full(len(order_session), 'order', dtype=object)]),
+        'product': np.concatenate([product, np.zeros(len(order_session), dtype=np.int64)]),
+    }, columns=COLUMNS)
+
+    return batch.iloc[rng.permutation(len(batch))]
+
+
+def write_events(filepath, rows, seed=0, batch_rows=1_000_000, **kwargs):
+    """Write at least ``rows`` synthetic events to ``filepath`` as CSV."""
+    rng = np.random.default_rng(seed)
+    written = 0
+    with open(filepath, 'w', newline='') as f:
+        while written < rows:
+            n_users = max(1, int(min(batch_rows, rows - written) / _EVENTS_PER_USER))
+            batch = generate_batch(rng, n_users, **kwargs)
+            batch.to_csv(f, header=written == 0, index=False,
+                         date_format='%Y-%m-%d %H:%M:%S')
+            written += len(batch)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', help="CSV file to write")
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    written = write_events(args.output, args.rows, seed=args.seed)
+    print(f"wrote {written:,} events to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""The apps under Streamlit's script runner."""
+import os
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+from analytics.loader import DEFAULT_FILEPATH, peek
+from benchmarks.synthetic import write_events
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    write_events(tmp_path / DEFAULT_FILEPATH, 20_000, seed=5)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('DASHBOARD_INGESTION', 'memory')
+    return tmp_path
+
+
+def test_app_with_workers(data_dir, monkeypatch):
+    # the script runner installs app.py as __main__, as ``streamlit run`` does
+    monkeypatch.setenv('DASHBOARD_WORKERS', '2')
+    at = AppTest.from_file(os.path.join(ROOT, 'app.py'), default_timeout=300).run()
+
+    assert not at.exception
+    assert peek(str(data_dir / DEFAULT_FILEPATH), 'parallel_2') is not None
@@ -0,0 +1,61 @@
+"""The columnar SQL 1 engine against the SQL query run by SQLite."""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from analytics.encoding import encode_events
+from analytics.first_session import RESULT_COLUMNS, non_returning_users_per_day
+from analytics.queries import NON_RETURNING_USERS_QUERY
+from analytics.sql import SQLiteBackend
+from benchmarks.synthetic import generate_batch
+
+
+def _events(rows):
+    return pd.DataFrame(rows, columns=['event_date', 'session', 'user', 'page_type',
+                                       'event_type', 'product']).assign(
+        event_date=lambda df: pd.to_datetime(df['event_date']))
+
+
+# MIN(session) compares ids as text: 's10' is u1's first session although
+# 's9' is earlier, u2 views products in two sessions, u3 only in its first
+# one and u4 never views a product
+EDGE_CASES = _events([
+    ('2022-10-01 10:00:00', 's9', 'u1', 'product_page', 'page_view', 0),
+    ('2022-10-02 11:00:00', 's10', 'u1', 'product_page', 'page_view', 0),
+    ('2022-10-02 11:05:00', 's10', 'u1', 'product_page', 'add_to_cart', 7),
+    ('2022-10-01 09:00:00', 's20', 'u2', 'product_page', 'page_view', 0),
+    ('2022-10-03 09:00:00', 's21', 'u2', 'product_page', 'page_view', 0),
+    ('2022-10-01 12:00:00', 's30', 'u3', 'listing_page', 'page_view', 0),
+    ('2022-10-01 12:01:00', 's30', 'u3', 'product_page', 'page_view', 0),
+    ('2022-10-02 08:00:00', 's30', 'u3', 'product_page', 'page_view', 0),
+    ('2022-10-04 08:00:00', 's31', 'u3', 'listing_page', 'page_view', 0),
+    ('2022-10-01 13:00:00', 's40', 'u4', 'listing_page', 'page_view', 0),
+])
+
+
+def _synthetic():
+    return generate_batch(np.random.default_rng(0), 5_000, extra_session_p=0.4).reset_index(drop=True)
+
+
+@pytest.fixture(params=['edge_cases', 'synthetic'])
+def events(request):
+    return EDGE_CASES if request.param == 'edge_cases' else _synthetic()
+
+
+def _sql_result(df, tmp_path):
+    backend = SQLiteBackend([df], os.path.join(tmp_path, 'events.sqlite'))
+    try:
+        expected = backend.query(NON_RETURNING_USERS_QUERY)
+    finally:
+        backend.close()
+    expected.columns = RESULT_COLUMNS
+    return expected.dropna(subset=['date']).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('encode', [False, True], ids=['plain', 'encoded'])
+def test_matches_sql(events, encode, tmp_path):
+    expected = _sql_result(events, tmp_path)
+    df = encode_events(events) if encode else events
+    pd.testing.assert_frame_equal(non_returning_users_per_day(df), expected, check_dtype=False)
@@ -0,0 +1,114 @@
+"""Incremental ingestion against the in-memory results of the concatenated batches."""
+import datetime
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from analytics import core
+from analytics.cohorts import RATES, build_cohort_cube, retention_matrix
+from analytics.first_session import non_returning_users_per_day
+from analytics.funnel import SCOPES
+from analytics.incremental import BatchStore
+from analytics.loader import peek, read_events
+from analytics.olap import build_olap_cube, rollup_funnel_cube
+from analytics.paths import build_page_paths, top_sequences, transition_table
+from analytics.sessions import sessionize
+from analytics.trends import build_trend_cube
+from analytics.snapshot import build_snapshot
+from benchmarks.synthetic import write_events
+
+
+N_BATCHES = 4
+
+
+@pytest.fixture(scope='module')
+def events_file(tmp_path_factory):
+    path = tmp_path_factory.mktemp('events') / 'events.csv'
+    write_events(path, 30_000, seed=2)
+    return path
+
+
+@pytest.fixture(scope='module')
+def events(events_file):
+    # batches are cut by time, so sessions and days continue across them
+    return read_events(events_file).sort_values('event_date', kind='stable', ignore_index=True)
+
+
+@pytest.fixture
+def filepath(events, events_file, tmp_path, monkeypatch):
+    monkeypatch.setenv('DASHBOARD_INGESTION', 'incremental')
+    monkeypatch.setenv('DASHBOARD_MEMORY_LIMIT_MB', '4')
+    monkeypatch.setenv('DASHBOARD_BATCH_DIR', str(tmp_path / 'batches'))
+
+    raw = pd.read_csv(events_file).sort_values('event_date', kind='stable', ignore_index=True)
+    bounds = [len(raw) * batch // N_BATCHES for batch in range(N_BATCHES + 1)]
+    files = []
+    for batch in range(N_BATCHES):
+        files.append(tmp_path / f'batch-{batch}.csv')
+        raw.iloc[bounds[batch]:bounds[batch + 1]].to_csv(files[-1], index=False)
+
+    # registered one batch at a time, as they would arrive
+    (tmp_path / 'batches').mkdir()
+    base = str(files[0])
+    core.funnel(base, None, 'user')
+    for file in files[1:]:
+        shutil.copy(file, tmp_path / 'batches')
+        core.funnel(base, None, 'user')
+    return base
+
+
+def test_olap_cube(filepath, events):
+    first_day = events['event_date'].min().date()
+    expected = build_olap_cube(events)
+    for start, end in ((None, None), (first_day + datetime.timedelta(days=2),
+                                      first_day + datetime.timedelta(days=6))):
+        pd.testing.assert_frame_equal(rollup_funnel_cube(core.olap_cube(filepath), start, end),
+                                      rollup_funnel_cube(expected, start, end),
+                                      check_dtype=False)
+
+
+def test_trend_cube(filepath, events):
+    pd.testing.assert_frame_equal(core.trend_cube(filepath), build_trend_cube(events))
+
+
+def test_key_partitions(filepath, events):
+    assert len(core.batch_store(filepath).batches) == N_BATCHES
+
+    pd.testing.assert_frame_equal(core.sessions(filepath), sessionize(events),
+                                  check_dtype=False, check_categorical=False)
+    for scope in SCOPES:
+        paths, expected = core.page_paths(filepath, scope), build_page_paths(events, scope)
+        pd.testing.assert_frame_equal(transition_table(paths), transition_table(expected))
+        pd.testing.assert_frame_equal(top_sequences(paths, 100), top_sequences(expected, 100),
+                                      check_dtype=False)
+
+    cube, expected = core.cohort_cube(filepath), build_cohort_cube(events)
+    for scope in SCOPES:
+        for granularity in ('Daily', 'Weekly'):
+            for metric in RATES:
+                pd.testing.assert_frame_equal(
+                    retention_matrix(cube, scope, granularity, metric),
+                    retention_matrix(expected, scope, granularity, metric), check_dtype=False)
+
+
+def test_reopened_store(filepath):
+    store = core.batch_store(filepath)
+    reopened = BatchStore(store.path, store.memory_limit_mb)
+    assert reopened.version == store.version
+
+    for scope in SCOPES:
+        for got, expected in zip(reopened.olap_cube()[scope], store.olap_cube()[scope]):
+            np.testing.assert_array_equal(got, expected)
+    aggregates, expected = reopened.aggregates(), store.aggregates()
+    pd.testing.assert_frame_equal(aggregates.funnel_cube, expected.funnel_cube)
+    pd.testing.assert_frame_equal(aggregates.user_summary, expected.user_summary)
+
+
+def test_snapshot_counts_every_batch(filepath, events):
+    snapshot = build_snapshot(filepath)
+
+    pd.testing.assert_frame_equal(snapshot['non_returning_users'],
+                                  non_returning_users_per_day(events), check_dtype=False)
+    assert peek(filepath, 'events') is None and peek(filepath, 'events_plain') is None
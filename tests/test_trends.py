@@ -0,0 +1,41 @@
+"""Funnel trends against the funnel of each day's and hour's own events."""
+import numpy as np
+import pytest
+
+from analytics.funnel import PAGE_TYPES, SCOPES, build_funnel_cube, funnel_metrics
+from analytics.olap import build_olap_cube, rollup_funnel_cube
+from analytics.trends import build_trend_cube, trend_metrics
+from benchmarks.synthetic import generate_batch
+
+
+COUNTS = ['sessions', 'interested_sessions', 'add_to_cart_sessions', 'purchase_sessions']
+
+
+@pytest.fixture(scope='module')
+def events():
+    # nanosecond timestamps, as the loader parses them
+    return (generate_batch(np.random.default_rng(1), 5_000, extra_session_p=0.4)
+            .astype({'event_date': 'datetime64[ns]'}).reset_index(drop=True))
+
+
+def test_daily_points_are_day_funnels(events):
+    cube, cells = build_trend_cube(events), build_olap_cube(events)
+    for scope in SCOPES:
+        for page_type in (None, *PAGE_TYPES):
+            trend = trend_metrics(cube, page_type, scope, 'D')
+            for day, row in trend.iterrows():
+                metrics = funnel_metrics(rollup_funnel_cube(cells, day.date(), day.date()),
+                                         page_type, scope)
+                assert row[COUNTS].tolist() == [metrics[count] for count in COUNTS]
+
+
+def test_hourly_points_are_hour_funnels(events):
+    cube = build_trend_cube(events)
+    hours = events['event_date'].dt.floor('h')
+    for hour in hours.drop_duplicates().sample(5, random_state=0):
+        funnels = build_funnel_cube(events[hours == hour].reset_index(drop=True))
+        for scope in SCOPES:
+            for page_type in (None, *PAGE_TYPES):
+                row = trend_metrics(cube, page_type, scope, 'h').loc[hour]
+                metrics = funnel_metrics(funnels, page_type, scope)
+                assert row[COUNTS].tolist() == [metrics[count] for count in COUNTS]